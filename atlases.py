@@ -0,0 +1,412 @@
+import os
+import json
+import hashlib
+import shutil
+import argparse
+from functools import lru_cache
+from tempfile import mkdtemp, TemporaryDirectory
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from scipy import sparse
+from nilearn import image, datasets
+from nilearn._utils.niimg_conversions import check_same_fov
+
+DEFAULT_REGISTRY_DIR = "/parcs/registry"
+ALL_PARCS = ["msdl", "gordon", "basc197", "basc444", "schaefer200", "schaefer400", "yeo17", "yeo17thin",
+             "yeo17split", "yeo7"]
+
+
+def fetch_roi_info(parc):
+    """
+    returns roi_file, roi_names, roi_type of a parcellation from the nilearn fetchers and /parcs
+    """
+    if parc == "msdl":
+        atlas = datasets.fetch_atlas_msdl()
+        roi_file = atlas['maps']
+        df_labels = pd.DataFrame({"roi_labels": atlas['labels']})
+        if isinstance(df_labels["roi_labels"][0], bytes):
+            df_labels["roi_labels"] = df_labels.roi_labels.apply(bytes.decode)
+        roi_names = df_labels["roi_labels"].values
+        roi_type = "maps"
+
+    elif parc == "gordon":
+        atlas_dir = "/parcs/Gordon/Parcels"
+        roi_file = os.path.join(atlas_dir, "Parcels_MNI_111.nii")
+        labs_df = pd.read_excel(os.path.join(atlas_dir, "Parcels.xlsx"))
+        roi_names = labs_df.ParcelID.values
+        roi_type = "labels"
+
+    elif parc == "basc197":
+        atlas = datasets.fetch_atlas_basc_multiscale_2015(version='sym')
+        roi_file = atlas['scale197']
+        roi_names = np.arange(1, 198).astype(int)
+        roi_type = "labels"
+
+    elif parc == "basc444":
+        atlas = datasets.fetch_atlas_basc_multiscale_2015(version='sym')
+        roi_file = atlas['scale444']
+        roi_names = np.arange(1, 445).astype(int)
+        roi_type = "labels"
+
+    elif parc == "schaefer200":
+        atlas_dir = "/parcs/Schaefer"
+        schaefer_cols = "roi community c1 c2 c3 c4".split(" ")
+        roi_file = os.path.join(atlas_dir, "Schaefer2018_200Parcels_17Networks_order_FSLMNI152_1mm.nii.gz")
+        labs_df = pd.read_csv(os.path.join(atlas_dir, "Schaefer2018_200Parcels_17Networks_order.txt"), sep="\t",
+                              names=schaefer_cols)
+        roi_names = labs_df.roi
+        roi_type = "labels"
+
+    elif parc == "schaefer400":
+        atlas_dir = "/parcs/Schaefer"
+        schaefer_cols = "roi community c1 c2 c3 c4".split(" ")
+        roi_file = os.path.join(atlas_dir, "Schaefer2018_400Parcels_17Networks_order_FSLMNI152_1mm.nii.gz")
+        labs_df = pd.read_csv(os.path.join(atlas_dir, "Schaefer2018_400Parcels_17Networks_order.txt"), sep="\t",
+                              names=schaefer_cols)
+        roi_names = labs_df.roi
+        roi_type = "labels"
+
+    elif parc == "yeo17":
+        atlas = datasets.fetch_atlas_yeo_2011()
+        roi_file = atlas['thick_17']
+        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
+        df_labels = pd.read_csv(atlas["colors_17"], sep=r"\s+", names=yeo_cols, skiprows=1)
+        roi_names = df_labels["roi_labels"].values
+        roi_type = "labels"
+
+    elif parc == "yeo17thin":
+        atlas = datasets.fetch_atlas_yeo_2011()
+        roi_file = atlas['thin_17']
+        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
+        df_labels = pd.read_csv(atlas["colors_17"], sep=r"\s+", names=yeo_cols, skiprows=1)
+        roi_names = df_labels["roi_labels"].values
+        roi_type = "labels"
+
+    elif parc == "yeo17split":
+        atlas_dir = "/parcs/Yeo_splithemi"
+        roi_file = os.path.join(atlas_dir, "yeo_2011_thick17_splithemi.nii.gz")
+        labs_df = pd.read_csv(os.path.join(atlas_dir, "yeo_2011_thick17_splithemi.tsv"), sep="\t")
+        roi_names = labs_df.full_roi_name.values
+        roi_type = "labels"
+
+    elif parc == "yeo7":
+        atlas = datasets.fetch_atlas_yeo_2011()
+        roi_file = atlas['thick_7']
+        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
+        df_labels = pd.read_csv(atlas["colors_7"], sep=r"\s+", names=yeo_cols, skiprows=1)
+        roi_names = df_labels["roi_labels"].values
+        roi_type = "labels"
+    else:
+        raise Exception("Parcellation not known {}".format(parc))
+    return roi_file, roi_names, roi_type
+
+
+@lru_cache(maxsize=None)
+def _read_registry(registry_file, mtime):
+    with open(registry_file) as fi:
+        return json.load(fi)
+
+
+def load_registry(registry_dir):
+    """
+    returns dict {parc: {"roi_file":..., "roi_type":..., "roi_names": [...]}} of the atlas registry in registry_dir
+    (empty if there is no registry)
+    """
+    registry_file = os.path.join(registry_dir, "registry.json")
+    if not os.path.exists(registry_file):
+        return {}
+    return _read_registry(registry_file, os.stat(registry_file).st_mtime)
+
+
+def get_roi_info(parc, registry_dir=DEFAULT_REGISTRY_DIR):
+    """
+    returns roi_file, roi_names, roi_type of a parcellation.
+    If parc is in the registry in registry_dir (see build_registry), the local copy is used, which needs no
+    fetching and no network. Otherwise falls back to fetch_roi_info.
+    """
+    registry = load_registry(registry_dir) if registry_dir else {}
+    if parc in registry:
+        entry = registry[parc]
+        return os.path.join(registry_dir, entry["roi_file"]), np.array(entry["roi_names"]), entry["roi_type"]
+    return fetch_roi_info(parc)
+
+
+def add_to_registry(registry_dir, parc, roi_file, roi_names, roi_type):
+    """
+    copies an atlas into the registry in registry_dir as uncompressed nifti (labels as compact integer arrays) and
+    stores its roi names and type in registry.json
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    img = image.load_img(roi_file)
+    if roi_type == "labels":
+        data = np.asarray(img.dataobj)
+        dtype = np.int16 if data.max() < np.iinfo(np.int16).max else np.int32
+        data = data.astype(dtype)
+    else:
+        data = np.asarray(img.dataobj)
+    out_file = "{}.nii".format(parc)
+    nb.Nifti1Image(data, img.affine).to_filename(os.path.join(registry_dir, out_file))
+
+    registry = dict(load_registry(registry_dir))
+    roi_names = [n.decode() if isinstance(n, bytes) else n for n in np.asarray(roi_names).tolist()]
+    registry[parc] = {"roi_file": out_file, "roi_type": roi_type, "roi_names": roi_names}
+
+    registry_file = os.path.join(registry_dir, "registry.json")
+    with open(registry_file + ".tmp", "w") as fi:
+        json.dump(registry, fi)
+    os.replace(registry_file + ".tmp", registry_file)
+
+
+def build_registry(registry_dir, parcs=ALL_PARCS):
+    """
+    materializes all parcellations into the registry in registry_dir. Run once (e.g., when building the docker
+    image); afterwards get_roi_info works without fetchers or network.
+    Parcellations that are not available (e.g., gordon without /parcs/Gordon) are skipped.
+    """
+    for parc in parcs:
+        try:
+            if parc == "yeo17split" and not os.path.exists("/parcs/Yeo_splithemi"):
+                from yeo_sephem import split_yeo
+                with TemporaryDirectory() as tmp_dir:
+                    split_yeo(tmp_dir)
+                    labs_df = pd.read_csv(os.path.join(tmp_dir, "yeo_2011_thick17_splithemi.tsv"), sep="\t")
+                    add_to_registry(registry_dir, parc, os.path.join(tmp_dir, "yeo_2011_thick17_splithemi.nii.gz"),
+                                    labs_df.full_roi_name.values, "labels")
+            else:
+                roi_file, roi_names, roi_type = fetch_roi_info(parc)
+                add_to_registry(registry_dir, parc, roi_file, roi_names, roi_type)
+            print("Added {} to atlas registry".format(parc))
+        except Exception as e:
+            print("Could not add {} to atlas registry: {}".format(parc, e))
+
+
+def _resample_to_ref(img, ref_img, interpolation):
+    img = image.load_img(img)
+    if not check_same_fov(img, ref_img):
+        img = image.resample_img(img, target_affine=ref_img.affine, target_shape=ref_img.shape[:3],
+                                 interpolation=interpolation)
+    return img
+
+
+def get_mask_data(brainmask_file, ref_img):
+    """
+    returns boolean brain mask on the grid of ref_img (the rs image)
+    """
+    mask_img = _resample_to_ref(brainmask_file, ref_img, "nearest")
+    return np.asarray(mask_img.dataobj).astype(bool)
+
+
+@lru_cache(maxsize=None)
+def _file_hash(filename, size, mtime):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fi:
+        for chunk in iter(lambda: fi.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_cache_key(roi_file, ref_img, interpolation):
+    """
+    content-addressed key: atlas file hash + target grid (affine, shape) + interpolation
+    """
+    st = os.stat(roi_file)
+    h = hashlib.sha1(_file_hash(os.path.abspath(roi_file), st.st_size, st.st_mtime).encode())
+    h.update(np.round(np.asarray(ref_img.affine, dtype=np.float64), 6).tobytes())
+    h.update(str(tuple(ref_img.shape[:3])).encode())
+    h.update(interpolation.encode())
+    return h.hexdigest()
+
+
+def _resample_atlas(roi_file, roi_type, ref_img):
+    if roi_type == "labels":
+        labels_img = _resample_to_ref(roi_file, ref_img, "nearest")
+        labels_data = np.asarray(labels_img.dataobj)
+        labels = np.unique(labels_data)
+        labels = labels[labels != 0]
+        voxels = np.flatnonzero(labels_data)
+        rows = np.searchsorted(labels, labels_data.ravel()[voxels])
+        return {"labels_data": labels_data, "labels": labels, "voxels": voxels, "rows": rows}
+
+    elif roi_type == "maps":
+        maps_img = _resample_to_ref(roi_file, ref_img, "continuous")
+        maps_data = maps_img.get_fdata().reshape(-1, maps_img.shape[-1])
+        voxels = np.flatnonzero((maps_data != 0).any(axis=1))
+        return {"voxels": voxels, "maps": maps_data[voxels]}
+
+    else:
+        raise Exception("roi type not known {}".format(roi_type))
+
+
+def get_resampled_atlas(roi_file, roi_type, ref_img, cache_dir=None):
+    """
+    returns the atlas resampled to the grid of ref_img as dict of arrays
+    * labels: "labels_data" (resampled label volume), "labels" (sorted roi labels), and the voxel->roi index arrays
+      "voxels" (flat indices of labelled voxels) and "rows" (roi index of each of those voxels)
+    * maps: "voxels" (flat indices of voxels with non-zero maps) and "maps" (n_voxels x n_maps)
+
+    if cache_dir is given, results are stored there and re-used for all jobs with the same atlas file content, grid
+    and interpolation. Cache entries are written to a temporary directory and renamed, so concurrent joblib workers
+    never see half-written entries. Cached arrays are memory-mapped.
+    """
+    if not cache_dir:
+        return _resample_atlas(roi_file, roi_type, ref_img)
+
+    interpolation = "nearest" if roi_type == "labels" else "continuous"
+    entry_dir = os.path.join(cache_dir, _get_cache_key(roi_file, ref_img, interpolation))
+
+    if not os.path.isdir(entry_dir):
+        resampled = _resample_atlas(roi_file, roi_type, ref_img)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = mkdtemp(dir=cache_dir, prefix=".tmp_")
+        for k, v in resampled.items():
+            np.save(os.path.join(tmp_dir, k + ".npy"), v)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # another worker was faster
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return resampled
+
+    return {os.path.splitext(f)[0]: np.load(os.path.join(entry_dir, f), mmap_mode="r")
+            for f in os.listdir(entry_dir)}
+
+
+def get_resampled_atlas_img(roi_file, roi_type, ref_img, cache_dir=None):
+    """
+    returns the atlas resampled to the grid of ref_img as nifti image (from the cache if cache_dir is given).
+    Can be passed to the nilearn maskers, which then do not resample again.
+    """
+    resampled = get_resampled_atlas(roi_file, roi_type, ref_img, cache_dir)
+    if roi_type == "labels":
+        data = np.array(resampled["labels_data"])
+    else:
+        maps = np.zeros((np.prod(ref_img.shape[:3]), resampled["maps"].shape[1]))
+        maps[resampled["voxels"]] = resampled["maps"]
+        data = maps.reshape(tuple(ref_img.shape[:3]) + (maps.shape[1],))
+    return image.new_img_like(ref_img, data, affine=ref_img.affine)
+
+
+def get_parcel_operator(roi_file, roi_type, ref_img, mask_data, cache_dir=None):
+    """
+    returns a sparse (n_rois x n_mask_voxels) matrix W, so that W.dot(masked_data) gives the same parcel time series
+    as the nilearn maskers with resampling_target="data"
+    * labels: each row is a normalized indicator of the roi voxels within the mask (i.e., the mean across voxels).
+      Rois that are entirely outside the mask get a row of zeros (like NiftiLabelsMasker).
+    * maps: least squares fit of the maps to the data (like NiftiMapsMasker), i.e., the pseudo-inverse of the maps
+      on their support within the mask
+    masked_data has shape (n_mask_voxels, n_volumes), with voxels ordered like data[mask_data]
+    """
+    resampled = get_resampled_atlas(roi_file, roi_type, ref_img, cache_dir)
+    mask_flat = mask_data.ravel()
+    mask_pos = np.cumsum(mask_flat) - 1
+    in_mask = mask_flat[resampled["voxels"]]
+    cols = mask_pos[resampled["voxels"][in_mask]]
+
+    if roi_type == "labels":
+        n_labels = len(resampled["labels"])
+        rows = resampled["rows"][in_mask]
+        counts = np.bincount(rows, minlength=n_labels)
+        weights = 1. / counts[rows]
+        operator = sparse.csr_matrix((weights, (rows, cols)), shape=(n_labels, mask_flat.sum()))
+
+    elif roi_type == "maps":
+        masked_maps = resampled["maps"][in_mask]
+        support = (masked_maps > 0).any(axis=1)
+        pinv = np.linalg.pinv(masked_maps[support])
+        rows = np.repeat(np.arange(pinv.shape[0]), support.sum())
+        cols = np.tile(cols[support], pinv.shape[0])
+        operator = sparse.csr_matrix((pinv.ravel(), (rows, cols)), shape=(pinv.shape[0], mask_flat.sum()))
+
+    else:
+        raise Exception("roi type not known {}".format(roi_type))
+    return operator
+
+
+def get_stacked_operator(roi_infos, ref_img, mask_data, cache_dir=None):
+    """
+    stacks the parcel operators of all parcellations in roi_infos = {parc: (roi_file, roi_type)}
+    returns the stacked sparse operator and a dict {parc: slice} with the rows of each parcellation
+    """
+    operators, slices = [], {}
+    n_rows = 0
+    for parc, (roi_file, roi_type) in roi_infos.items():
+        operator = get_parcel_operator(roi_file, roi_type, ref_img, mask_data, cache_dir)
+        slices[parc] = slice(n_rows, n_rows + operator.shape[0])
+        n_rows += operator.shape[0]
+        operators.append(operator)
+    return sparse.vstack(operators, format="csr"), slices
+
+
+def apply_stacked_operator(operator, slices, masked_data):
+    """
+    extracts time series of all parcellations in one sparse-dense product
+    masked_data: (n_mask_voxels, n_volumes)
+    returns dict {parc: time_series (n_volumes x n_rois)}
+    """
+    signals = operator.dot(masked_data).T
+    return {parc: np.ascontiguousarray(signals[:, sl]) for parc, sl in slices.items()}
+
+
+def get_roi_centroids(roi_file, roi_type):
+    """
+    returns the centroids of the rois in world (mm) coordinates (n_rois x 3), in the order of the masker outputs
+    * labels: mean position of the voxels of each label (labels sorted, background 0 excluded)
+    * maps: mean position weighted by the positive map values
+    """
+    img = image.load_img(roi_file)
+    data = np.asarray(img.dataobj)
+    ijk = np.indices(data.shape[:3]).reshape(3, -1).T
+    if roi_type == "labels":
+        labels_flat = data.ravel()
+        labels = np.unique(labels_flat)
+        labels = labels[labels != 0]
+        voxels = np.flatnonzero(labels_flat)
+        rows = np.searchsorted(labels, labels_flat[voxels])
+        weights = sparse.csr_matrix((np.ones(len(voxels)), (rows, voxels)), shape=(len(labels), len(labels_flat)))
+    elif roi_type == "maps":
+        weights = np.clip(data.reshape(-1, data.shape[-1]).T, 0, None)
+    else:
+        raise Exception("roi type not known {}".format(roi_type))
+    centroids_ijk = np.asarray(weights.dot(ijk)) / np.asarray(weights.sum(axis=1)).reshape(-1, 1)
+    return nb.affines.apply_affine(img.affine, centroids_ijk)
+
+
+def test_get_roi_centroids():
+    labels = np.zeros((4, 4, 4), dtype=np.int16)
+    labels[:2, 0, 0] = 3
+    labels[3, 3, 3] = 1
+    maps = np.zeros((4, 4, 4, 2))
+    maps[0, 0, 0, 0], maps[2, 0, 0, 0] = 1, 3
+    maps[1, 1, 1, 1] = 1
+    affine = np.diag([2., 2., 2., 1.])
+    with TemporaryDirectory() as tmp_dir:
+        nb.Nifti1Image(labels, affine).to_filename(os.path.join(tmp_dir, "labels.nii.gz"))
+        nb.Nifti1Image(maps, affine).to_filename(os.path.join(tmp_dir, "maps.nii.gz"))
+        centroids = get_roi_centroids(os.path.join(tmp_dir, "labels.nii.gz"), "labels")
+        assert np.allclose(centroids, [[6, 6, 6], [1, 0, 0]])
+        centroids = get_roi_centroids(os.path.join(tmp_dir, "maps.nii.gz"), "maps")
+        assert np.allclose(centroids, [[3, 0, 0], [2, 2, 2]])
+
+
+def test_registry():
+    with TemporaryDirectory() as tmp_dir:
+        labels = np.zeros((4, 4, 4), dtype=np.float32)
+        labels[:2] = 1
+        labels[2:] = 2
+        labels_file = os.path.join(tmp_dir, "labels.nii.gz")
+        nb.Nifti1Image(labels, np.eye(4)).to_filename(labels_file)
+        registry_dir = os.path.join(tmp_dir, "registry")
+        add_to_registry(registry_dir, "test", labels_file, np.array([b"r1", b"r2"]), "labels")
+
+        roi_file, roi_names, roi_type = get_roi_info("test", registry_dir)
+        assert roi_type == "labels"
+        assert roi_names.tolist() == ["r1", "r2"], "roi names not restored"
+        assert np.array_equal(np.asarray(image.load_img(roi_file).dataobj), labels), "labels changed"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='materializes all parcellations into a local atlas registry')
+    parser.add_argument('registry_dir', help='path to save the atlas registry')
+    args = parser.parse_args()
+
+    build_registry(args.registry_dir)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import glob
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# analysis levels that can be benchmarked, in the order they depend on each other
+LEVELS = ["participant_1_sbc_pcc", "group_1_sbc_pcc", "participant_2_conmats", "participant_3_centrality",
+          "group_2_collect_motion"]
+SPIKEREG_THRESH_LIST = [None, 0.5, 1.0]
+# levels whose outputs depend on the precision (see compare_precision)
+PRECISION_LEVELS = ["participant_1_sbc_pcc", "participant_2_conmats", "participant_3_centrality"]
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def _run_level(level, fmriprep_dir, registry_dir, parcs, output_dir, tr, precision="float64"):
+    """
+    runs one analysis level on all sessions (one after the other, as one participant job each)
+    precision: of the participant levels (see conmats._get_masker_pars)
+    returns wall and cpu time, stage times (see instrumentation.get_stage_times) and peak RSS of this process
+    """
+    from utils import get_layout, get_subject_sessions
+    from instrumentation import get_stage_times, get_max_peak_rss_mb
+    layout = get_layout(fmriprep_dir)
+    subjects, subjects_sessions = get_subject_sessions(fmriprep_dir, None, layout=layout)
+    get_stage_times()
+
+    start, start_cpu = time.perf_counter(), time.process_time()
+    if level == "participant_1_sbc_pcc":
+        from sbc import sbc_one_session
+        sbc_dir = os.path.join(output_dir, "sbc", "participant")
+        os.makedirs(sbc_dir, exist_ok=True)
+        for subject, session in subjects_sessions:
+            sbc_one_session(subject, session, fmriprep_dir, sbc_dir, tr, layout=layout, precision=precision)
+    elif level == "group_1_sbc_pcc":
+        from sbc import sbc_group
+        sbc_group(os.path.join(output_dir, "sbc", "participant"), os.path.join(output_dir, "sbc", "group"))
+    elif level == "participant_2_conmats":
+        from conmats import conmats_one_session
+        # the finest labels atlas also with 9P, like yeo17split in run.py
+        labels_parcs = sorted([p for p in parcs if p != "synth_maps"], key=lambda p: int(p[len("synth"):]))
+        conf_parcs = {"36P": parcs, "9P": [labels_parcs[-1]]}
+        for subject, session in subjects_sessions:
+            conmats_one_session(subject, session, fmriprep_dir, os.path.join(output_dir, "conmats", "participant"), tr,
+                                conf_parcs, SPIKEREG_THRESH_LIST, os.path.join(output_dir, "atlas_cache"),
+                                registry_dir=registry_dir, layout=layout,
+                                store_dir=os.path.join(output_dir, "conmats", "store"), precision=precision)
+    elif level == "participant_3_centrality":
+        from centrality import centrality_one_session
+        centrality_dir = os.path.join(output_dir, "centrality", "participant")
+        os.makedirs(centrality_dir, exist_ok=True)
+        for subject, session in subjects_sessions:
+            centrality_one_session(subject, session, fmriprep_dir, centrality_dir, tr, layout=layout,
+                                   precision=precision)
+    elif level == "group_2_collect_motion":
+        from motion import collect_motion
+        collect_motion(subjects_sessions, fmriprep_dir, os.path.join(output_dir, "motion", "group"),
+                       SPIKEREG_THRESH_LIST, layout=layout)
+    else:
+        raise Exception("Level cannot be benchmarked {}".format(level))
+
+    # the stages and jobs reset the peak RSS of the process (see instrumentation.timed), so the peak of the level is
+    # the maximum of their peaks; ru_maxrss (kB on linux) covers levels without jobs
+    peak_rss_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., get_max_peak_rss_mb())
+    return {"wall_time": time.perf_counter() - start, "cpu_time": time.process_time() - start_cpu,
+            "stages": get_stage_times(), "n_sessions": len(subjects_sessions), "peak_rss_mb": peak_rss_mb}
+
+
+def _get_dataset(work_dir, dataset_pars, tr):
+    # synthetic dataset in work_dir, generated once per parameter set
+    from synthetic import make_fmriprep_dataset
+    pars_str = json.dumps(dict(dataset_pars, tr=tr), sort_keys=True)
+    dataset_dir = os.path.join(work_dir, "dataset_" + hashlib.md5(pars_str.encode()).hexdigest()[:10])
+    if not os.path.exists(os.path.join(dataset_dir, "dataset_pars.json")):
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        make_fmriprep_dataset(dataset_dir, tr=tr, **dataset_pars)
+        with open(os.path.join(dataset_dir, "dataset_pars.json"), "w") as fi:
+            fi.write(pars_str)
+    fmriprep_dir = os.path.join(dataset_dir, "fmriprep")
+    registry_dir = os.path.join(dataset_dir, "registry")
+    with open(os.path.join(registry_dir, "registry.json")) as fi:
+        parcs = sorted(json.load(fi))
+    return fmriprep_dir, registry_dir, parcs
+
+
+def _run_in_process(*args):
+    # fresh process per level, so peak RSS and import state are those of a single job
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_level, *args).result()
+
+
+def run_benchmark(work_dir, results_file, levels=LEVELS, dataset_pars=None, tr=2., label=None, precision="float64"):
+    """
+    benchmarks analysis levels on a synthetic fmriprep dataset (see synthetic.make_fmriprep_dataset) and appends one
+    json line per level to results_file with wall and cpu time, time per stage (load, mask, clean, correlate, write,
+    plot; see instrumentation.STAGES), throughput (sessions and volumes per second), peak RSS, the dataset parameters,
+    commit and label, so results can be compared across commits.
+    Each level runs in a fresh process, so peak RSS and import state are those of a single job.
+    The dataset is generated once per parameter set in work_dir; outputs are recomputed on every run.
+    dataset_pars: parameters of make_fmriprep_dataset (e.g. {"n_subjects": 4, "n_vols": 200})
+    precision: of the participant levels (see conmats._get_masker_pars)
+    returns list of result dicts
+    """
+    dataset_pars = dict(dataset_pars or {})
+    fmriprep_dir, registry_dir, parcs = _get_dataset(work_dir, dataset_pars, tr)
+
+    output_dir = os.path.join(work_dir, "output")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+
+    commit = _get_commit()
+    results = []
+    for level in levels:
+        print("*** Benchmarking {} ***".format(level))
+        result = _run_in_process(level, fmriprep_dir, registry_dir, parcs, output_dir, tr, precision)
+        n_vols = dataset_pars.get("n_vols", 200) * result["n_sessions"]
+        result.update({"level": level, "commit": commit, "label": label, "dataset": dataset_pars,
+                       "precision": precision,
+                       "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "sessions_per_s": result["n_sessions"] / result["wall_time"],
+                       "volumes_per_s": n_vols / result["wall_time"]})
+        with open(results_file, "a") as fi:
+            fi.write(json.dumps(result) + "\n")
+        print("{level}: {wall_time:.1f}s wall, {cpu_time:.1f}s cpu, {sessions_per_s:.2f} sessions/s, "
+              "peak RSS {peak_rss_mb:.0f} MB".format(**result))
+        print("  " + ", ".join("{} {:.2f}s".format(k, v) for k, v in sorted(result["stages"].items())))
+        results.append(result)
+    return results
+
+
+def _output_type(out_file):
+    # conmat (r), sbc (fisher z) or centrality map type (gbc, degree, weighteddegree)
+    name = os.path.basename(out_file)
+    if name.startswith("centrality_"):
+        return name.split("_")[1]
+    return "conmat" if name.endswith("_conmat.tsv") else "sbc"
+
+
+def _load_output(out_file):
+    import numpy as np
+    import pandas as pd
+    import nibabel as nb
+    if out_file.endswith(".tsv"):
+        return pd.read_csv(out_file, sep="\t", index_col=0).values
+    return np.asarray(nb.load(out_file).dataobj, dtype=np.float64)
+
+
+def compare_precision(work_dir, dataset_pars=None, tr=2., levels=PRECISION_LEVELS):
+    """
+    runs levels with float64 and float32 precision on a synthetic dataset (see run_benchmark) and compares the
+    outputs (conmats, sbc maps, centrality maps) of both runs
+    returns data frame with one row per output type: number of files, max. and mean absolute difference, max.
+    absolute float64 value, and the wall time and peak RSS of both precisions
+    """
+    import numpy as np
+    import pandas as pd
+    dataset_pars = dict(dataset_pars or {})
+    fmriprep_dir, registry_dir, parcs = _get_dataset(work_dir, dataset_pars, tr)
+    runs = {}
+    for precision in ["float64", "float32"]:
+        output_dir = os.path.join(work_dir, "output_" + precision)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.makedirs(output_dir)
+        for level in levels:
+            print("*** Running {} with {} ***".format(level, precision))
+            runs[level, precision] = _run_in_process(level, fmriprep_dir, registry_dir, parcs, output_dir, tr,
+                                                     precision)
+
+    out_dir_64 = os.path.join(work_dir, "output_float64")
+    out_files = sorted(glob.glob(os.path.join(out_dir_64, "**", "*_conmat.tsv"), recursive=True) +
+                       glob.glob(os.path.join(out_dir_64, "**", "*.nii.gz"), recursive=True))
+    diffs = []
+    for out_file in out_files:
+        x64 = _load_output(out_file)
+        x32 = _load_output(out_file.replace(out_dir_64, os.path.join(work_dir, "output_float32"), 1))
+        finite = np.isfinite(x64) & np.isfinite(x32)
+        diffs.append({"output": _output_type(out_file), "max_abs_diff": np.abs(x64 - x32)[finite].max(),
+                      "mean_abs_diff": np.abs(x64 - x32)[finite].mean(), "max_abs_value": np.abs(x64[finite]).max(),
+                      "n_nonfinite_diff": int((np.isfinite(x64) != np.isfinite(x32)).sum())})
+    comparison = pd.DataFrame(diffs).groupby("output").agg(
+        n_files=("max_abs_diff", "size"), max_abs_diff=("max_abs_diff", "max"),
+        mean_abs_diff=("mean_abs_diff", "mean"), max_abs_value=("max_abs_value", "max"),
+        n_nonfinite_diff=("n_nonfinite_diff", "sum"))
+
+    level_of_output = {"conmat": "participant_2_conmats", "sbc": "participant_1_sbc_pcc"}
+    for precision in ["float64", "float32"]:
+        for metric in ["wall_time", "peak_rss_mb"]:
+            comparison["{}_{}".format(metric, precision)] = [
+                runs[level_of_output.get(o, "participant_3_centrality"), precision][metric]
+                for o in comparison.index]
+    return comparison
+
+
+def test_run_benchmark():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as work_dir:
+        results_file = os.path.join(work_dir, "results.jsonl")
+        dataset_pars = {"n_subjects": 2, "n_sessions": 1, "n_vols": 40, "shape": (10, 12, 10), "voxel_size": 10.,
+                        "n_parcels": (8,)}
+        run_benchmark(work_dir, results_file, ["participant_2_conmats", "group_2_collect_motion"], dataset_pars,
+                      label="test")
+        # second run reuses the dataset, but recomputes the outputs
+        run_benchmark(work_dir, results_file, ["participant_2_conmats"], dataset_pars)
+        with open(results_file) as fi:
+            results = [json.loads(line) for line in fi]
+        assert [r["level"] for r in results] == ["participant_2_conmats", "group_2_collect_motion",
+                                                 "participant_2_conmats"]
+        assert {"load", "mask", "clean", "correlate", "write", "plot"} <= set(results[0]["stages"])
+        assert results[2]["stages"] and results[0]["peak_rss_mb"] > 0
+
+
+def test_compare_precision():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as work_dir:
+        dataset_pars = {"n_subjects": 1, "n_sessions": 1, "n_vols": 150, "shape": (12, 14, 12), "voxel_size": 8.,
+                        "n_parcels": (10,), "bold_dtype": "int16"}
+        comparison = compare_precision(work_dir, dataset_pars, levels=["participant_1_sbc_pcc",
+                                                                       "participant_2_conmats"])
+        assert sorted(comparison.index) == ["conmat", "sbc"]
+        assert (comparison.n_nonfinite_diff == 0).all()
+        assert comparison.loc["conmat", "max_abs_diff"] < 1e-3
+        assert comparison.loc["sbc", "max_abs_diff"] < 1e-3
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='benchmarks analysis levels on a synthetic fmriprep dataset')
+    parser.add_argument('work_dir', help='directory for the synthetic dataset and the outputs')
+    parser.add_argument('--results_file', help='json lines file the results are appended to',
+                        default="benchmark_results.jsonl")
+    parser.add_argument('--levels', help='analysis levels to benchmark', nargs="+", choices=LEVELS, default=LEVELS)
+    parser.add_argument('--label', help='label of this run in the results file (e.g., host or branch)')
+    parser.add_argument('--precision', help='precision of the participant levels', default='float64',
+                        choices=['float64', 'float32'])
+    parser.add_argument('--compare_precision', help='instead of benchmarking, compare the outputs of float32 and '
+                                                    'float64 runs (and print the differences)', action='store_true')
+    parser.add_argument('--n_subjects', type=int, default=4)
+    parser.add_argument('--n_sessions', type=int, default=2)
+    parser.add_argument('--n_vols', type=int, default=200)
+    parser.add_argument('--shape', help='grid size in voxels', type=int, nargs=3, default=[32, 38, 32])
+    parser.add_argument('--voxel_size', help='voxel size in mm', type=float, default=4.)
+    parser.add_argument('--n_parcels', help='number of parcels of the synthetic labels atlases', type=int, nargs="+",
+                        default=[100, 400])
+    parser.add_argument('--bold_dtype', help='stored dtype of the synthetic bold data', default='float32',
+                        choices=['float32', 'int16'])
+    args = parser.parse_args()
+
+    dataset_pars = {"n_subjects": args.n_subjects, "n_sessions": args.n_sessions, "n_vols": args.n_vols,
+                    "shape": tuple(args.shape), "voxel_size": args.voxel_size, "n_parcels": tuple(args.n_parcels),
+                    "bold_dtype": args.bold_dtype}
+    if args.compare_precision:
+        print(compare_precision(os.path.abspath(args.work_dir), dataset_pars).to_string())
+    else:
+        run_benchmark(os.path.abspath(args.work_dir), os.path.abspath(args.results_file), args.levels, dataset_pars,
+                      label=args.label, precision=args.precision)
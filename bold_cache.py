@@ -0,0 +1,178 @@
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+import nibabel as nb
+
+
+def _get_cached_path(rs_file, cache_dir, dtype=None):
+    st = os.stat(rs_file)
+    key = hashlib.sha1("{}_{}_{}_{}".format(os.path.abspath(rs_file), st.st_size, st.st_mtime, dtype).encode())
+    stub = os.path.basename(rs_file).split(".")[0]
+    return os.path.join(cache_dir, "{}_{}.nii".format(stub, key.hexdigest()[:12]))
+
+
+def _convert(rs_file, cached_file, dtype=None):
+    img = nb.load(rs_file)
+    tmp_file = cached_file + ".tmp.nii"
+    if dtype:
+        # scaled directly into dtype, without a float64 copy
+        header = img.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(1, 0)
+        nb.Nifti1Image(img.get_fdata(dtype=dtype), img.affine, header).to_filename(tmp_file)
+    else:
+        # stored dtype and scaling are kept (e.g., scaled int16 stays int16), only the compression is dropped
+        header = img.header.copy()
+        header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+        header.set_data_offset(img.dataobj.offset)
+        with open(tmp_file, "wb") as fi:
+            header.write_to(fi)
+            header.data_to_fileobj(img.dataobj.get_unscaled(), fi, rescale=False)
+    os.replace(tmp_file, cached_file)
+
+
+def get_cached_bold(rs_file, cache_dir, dtype=None):
+    """
+    returns the path of an uncompressed copy of rs_file (a .nii.gz) in cache_dir, which nibabel (and therefore the
+    nilearn maskers) read through np.memmap. Jobs that use the same file then share the page-cached data and do not
+    gunzip it again.
+    * dtype: e.g. "float32" to store the data as float32; by default the stored dtype and scaling are kept
+    * the copy is created on first use; a lock file makes sure only one process (e.g., a pool worker or the
+      prefetch thread) converts a file, while others wait for it. The lock is released by the OS if the converting
+      process dies, so a crashed conversion does not block later jobs.
+    * cache entries are keyed by path, size and mtime of rs_file, so changed inputs get a new entry
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_file = _get_cached_path(rs_file, cache_dir, dtype)
+    if not os.path.exists(cached_file):
+        with open(cached_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # someone else may have converted the file while we waited
+            if not os.path.exists(cached_file):
+                _convert(rs_file, cached_file, dtype)
+    return cached_file
+
+
+def remove_cached_bold(rs_file, cache_dir, dtype=None):
+    """
+    removes the cached copy of rs_file (see get_cached_bold) and its lock file
+    """
+    cached_file = _get_cached_path(rs_file, cache_dir, dtype)
+    for f in [cached_file, cached_file + ".lock"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def make_prefetch(rs_files, cache_dir, dtype=None, lookahead=2):
+    """
+    prepares a background thread that converts rs_files (in order) into the cache (see get_cached_bold), so the
+    inputs of the next sessions are decompressed while the current ones are computed.
+    returns functions
+    * start(): starts the thread. With a fork-based process pool, call it after the workers are forked (see
+      scheduler.run_jobs), so no worker is forked while the thread is in gzip or nibabel.
+    * done(rs_file): the jobs of rs_file are finished; its cached copy is removed
+    * stop(): stops the thread after the current file
+    At most lookahead files are converted ahead of the finished ones, so the cache holds at most lookahead
+    uncompressed files (plus those the jobs convert themselves).
+    """
+    cond = threading.Condition()
+    prefetched, finished = set(), set()
+    stopped = []
+
+    def prefetch():
+        for rs_file in rs_files:
+            with cond:
+                cond.wait_for(lambda: stopped or len(prefetched - finished) < lookahead)
+                if stopped:
+                    break
+                if rs_file in finished:
+                    continue
+                prefetched.add(rs_file)
+            try:
+                get_cached_bold(rs_file, cache_dir, dtype)
+            except Exception as e:
+                print("Prefetching {} failed: {}".format(rs_file, e))
+            with cond:
+                # the jobs finished during the conversion
+                if rs_file in finished:
+                    remove_cached_bold(rs_file, cache_dir, dtype)
+
+    def start():
+        threading.Thread(target=prefetch, daemon=True).start()
+
+    def done(rs_file):
+        with cond:
+            finished.add(rs_file)
+            remove_cached_bold(rs_file, cache_dir, dtype)
+            cond.notify_all()
+
+    def stop():
+        with cond:
+            stopped.append(True)
+            cond.notify_all()
+
+    return start, done, stop
+
+
+def test_get_cached_bold():
+    import time
+    from glob import glob
+    from tempfile import TemporaryDirectory
+    rng = np.random.RandomState(0)
+    with TemporaryDirectory() as tmp_dir:
+        data = (rng.rand(4, 5, 6, 10) * 1000).astype(np.int16)
+        rs_files = [os.path.join(tmp_dir, "rs{}.nii.gz".format(i)) for i in range(3)]
+        for rs_file in rs_files:
+            nb.Nifti1Image(data, np.eye(4)).to_filename(rs_file)
+        cache_dir = os.path.join(tmp_dir, "cache")
+
+        def cached_files():
+            return sorted(glob(os.path.join(cache_dir, "*.nii")))
+
+        def wait_for(n_files):
+            for _ in range(500):
+                if len(cached_files()) == n_files:
+                    break
+                time.sleep(0.01)
+            time.sleep(0.05)
+            assert len(cached_files()) == n_files, "prefetch did not convert the next files"
+
+        start, done, stop = make_prefetch(rs_files, cache_dir, "float32", lookahead=2)
+        start()
+        wait_for(2)
+        assert cached_files() == [_get_cached_path(f, cache_dir, "float32") for f in rs_files[:2]]
+        done(rs_files[0])
+        wait_for(2)
+        assert cached_files() == [_get_cached_path(f, cache_dir, "float32") for f in rs_files[1:]]
+        done(rs_files[1])
+        done(rs_files[2])
+        stop()
+        assert cached_files() == [] and os.listdir(cache_dir) == [], "finished files not removed"
+
+        for dtype in [None, "float32"]:
+            cached_file = get_cached_bold(rs_files[0], cache_dir, dtype)
+            assert cached_file.endswith(".nii")
+            img = nb.load(cached_file)
+            assert isinstance(img.dataobj.get_unscaled(), np.memmap), "cached file not memory-mapped"
+            assert np.array_equal(img.get_fdata(), data), "cached data differs"
+            assert img.get_data_dtype() == (dtype or np.int16)
+        assert get_cached_bold(rs_files[0], cache_dir, "float32") == cached_file
+
+        # scaled int16 (as written by many pipelines) is cached as scaled int16, not as float64
+        scaled_file = os.path.join(tmp_dir, "scaled.nii.gz")
+        scaled_img = nb.Nifti1Image(data, np.eye(4))
+        scaled_img.header.set_slope_inter(0.0015, 10.)
+        scaled_img.to_filename(scaled_file)
+        scaled_data = nb.load(scaled_file).get_fdata()
+        for dtype in [None, "float32"]:
+            img = nb.load(get_cached_bold(scaled_file, cache_dir, dtype))
+            assert img.get_data_dtype() == (dtype or np.int16)
+            assert np.allclose(img.get_fdata(), scaled_data, rtol=1e-6), "scaled data differs"
+        assert os.path.getsize(get_cached_bold(scaled_file, cache_dir)) < data.size * 2 + 1024, "cache not int16"
+
+        # lock file left behind by a killed converter does not block
+        cached_file = _get_cached_path(rs_files[1], cache_dir)
+        open(cached_file + ".lock", "w").close()
+        assert get_cached_bold(rs_files[1], cache_dir) == cached_file and os.path.exists(cached_file)
@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from nilearn import input_data, image
+from utils import get_files, get_confounds
+from bold_cache import get_cached_bold
+from manifest import load_manifest, is_up_to_date, record_outputs, atomic_output
+from instrumentation import timed, job
+
+# recorded in the output manifest; bump when the centrality computation changes, so existing outputs are recomputed
+MANIFEST_VERSION = 1
+
+
+def _get_centrality_out_files(output_dir, out_stub, thresholds):
+    out_files = {"gbc": os.path.join(output_dir, "centrality_gbc_{}.nii.gz".format(out_stub))}
+    for thr in thresholds:
+        out_files["degree_{}".format(thr)] = os.path.join(
+            output_dir, "centrality_degree_thrsh{}_{}.nii.gz".format(thr, out_stub))
+        out_files["weighted_degree_{}".format(thr)] = os.path.join(
+            output_dir, "centrality_weighteddegree_thrsh{}_{}.nii.gz".format(thr, out_stub))
+    out_files["report"] = os.path.join(output_dir, "centrality_info_{}.txt".format(out_stub))
+    return out_files
+
+
+def blocked_centrality(time_series, thresholds=(0.25,), block_size=512):
+    """
+    voxelwise global brain connectivity (GBC; mean correlation with all other voxels) and degree centrality (number
+    of voxels with r > threshold; weighted: sum of those r; thresholds >= 0) from standardized time series
+    (n_vols x n_voxels).
+    The correlations are computed as float32 matrix products of block_size voxels against all voxels, so only one
+    (block_size x n_voxels) block of the voxel x voxel matrix is in memory at a time.
+    returns dict {"gbc": ..., "degree_<thr>": ..., "weighted_degree_<thr>": ...} with one value per voxel
+    """
+    if any(thr < 0 for thr in thresholds):
+        raise Exception("Degree centrality thresholds must be >= 0 {}".format(list(thresholds)))
+    x = np.asarray(time_series, dtype=np.float32)
+    n_vols, n_voxels = x.shape
+    x_scaled = x / np.float32(n_vols)
+    maps = {"gbc": np.zeros(n_voxels)}
+    for thr in thresholds:
+        maps["degree_{}".format(thr)] = np.zeros(n_voxels)
+        maps["weighted_degree_{}".format(thr)] = np.zeros(n_voxels)
+
+    for start in range(0, n_voxels, block_size):
+        stop = min(start + block_size, n_voxels)
+        block = x_scaled[:, start:stop].T.dot(x)
+        # exclude each voxel's correlation with itself
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+        maps["gbc"][start:stop] = block.sum(axis=1, dtype=np.float64) / (n_voxels - 1)
+        # ascending thresholds: sub-threshold values are zeroed in place, so no second block is allocated
+        for thr in sorted(thresholds):
+            block[block <= thr] = 0
+            maps["degree_{}".format(thr)][start:stop] = np.count_nonzero(block, axis=1)
+            maps["weighted_degree_{}".format(thr)][start:stop] = block.sum(axis=1, dtype=np.float64)
+    return maps
+
+
+@job("centrality", subject="subject", session="session")
+def centrality_one_session(subject, session, fmriprep_dir, output_dir, tr, thresholds=(0.25,), block_size=512,
+                           layout=None, bold_cache_pars=None, precision="float64"):
+    """
+    calculates voxelwise GBC and degree centrality maps (see blocked_centrality) from the whole-brain time series,
+    cleaned like in sbc.sbc_one_session (36P, band-pass, 6mm smoothing)
+    thresholds: correlation thresholds for degree centrality
+    block_size: number of voxels per block; memory for the correlations is block_size * n_voxels * 4 bytes
+    layout: fmriprep layout index (see utils.get_layout)
+    bold_cache_pars: read the rs data from an uncompressed cache (see sbc.sbc_one_session)
+    precision: "float32" also loads and cleans the rs data in float32 (the correlations are float32 either way)
+    Outputs are skipped if the manifest of output_dir (see manifest.py) lists them as computed from the same input
+    files and parameters.
+    """
+    with timed("discover"):
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session, layout)
+    out_stub = "{}_{}".format(subject, session)
+    out_files = _get_centrality_out_files(output_dir, out_stub, thresholds)
+    lp_freq = 0.1
+    hp_freq = 0.01
+    masker_pars = {"mask_img": brainmask_file, "detrend": True, "standardize": True, "low_pass": lp_freq,
+                   "high_pass": hp_freq, "t_r": tr}
+    if precision != "float64":
+        masker_pars["dtype"] = precision
+    inputs = [rs_file, confounds_file, brainmask_file]
+    params = {"masker_pars": masker_pars, "smoothing_fwhm": 6}
+    with timed("discover"):
+        manifest, existing = load_manifest(output_dir)
+
+    if not is_up_to_date(manifest, existing, out_stub, out_files.values(), inputs, params, MANIFEST_VERSION):
+        print("*** Running centrality for {} {} ***".format(subject, session))
+        confounds, outlier_stats = get_confounds(confounds_file)
+        with timed("load"):
+            rs_img = image.load_img(get_cached_bold(rs_file, **bold_cache_pars) if bold_cache_pars else rs_file)
+
+        with timed("mask_clean"):
+            brain_masker = input_data.NiftiMasker(smoothing_fwhm=6, **masker_pars)
+            brain_time_series = brain_masker.fit_transform(rs_img, confounds=confounds.values)
+            brain_time_series = brain_time_series.astype(np.float32, copy=False)
+
+        with timed("correlate"):
+            maps = blocked_centrality(brain_time_series, thresholds, block_size)
+        with timed("write"):
+            for k, values in maps.items():
+                with atomic_output(out_files[k]) as tmp_file:
+                    brain_masker.inverse_transform(values.astype(np.float32)).to_filename(tmp_file)
+
+        report = "n_voxels: {}\n".format(brain_time_series.shape[1])
+        report += "thresholds: {}\n".format(list(thresholds))
+        report += "Confounds:\n"
+        report += "\n".join(confounds.columns) + "\n\n"
+        report += "lp_freq: {}\n".format(lp_freq)
+        report += "hp_freq: {}\n".format(hp_freq)
+        report += "confounds_file: {}\n".format(confounds_file)
+        report += "brainmask_file: {}\n".format(brainmask_file)
+        report += "rs_file: {}\n".format(rs_file)
+        with atomic_output(out_files["report"]) as tmp_file:
+            with open(tmp_file, "w") as fi:
+                fi.write(report)
+        record_outputs(output_dir, out_stub, out_files.values(), inputs, params, MANIFEST_VERSION)
+    else:
+        print("*** Centrality for {} {} already computed. Do nothing. ***".format(subject, session))
+
+
+def test_blocked_centrality():
+    rng = np.random.RandomState(0)
+    ts = rng.randn(50, 30)
+    ts[:, 10:20] += 2 * ts[:, [0]]
+    ts = (ts - ts.mean(0)) / ts.std(0)
+    corr = np.corrcoef(ts.T)
+    np.fill_diagonal(corr, 0)
+    maps = blocked_centrality(ts, thresholds=[0.2, 0.5], block_size=7)
+    assert np.allclose(maps["gbc"], corr.sum(1) / 29, atol=1e-5)
+    for thr in [0.2, 0.5]:
+        assert np.array_equal(maps["degree_{}".format(thr)], (corr > thr).sum(1))
+        assert np.allclose(maps["weighted_degree_{}".format(thr)], np.where(corr > thr, corr, 0).sum(1), atol=1e-4)
+
+
+def test_centrality_one_session():
+    from tempfile import TemporaryDirectory
+    from conmats import _make_test_fmriprep_dir
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        output_dir = os.path.join(tmp_dir, "out")
+        os.makedirs(output_dir)
+        _make_test_fmriprep_dir(fmriprep_dir, "1", "1")
+        centrality_one_session("1", "1", fmriprep_dir, output_dir, 2., [0.3], block_size=100)
+        out_files = _get_centrality_out_files(output_dir, "1_1", [0.3])
+        assert all(map(os.path.exists, out_files.values())), "centrality output missing"
@@ -0,0 +1,103 @@
+import os
+import numpy as np
+from scipy import linalg
+from nilearn import signal
+from utils import get_confounds
+
+
+def _zscore(x):
+    # mean and std are accumulated in float64, also for float32 signals
+    x = x - x.mean(axis=0, dtype=np.float64).astype(x.dtype)
+    std = x.std(axis=0, dtype=np.float64)
+    std[std < np.finfo(np.float64).eps] = 1.
+    return x / std.astype(x.dtype)
+
+
+def _detrend_filter(x, tr, low_pass, high_pass):
+    # same detrending and butterworth filtering as nilearn.signal.clean
+    return signal.clean(x, detrend=True, standardize=False, low_pass=low_pass, high_pass=high_pass, t_r=tr)
+
+
+def _orth_basis(x):
+    # same rank truncation as nilearn.signal.clean
+    if x.shape[1] == 0:
+        return np.zeros((x.shape[0], 0))
+    Q, R, _ = linalg.qr(x, mode="economic", pivoting=True)
+    return Q[:, np.abs(np.diag(R)) > np.finfo(np.float64).eps * 100.]
+
+
+def get_variant_projections(base_confounds, spike_confounds, tr, low_pass=0.1, high_pass=0.01):
+    """
+    prepares the confound regression of several variants that share the same base confounds (e.g., 36P) and only
+    differ in their spike regressors
+    base_confounds: (n_vols x n_base) array or df
+    spike_confounds: dict {variant: (n_vols x n_spikes) one-hot array or df}; n_spikes can be 0
+    returns
+    * q_base: orthonormal basis of the (detrended, filtered, standardized) base confounds
+    * q_spikes: dict {variant: orthonormal basis of the spike regressors after removing q_base}
+    The base block is filtered and QR-factorized once. The spike regressors are one-hot columns, so the filtered
+    column of each outlier volume is computed once and shared by all variants.
+    """
+    base_confounds = np.asarray(base_confounds, dtype=np.float64)
+    n_vols = base_confounds.shape[0]
+    q_base = _orth_basis(_zscore(_detrend_filter(base_confounds, tr, low_pass, high_pass)))
+
+    spike_vols = {k: np.asarray(v).argmax(axis=0) for k, v in spike_confounds.items()}
+    all_vols = np.unique(np.concatenate([np.zeros(0, dtype=int)] + list(spike_vols.values())))
+    if len(all_vols):
+        spikes = _zscore(_detrend_filter(np.eye(n_vols)[:, all_vols], tr, low_pass, high_pass))
+        # remove the part of the spike regressors that is explained by the base confounds
+        spikes -= q_base.dot(q_base.T.dot(spikes))
+
+    q_spikes = {}
+    for k, vols in spike_vols.items():
+        q_spikes[k] = _orth_basis(spikes[:, np.searchsorted(all_vols, vols)]) if len(vols) else np.zeros((n_vols, 0))
+    return q_base, q_spikes
+
+
+def clean_with_projections(raw_signals, q_base, q_spikes, tr, low_pass=0.1, high_pass=0.01):
+    """
+    cleans raw parcel time series for all variants prepared by get_variant_projections.
+    The signals are detrended and filtered once and the base confounds are removed once; each variant then only
+    needs a low-rank update for its spike regressors.
+    Gives the same result as the nilearn maskers in conmats.extract_mat (detrend, standardize, band-pass, confounds)
+    float32 raw_signals are cleaned in float32 (the confound bases are computed in float64 and cast), all other
+    dtypes in float64.
+    returns dict {variant: cleaned time series}
+    """
+    raw_signals = np.asarray(raw_signals)
+    dtype = np.float32 if raw_signals.dtype == np.float32 else np.float64
+    # the mean is removed first (it is removed by the detrending anyway): nilearn adds it back after filtering, which
+    # would cost float32 signals the precision of the (small) residuals
+    raw_signals = raw_signals - raw_signals.mean(axis=0, dtype=np.float64).astype(dtype)
+    filtered = _detrend_filter(raw_signals, tr, low_pass, high_pass)
+    q_base = q_base.astype(dtype, copy=False)
+    residuals = filtered - q_base.dot(q_base.T.dot(filtered))
+    cleaned = {}
+    for k, q in q_spikes.items():
+        q = q.astype(dtype, copy=False)
+        cleaned[k] = _zscore(residuals - q.dot(q.T.dot(residuals)))
+    return cleaned
+
+
+def test_clean_with_projections():
+    confounds_file = os.path.join("test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv")
+    rng = np.random.RandomState(0)
+    raw_signals = 100 + rng.randn(225, 5)
+    tr = 2.
+    for conf in ["36P", "9P"]:
+        base_confounds, _ = get_confounds(confounds_file, conf)
+        all_confounds = {thr: get_confounds(confounds_file, conf, thr)[0] for thr in [None, 0.4, 0.3]}
+        spike_confounds = {thr: c.iloc[:, base_confounds.shape[1]:] for thr, c in all_confounds.items()}
+
+        q_base, q_spikes = get_variant_projections(base_confounds, spike_confounds, tr)
+        cleaned = clean_with_projections(raw_signals, q_base, q_spikes, tr)
+        for thr, confounds in all_confounds.items():
+            expected = signal.clean(raw_signals, detrend=True, standardize=True, confounds=confounds.values,
+                                    low_pass=0.1, high_pass=0.01, t_r=tr)
+            assert np.allclose(cleaned[thr], expected), "batched cleaning differs from nilearn for {}".format(thr)
+
+        cleaned32 = clean_with_projections(raw_signals.astype(np.float32), q_base, q_spikes, tr)
+        for thr in all_confounds:
+            assert cleaned32[thr].dtype == np.float32
+            assert np.abs(cleaned32[thr] - cleaned[thr]).max() < 1e-3, "float32 cleaning differs for {}".format(thr)
@@ -0,0 +1,228 @@
+import os
+import fcntl
+import numpy as np
+import pandas as pd
+
+EDGES_DTYPE = np.float32
+META_COLS = ["row", "subject", "session", "conf", "spikereg", "censor", "kind", "n_tr", "n_outliers"]
+VARIANT_COLS = ["conf", "spikereg", "censor", "kind"]
+
+
+def _get_store_files(store_dir, parc):
+    parc_dir = os.path.join(store_dir, "parc-{}".format(parc))
+    return parc_dir, {"edges": os.path.join(parc_dir, "edges.dat"),
+                      "meta": os.path.join(parc_dir, "meta.tsv"),
+                      "rois": os.path.join(parc_dir, "rois.tsv"),
+                      "lock": os.path.join(parc_dir, ".lock")}
+
+
+def matrix_to_edges(conmat):
+    """
+    returns upper triangle (without diagonal) of a symmetrical matrix as vector
+    """
+    return np.asarray(conmat)[np.triu_indices(len(conmat), 1)]
+
+
+def edges_to_matrix(edges, diagonal=0):
+    """
+    inverse of matrix_to_edges; edges can be 1D (one matrix) or 2D (n_matrices x n_edges)
+    """
+    edges = np.asarray(edges)
+    n_rois = int(round((1 + np.sqrt(1 + 8 * edges.shape[-1])) / 2))
+    mats = np.full(edges.shape[:-1] + (n_rois, n_rois), diagonal, dtype=edges.dtype)
+    iu = np.triu_indices(n_rois, 1)
+    mats[..., iu[0], iu[1]] = edges
+    mats[..., iu[1], iu[0]] = edges
+    return mats
+
+
+def append_conmat(store_dir, parc, roi_names, conmat, subject, session, conf, spikereg, outlier_stats=None,
+                  censor=False, kind="correlation"):
+    """
+    appends one connectivity matrix to the store of parc in store_dir (e.g., conmats/store/parc-yeo17), which holds
+    * edges.dat: upper-triangle edge vectors (float32), one row per matrix; memory-mappable. The diagonal is not
+      stored, so for the covariance and tangent kinds the (co)variances of the rois with themselves are only in the
+      *_conmat.tsv files (tangent: in neither)
+    * meta.tsv: one line per matrix with row, subject, session, conf, spikereg, censor, kind (connectivity kind, see
+      connectivity.KINDS), n_tr, n_outliers (outlier volumes; censored volumes if censor, so n_tr - n_outliers
+      volumes are retained)
+    * rois.tsv: roi names
+    Appends are serialized with a lock file, so parallel jobs can write to the same store. A matrix that is already
+    the latest one of its session and variant (same edges and outlier counts, e.g. after a forced rerun) is not
+    appended again. Matrices that are appended again with other values (e.g., after recomputing) replace earlier ones
+    when loading; compact_store removes the replaced rows.
+    """
+    parc_dir, store_files = _get_store_files(store_dir, parc)
+    os.makedirs(parc_dir, exist_ok=True)
+    edges = matrix_to_edges(conmat).astype(EDGES_DTYPE)
+    row_bytes = edges.nbytes
+
+    if outlier_stats is not None:
+        # censored variants pass the censor stats (see utils.get_censor_mask): n_outliers are the censored volumes
+        flag = "censored" if censor else "outlier"
+        n_tr = int(outlier_stats.n_tr.sum())
+        n_outliers = int(outlier_stats.loc[outlier_stats[flag] == True, "n_tr"].sum())
+    else:
+        n_tr, n_outliers = np.nan, np.nan
+
+    with open(store_files["lock"], "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(store_files["rois"]):
+            n_rois = len(pd.read_csv(store_files["rois"], sep="\t"))
+            if n_rois != len(conmat):
+                raise Exception("Store of {} has {} rois, matrix has {}".format(parc, n_rois, len(conmat)))
+        else:
+            pd.DataFrame({"roi": roi_names}).to_csv(store_files["rois"], sep="\t", index=False)
+
+        if os.path.exists(store_files["meta"]):
+            meta = load_store_meta(store_dir, parc)
+            latest = meta[(meta.subject == subject) & (meta.session == session) & (meta.conf == conf) &
+                          (meta.spikereg == str(spikereg)) & (meta.censor == censor) & (meta.kind == kind)]
+            if len(latest) and np.allclose(latest[["n_tr", "n_outliers"]].values[0].astype(float), [n_tr, n_outliers],
+                                           equal_nan=True):
+                with open(store_files["edges"], "rb") as fi:
+                    fi.seek(int(latest.row.iloc[0]) * row_bytes)
+                    if fi.read(row_bytes) == edges.tobytes():
+                        return
+
+        with open(store_files["edges"], "ab") as fi:
+            # drop a partially written row of a crashed job
+            row, rest = divmod(fi.seek(0, os.SEEK_END), row_bytes)
+            if rest:
+                fi.truncate(row * row_bytes)
+            fi.write(edges.tobytes())
+
+        meta = pd.DataFrame([[row, subject, session, conf, str(spikereg), censor, kind, n_tr, n_outliers]],
+                            columns=META_COLS)
+        meta.to_csv(store_files["meta"], sep="\t", index=False, mode="a",
+                    header=not os.path.exists(store_files["meta"]))
+
+
+def load_store_meta(store_dir, parc):
+    """
+    returns the meta data of all matrices in the store of parc (latest entry per subject/session and variant)
+    """
+    _, store_files = _get_store_files(store_dir, parc)
+    meta = pd.read_csv(store_files["meta"], sep="\t", dtype={"subject": str, "session": str, "spikereg": str})
+    # pandas reads the "None" of runs without spike regression as NaN
+    meta["spikereg"] = meta.spikereg.fillna("None")
+    meta = meta.drop_duplicates(["subject", "session"] + VARIANT_COLS, keep="last")
+    return meta.sort_values(["subject", "session"] + VARIANT_COLS).reset_index(drop=True)
+
+
+def get_stored_keys(store_dir, parc):
+    """
+    returns the set of (subject, session, conf, spikereg, censor, kind) of the matrices in the store of parc
+    (spikereg as string, as in meta.tsv); empty if the store does not exist
+    """
+    _, store_files = _get_store_files(store_dir, parc)
+    if not os.path.exists(store_files["meta"]):
+        return set()
+    meta = load_store_meta(store_dir, parc)
+    return set(map(tuple, meta[["subject", "session"] + VARIANT_COLS].values.tolist()))
+
+
+def load_connectomes(store_dir, parc, conf, spikereg, subjects=None, censor=False, kind="correlation"):
+    """
+    returns the memory-mapped edge array of the store (n_rows x n_edges) and the meta data (row, subject, session,
+    outlier counts) of all sessions of one parc/conf/spikereg/kind variant as data frame; meta.row are the rows of
+    these sessions in the edge array.
+    No per-file parsing, and nothing is read until rows are indexed, so callers can read the rows in chunks
+    (e.g., edges[meta.row.values[:100]]).
+    subjects: list of subjects to restrict to
+    """
+    _, store_files = _get_store_files(store_dir, parc)
+    meta = load_store_meta(store_dir, parc)
+    n_rois = len(pd.read_csv(store_files["rois"], sep="\t"))
+    n_edges = n_rois * (n_rois - 1) // 2
+
+    meta = meta[(meta.conf == conf) & (meta.spikereg == str(spikereg)) & (meta.censor == censor) &
+                (meta.kind == kind)]
+    if subjects is not None:
+        meta = meta[meta.subject.isin(subjects)]
+    meta = meta.reset_index(drop=True)
+
+    n_rows = os.path.getsize(store_files["edges"]) // (n_edges * np.dtype(EDGES_DTYPE).itemsize)
+    edges = np.memmap(store_files["edges"], dtype=EDGES_DTYPE, mode="r", shape=(n_rows, n_edges))
+    return edges, meta
+
+
+def compact_store(store_dir, parc, chunk_size=1000):
+    """
+    removes the rows of the store of parc that were replaced by later appends (see append_conmat): the latest rows
+    are copied (chunk_size rows at a time) to new edges and meta files, which then replace the old ones.
+    Holds the lock of the store, so no job can append in the meantime.
+    returns the number of removed rows
+    """
+    _, store_files = _get_store_files(store_dir, parc)
+    with open(store_files["lock"], "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        meta = load_store_meta(store_dir, parc).sort_values("row").reset_index(drop=True)
+        n_rois = len(pd.read_csv(store_files["rois"], sep="\t"))
+        n_edges = n_rois * (n_rois - 1) // 2
+        n_rows = os.path.getsize(store_files["edges"]) // (n_edges * np.dtype(EDGES_DTYPE).itemsize)
+        if len(meta) == n_rows:
+            return 0
+
+        edges = np.memmap(store_files["edges"], dtype=EDGES_DTYPE, mode="r", shape=(n_rows, n_edges))
+        tmp_files = {k: store_files[k] + ".tmp" for k in ["edges", "meta"]}
+        with open(tmp_files["edges"], "wb") as fi:
+            for start in range(0, len(meta), chunk_size):
+                fi.write(np.ascontiguousarray(edges[meta.row.values[start:start + chunk_size]]).tobytes())
+        del edges
+        meta["row"] = np.arange(len(meta))
+        meta[META_COLS].to_csv(tmp_files["meta"], sep="\t", index=False)
+        os.replace(tmp_files["edges"], store_files["edges"])
+        os.replace(tmp_files["meta"], store_files["meta"])
+    return n_rows - len(meta)
+
+
+def load_roi_names(store_dir, parc):
+    _, store_files = _get_store_files(store_dir, parc)
+    return pd.read_csv(store_files["rois"], sep="\t").roi.values
+
+
+def test_conmat_store():
+    from tempfile import TemporaryDirectory
+    rng = np.random.RandomState(0)
+    roi_names = ["r1", "r2", "r3", "r4"]
+    outlier_stats = pd.DataFrame({"outlier": [False, True], "n_tr": [220, 5]})
+    mats = {}
+    with TemporaryDirectory() as store_dir:
+        for subject in ["01", "02", "03"]:
+            for spikereg in [None, 0.5]:
+                m = rng.rand(4, 4)
+                mats[subject, spikereg] = m + m.T
+                append_conmat(store_dir, "test", roi_names, mats[subject, spikereg], subject, "1", "36P", spikereg,
+                              outlier_stats)
+        # recomputed matrix replaces the first one
+        mats["01", None] = np.ones((4, 4))
+        append_conmat(store_dir, "test", roi_names, mats["01", None], "01", "1", "36P", None, outlier_stats)
+
+        edges, meta = load_connectomes(store_dir, "test", "36P", None)
+        assert isinstance(edges, np.memmap) and edges.shape == (7, 6)
+        assert meta.subject.tolist() == ["01", "02", "03"]
+        assert meta.n_outliers.tolist() == [5, 5, 5]
+        for row, subject in zip(meta.row, meta.subject):
+            assert np.allclose(edges_to_matrix(edges[row])[np.triu_indices(4, 1)],
+                               mats[subject, None][np.triu_indices(4, 1)]), "edges differ"
+
+        edges, meta = load_connectomes(store_dir, "test", "36P", 0.5, subjects=["02"])
+        assert len(meta) == 1
+        assert np.allclose(edges[meta.row[0]], matrix_to_edges(mats["02", 0.5]))
+
+        # unchanged matrix is not appended again; replaced rows are removed by compaction
+        n_rows = os.path.getsize(os.path.join(store_dir, "parc-test", "edges.dat")) // 24
+        append_conmat(store_dir, "test", roi_names, mats["02", 0.5], "02", "1", "36P", 0.5, outlier_stats)
+        assert os.path.getsize(os.path.join(store_dir, "parc-test", "edges.dat")) // 24 == n_rows
+        assert compact_store(store_dir, "test") == 1 and compact_store(store_dir, "test") == 0
+        edges, meta = load_connectomes(store_dir, "test", "36P", None)
+        assert edges.shape == (6, 6) and meta.subject.tolist() == ["01", "02", "03"]
+        for row, subject in zip(meta.row, meta.subject):
+            assert np.allclose(edges[row], matrix_to_edges(mats[subject, None])), "compacted edges differ"
+
+        # censored variants count the censored volumes
+        censor_stats = pd.DataFrame({"censored": [False, True], "n_tr": [200, 25]})
+        append_conmat(store_dir, "test", roi_names, mats["01", 0.5], "01", "1", "36P", 0.5, censor_stats, censor=True)
+        _, meta = load_connectomes(store_dir, "test", "36P", 0.5, censor=True)
+        assert meta[["n_tr", "n_outliers"]].values.tolist() == [[225, 25]]
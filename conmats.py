@@ -1,94 +1,27 @@
 import os
-from nilearn import input_data, connectome, datasets, plotting
-from utils import get_confounds, get_files, save_feather
+from nilearn import input_data, connectome, image, signal
+from utils import get_confounds, get_confounds_from_df, get_censor_mask, get_files, save_feather
+from atlases import get_mask_data, get_stacked_operator, apply_stacked_operator, get_resampled_atlas_img, \
+    get_roi_info, DEFAULT_REGISTRY_DIR
+from cleaning import get_variant_projections, clean_with_projections
+from bold_cache import get_cached_bold
+from conmat_store import append_conmat, get_stored_keys
+from dfc import sliding_window_correlation
+from connectivity import get_connectivity
+from manifest import load_manifest, is_up_to_date, record_outputs, atomic_output
+from instrumentation import timed, job, keys_context
 import numpy as np
 import pandas as pd
 import matplotlib
 
 matplotlib.use('Agg')
-from matplotlib import pyplot as plt
-
-
-def _get_roi_info(parc):
-    if parc == "msdl":
-        atlas = datasets.fetch_atlas_msdl()
-        roi_file = atlas['maps']
-        df_labels = pd.DataFrame({"roi_labels": atlas['labels']})
-        if isinstance(df_labels["roi_labels"][0], bytes):
-            df_labels["roi_labels"] = df_labels.roi_labels.apply(bytes.decode)
-        roi_names = df_labels["roi_labels"].values
-        roi_type = "maps"
-
-    elif parc == "gordon":
-        atlas_dir = "/parcs/Gordon/Parcels"
-        roi_file = os.path.join(atlas_dir, "Parcels_MNI_111.nii")
-        labs_df = pd.read_excel(os.path.join(atlas_dir, "Parcels.xlsx"))
-        roi_names = labs_df.ParcelID.values
-        roi_type = "labels"
-
-    elif parc == "basc197":
-        atlas = datasets.fetch_atlas_basc_multiscale_2015(version='sym')
-        roi_file = atlas['scale197']
-        roi_names = np.arange(1, 198).astype(int)
-        roi_type = "labels"
-
-    elif parc == "basc444":
-        atlas = datasets.fetch_atlas_basc_multiscale_2015(version='sym')
-        roi_file = atlas['scale444']
-        roi_names = np.arange(1, 445).astype(int)
-        roi_type = "labels"
-
-    elif parc == "schaefer200":
-        atlas_dir = "/parcs/Schaefer"
-        schaefer_cols = "roi community c1 c2 c3 c4".split(" ")
-        roi_file = os.path.join(atlas_dir, "Schaefer2018_200Parcels_17Networks_order_FSLMNI152_1mm.nii.gz")
-        labs_df = pd.read_csv(os.path.join(atlas_dir, "Schaefer2018_200Parcels_17Networks_order.txt"), sep="\t",
-                              names=schaefer_cols)
-        roi_names = labs_df.roi
-        roi_type = "labels"
-
-    elif parc == "schaefer400":
-        atlas_dir = "/parcs/Schaefer"
-        schaefer_cols = "roi community c1 c2 c3 c4".split(" ")
-        roi_file = os.path.join(atlas_dir, "Schaefer2018_400Parcels_17Networks_order_FSLMNI152_1mm.nii.gz")
-        labs_df = pd.read_csv(os.path.join(atlas_dir, "Schaefer2018_400Parcels_17Networks_order.txt"), sep="\t",
-                              names=schaefer_cols)
-        roi_names = labs_df.roi
-        roi_type = "labels"
-
-    elif parc == "yeo17":
-        atlas = datasets.fetch_atlas_yeo_2011()
-        roi_file = atlas['thick_17']
-        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
-        df_labels = pd.read_csv(atlas["colors_17"], sep=r"\s*", engine="python", names=yeo_cols, skiprows=1)
-        roi_names = df_labels["roi_labels"].values
-        roi_type = "labels"
-
-    elif parc == "yeo17thin":
-        atlas = datasets.fetch_atlas_yeo_2011()
-        roi_file = atlas['thin_17']
-        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
-        df_labels = pd.read_csv(atlas["colors_17"], sep=r"\s*", engine="python", names=yeo_cols, skiprows=1)
-        roi_names = df_labels["roi_labels"].values
-        roi_type = "labels"
-
-    elif parc == "yeo17split":
-        atlas_dir = "/parcs/Yeo_splithemi"
-        roi_file = os.path.join(atlas_dir, "yeo_2011_thick17_splithemi.nii.gz")
-        labs_df = pd.read_csv(os.path.join(atlas_dir, "yeo_2011_thick17_splithemi.tsv"), sep="\t")
-        roi_names = labs_df.full_roi_name.values
-        roi_type = "labels"
-
-    elif parc == "yeo7":
-        atlas = datasets.fetch_atlas_yeo_2011()
-        roi_file = atlas['thick_7']
-        yeo_cols = "roi roi_labels c1 c2 c3 c4".split(" ")
-        df_labels = pd.read_csv(atlas["colors_7"], sep=r"\s*", engine="python", names=yeo_cols, skiprows=1)
-        roi_names = df_labels["roi_labels"].values
-        roi_type = "labels"
-    else:
-        raise Exception("Parcellation not known {}".format(parc))
-    return roi_file, roi_names, roi_type
+
+# recorded in the output manifests; bump when the conmat computation changes, so existing outputs are recomputed
+MANIFEST_VERSION = 2
+
+
+def _get_roi_info(parc, registry_dir=DEFAULT_REGISTRY_DIR):
+    return get_roi_info(parc, registry_dir)
 
 
 raw_mat = np.array([
@@ -125,71 +58,323 @@ def _get_con_df(raw_mat, roi_names):
     return con_df
 
 
-def conmat_one_session(subject, session, fmriprep_dir, output_dir, tr, conf, parc, spikereg_threshold=None):
+def _get_out_files(output_dir, subject, session, conf, parc, spikereg_threshold, censor=False, dfc_pars=None,
+                   kinds=("correlation",), figures=True):
+    """
+    returns dict with output file names of one subject/session/parc/conf/spikereg combination
+    with censor=True, outlier volumes are censored instead of regressed out, and files are named censor-<threshold>
+    with dfc_pars (see conmats_one_session), the file of the dynamic connectivity is added
+    kinds: additional connectivity kinds add conmat_<kind> files; tangent adds the covariance (cov) for the group step
+    figures: if False, the plot is not part of the outputs (it can be rendered later, see render.py)
+    """
     full_out_dir = os.path.join(output_dir, "sub-{}".format(subject), "ses-{}".format(session))
-    os.makedirs(full_out_dir, exist_ok=True)
+    out_stub = "sub-{}_ses-{}_parc-{}_conf-{}_{}-{}".format(subject, session, parc, conf,
+                                                          "censor" if censor else "spikereg", spikereg_threshold)
+
+    out_files = {"conmat": os.path.join(full_out_dir, "{}_conmat.tsv".format(out_stub)),
+                 "conmat_feather": os.path.join(full_out_dir, "{}_conmat.feather".format(out_stub)),
+                 "conmat_plot": os.path.join(full_out_dir, "{}_conmat.png".format(out_stub)),
+                 "report": os.path.join(full_out_dir, "{}_report.txt".format(out_stub)),
+                 "outlier_stats": os.path.join(full_out_dir, "{}_outlier_stats.txt".format(out_stub)),
+                 }
+    if not figures:
+        out_files.pop("conmat_plot")
+    for kind in kinds:
+        if kind == "tangent":
+            out_files["cov"] = os.path.join(full_out_dir, "{}_cov.npy".format(out_stub))
+        elif kind != "correlation":
+            out_files["conmat_" + kind] = os.path.join(full_out_dir, "{}_kind-{}_conmat.tsv".format(out_stub, kind))
+    if dfc_pars:
+        out_files["dfc"] = os.path.join(full_out_dir, "{}_dfc_width-{}_step-{}_taper-{}.npy".format(
+            out_stub, dfc_pars["width"], dfc_pars["step"], dfc_pars["taper"]))
+    return full_out_dir, out_files
+
+
+def _outputs_exist(out_files):
+    return all(map(os.path.exists, out_files.values()))
+
+
+def _get_provenance(out_files, rs_file, confounds_file, roi_file, conf, parc, spikereg_threshold, censor_pars,
+                    masker_pars):
+    """
+    returns manifest key, input files and params of one conmat variant (see manifest.is_up_to_date)
+    """
+    key = os.path.basename(out_files["conmat"]).replace("_conmat.tsv", "")
+    inputs = [rs_file, confounds_file, masker_pars["mask_img"], roi_file]
+    params = {"conf": conf, "parc": parc, "spikereg_threshold": spikereg_threshold, "censor_pars": censor_pars,
+              "masker_pars": masker_pars}
+    return key, inputs, params
 
-    out_stub_short = "{}_{}".format(subject, session)
-    out_stub = "sub-{}_ses-{}_parc-{}_conf-{}_spikereg-{}".format(subject, session, parc, conf, spikereg_threshold)
 
-    conmat_file = os.path.join(full_out_dir, "{}_conmat.tsv".format(out_stub))
-    conmat_file_feather = os.path.join(full_out_dir, "{}_conmat.feather".format(out_stub))
-    conmat_plot_file = os.path.join(full_out_dir, "{}_conmat.png".format(out_stub))
-    report_file = os.path.join(full_out_dir, "{}_report.txt".format(out_stub))
-    outlier_stats_file = os.path.join(full_out_dir, "{}_outlier_stats.txt".format(out_stub))
+def plot_conmat(conmat, roi_names, title, out_file, figure=None):
+    """
+    saves plot of conmat to out_file
+    figure: matplotlib figure to draw into (cleared first and kept open, so it can be reused); if None a new
+    figure is created and closed
+    """
+    # imported on first use, so jobs without figures do not load pyplot and nilearn.plotting
+    from matplotlib import pyplot as plt
+    from nilearn import plotting
+    if figure is None:
+        plotting.plot_matrix(conmat, labels=roi_names, figure=(9, 7), vmax=1, vmin=-1, title=title)
+        plt.savefig(out_file, bbox_inches='tight')
+        plt.close()
+    else:
+        figure.clf()
+        plotting.plot_matrix(conmat, labels=roi_names, figure=figure, vmax=1, vmin=-1, title=title)
+        figure.savefig(out_file, bbox_inches='tight')
+
 
-    if not (os.path.exists(conmat_file) and os.path.exists(conmat_file_feather) and os.path.exists(conmat_plot_file)
-            and os.path.exists(report_file) and os.path.exists(outlier_stats_file)):
-        print("*** Calc conmats for {} {} {} {} {} ***".format(subject, session, parc, conf, spikereg_threshold))
+def _save_conmat(conmat, roi_names, report_str, outlier_stats, out_files, title):
+    conmat_df = _get_con_df(conmat, roi_names)
 
-        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session)
-        roi_file, roi_names, roi_type = _get_roi_info(parc)
+    with timed("write"):
+        with atomic_output(out_files["conmat"]) as tmp_file:
+            conmat_df.to_csv(tmp_file, sep="\t")
+        with atomic_output(out_files["report"]) as tmp_file:
+            with open(tmp_file, "w") as fi:
+                fi.write(report_str)
+        with atomic_output(out_files["outlier_stats"]) as tmp_file:
+            outlier_stats.to_csv(tmp_file, sep="\t")
 
-        conmat, report_str, outlier_stats = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf,
-                                                        roi_type, tr, spikereg_threshold)
-        conmat_df = _get_con_df(conmat, roi_names)
+    if "conmat_plot" in out_files:
+        with timed("plot"), atomic_output(out_files["conmat_plot"]) as tmp_file:
+            plot_conmat(conmat, roi_names, title, tmp_file)
 
-        conmat_df.to_csv(conmat_file, sep="\t")
-        with open(report_file, "w") as fi:
-            fi.write(report_str)
-        outlier_stats.to_csv(outlier_stats_file, sep="\t")
+    with timed("write"), atomic_output(out_files["conmat_feather"]) as tmp_file:
+        save_feather(conmat_df, tmp_file)
 
-        plotting.plot_matrix(conmat, labels=roi_names, figure=(9, 7), vmax=1, vmin=-1, title=out_stub_short + " r")
-        plt.savefig(conmat_plot_file, bbox_inches='tight')
-        plt.close()
 
-        save_feather(conmat_df, conmat_file_feather)
+@job("conmat", subject="subject", session="session", parc="parc", conf="conf", spikereg="spikereg_threshold")
+def conmat_one_session(subject, session, fmriprep_dir, output_dir, tr, conf, parc, spikereg_threshold=None,
+                       cache_dir=None, censor_pars=None, layout=None, bold_cache_pars=None, figures=True,
+                       precision="float64"):
+    """
+    censor_pars: if not None, volumes with FD > spikereg_threshold are censored instead of adding spike regressors;
+    dict with the neighbor expansion and minimum run length (see utils.get_censor_mask), e.g.
+    {"before": 1, "after": 2, "min_run_length": 5}. The outlier stats file then holds the censor stats (counts of
+    censored and retained volumes).
+    layout: fmriprep layout index (see utils.get_layout)
+    bold_cache_pars: read the rs data from an uncompressed cache, e.g. {"cache_dir": ..., "dtype": "float32"} (see
+    bold_cache.get_cached_bold)
+    figures: if False, no plots are created (see render.py)
+    precision: "float32" keeps the rs data, cleaning and correlation in float32 (see _get_masker_pars)
+    Outputs are skipped if the manifest of the output directory (see manifest.py) lists them as computed from the
+    same input files and parameters.
+    """
+    full_out_dir, out_files = _get_out_files(output_dir, subject, session, conf, parc, spikereg_threshold,
+                                             censor_pars is not None, figures=figures)
+    os.makedirs(full_out_dir, exist_ok=True)
+
+    out_stub_short = "{}_{}".format(subject, session)
+    with timed("discover"):
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session, layout)
+        roi_file, roi_names, roi_type = _get_roi_info(parc)
+        key, inputs, params = _get_provenance(out_files, rs_file, confounds_file, roi_file, conf, parc,
+                                              spikereg_threshold, censor_pars,
+                                              _get_masker_pars(brainmask_file, tr, precision))
+        manifest, existing = load_manifest(full_out_dir)
+
+    if not is_up_to_date(manifest, existing, key, out_files.values(), inputs, params, MANIFEST_VERSION):
+        print("*** Calc conmats for {} {} {} {} {} ***".format(subject, session, parc, conf, spikereg_threshold))
+
+        conmat, report_str, outlier_stats = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf,
+                                                        roi_type, tr, spikereg_threshold, cache_dir, censor_pars,
+                                                        bold_cache_pars, precision)
+        _save_conmat(conmat, roi_names, report_str, outlier_stats, out_files, out_stub_short + " r")
+        record_outputs(full_out_dir, key, out_files.values(), inputs, params, MANIFEST_VERSION)
 
     else:
         print("*** Conmats for {} {} {} {} {} already computed. Do nothing. ***".format(subject, session, parc,
                                                                                         conf, spikereg_threshold))
 
 
-def extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf, roi_type, tr, spikereg_threshold=None):
+@job("conmats", subject="subject", session="session")
+def conmats_one_session(subject, session, fmriprep_dir, output_dir, tr, conf_parcs, spikereg_thresh_list,
+                        cache_dir=None, registry_dir=DEFAULT_REGISTRY_DIR, censor_pars=None, layout=None,
+                        bold_cache_pars=None, store_dir=None, dfc_pars=None, kinds=("correlation",), figures=True,
+                        precision="float64"):
     """
-    36 P
+    session-level version of conmat_one_session.
+    calculates all conf/parc/spikereg variants of one session, e.g.,
+    conf_parcs = {"36P": ["msdl", "yeo17"], "9P": ["yeo17"]}
+    spikereg_thresh_list = [None, 0.5]
+    The rs file is loaded and each parcellation is extracted only once. The variants are then created by cleaning the
+    (small) raw parcel time series with the respective confounds. Output files are the same as for
+    conmat_one_session.
+    The confound regression of all spikereg variants is done in one batch (see cleaning.get_variant_projections).
+    cache_dir: directory to cache atlases resampled to the rs grid (see atlases.get_resampled_atlas)
+    registry_dir: atlas registry (see atlases.get_roi_info)
+    censor_pars: censor outlier volumes instead of spike regression (see conmat_one_session)
+    layout: fmriprep layout index (see utils.get_layout)
+    bold_cache_pars: read the rs data from an uncompressed cache (see conmat_one_session)
+    store_dir: if not None, the conmats are also appended to the connectome store (see conmat_store.append_conmat).
+    Matrices of up-to-date variants that are missing in the store are appended from their output files.
+    dfc_pars: if not None, dynamic connectivity is additionally computed from the cleaned time series and saved as
+    (n_windows x n_edges) float32 .npy array; dict with window width and step in volumes and the taper, e.g.
+    {"width": 30, "step": 1, "taper": "rectangular"} (see dfc.sliding_window_correlation)
+    kinds: connectivity kinds (see connectivity.KINDS); correlation is always computed. All kinds are derived from one
+    covariance estimate per variant. For tangent, the covariance is saved and projected in the group step
+    (see connectivity.tangent_group)
+    figures: if False, no plots are created (see conmat_one_session)
+    precision: "float32" keeps the rs data, the extraction and the cleaning in float32 (see _get_masker_pars)
+    Up-to-date checks read the manifest of the session output directory once (see conmat_one_session).
     """
+    if censor_pars is not None and dfc_pars is not None:
+        raise Exception("Dynamic connectivity is not available for censored data (windows would span the gaps)")
+
+    with timed("discover"):
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session, layout)
+        masker_pars = _get_masker_pars(brainmask_file, tr, precision)
+        roi_infos = {parc: _get_roi_info(parc, registry_dir) for parc in set(sum(conf_parcs.values(), []))}
+        session_out_dir = os.path.join(output_dir, "sub-{}".format(subject), "ses-{}".format(session))
+        manifest, existing = load_manifest(session_out_dir)
+        stored_keys = {parc: get_stored_keys(store_dir, parc) for parc in roi_infos} if store_dir else {}
+
+    variants = []
+    for conf, parcs in conf_parcs.items():
+        for parc in parcs:
+            for spikereg_threshold in spikereg_thresh_list:
+                full_out_dir, out_files = _get_out_files(output_dir, subject, session, conf, parc, spikereg_threshold,
+                                                         censor_pars is not None, dfc_pars, kinds, figures)
+                key, inputs, params = _get_provenance(out_files, rs_file, confounds_file, roi_infos[parc][0], conf,
+                                                      parc, spikereg_threshold, censor_pars, masker_pars)
+                if not is_up_to_date(manifest, existing, key, out_files.values(), inputs, params, MANIFEST_VERSION):
+                    variants.append((conf, parc, spikereg_threshold, full_out_dir, out_files, (key, inputs, params)))
+                elif store_dir:
+                    with timed("write"):
+                        _append_outputs_to_store(store_dir, parc, roi_infos[parc][1], subject, session, conf,
+                                                 spikereg_threshold, censor_pars is not None, kinds, out_files,
+                                                 stored_keys[parc])
+
+    if not variants:
+        print("*** Conmats for {} {} already computed. Do nothing. ***".format(subject, session))
+        return
+
+    print("*** Calc {} conmats for {} {} ***".format(len(variants), subject, session))
+    out_stub_short = "{}_{}".format(subject, session)
 
-    # Masker
-    masker_pars = {"mask_img": brainmask_file, "detrend": True, "standardize": True, "low_pass": 0.1, "high_pass": \
-        0.01, "t_r": tr}
-
-    if roi_type == "maps":
-        # for msdl type probablistic rois
-        masker = input_data.NiftiMapsMasker(roi_file, **masker_pars)
-    elif roi_type == "labels":
-        # for binary rois
-        masker = input_data.NiftiLabelsMasker(roi_file, **masker_pars)
-    else:
-        raise Exception("roi type not known {}".format(roi_type))
-
-    # Extract time series
-    confounds, outlier_stats = get_confounds(confounds_file, kind=conf, spikereg_threshold=spikereg_threshold)
-    time_series = masker.fit_transform(rs_file, confounds=confounds.values)
+    parcs = sorted(set([v[1] for v in variants]))
+    rs_load_file = get_cached_bold(rs_file, **bold_cache_pars) if bold_cache_pars else rs_file
+    raw_signals = extract_parcel_signals(rs_load_file, brainmask_file, {p: (roi_infos[p][0], roi_infos[p][2])
+                                                                         for p in parcs}, cache_dir, precision)
+    with timed("confounds"):
+        confounds_df = pd.read_csv(confounds_file, sep="\t")
+
+    for conf in sorted(set([v[0] for v in variants])):
+        # all spikereg variants of one confound kind share the base confounds, which are factorized only once
+        conf_variants = [v for v in variants if v[0] == conf]
+        with timed("confounds", conf=conf):
+            base_confounds, _ = get_confounds_from_df(confounds_df, kind=conf)
+            confounds, outlier_stats, sample_masks = {}, {}, {}
+            for spikereg_threshold in set([v[2] for v in conf_variants]):
+                confounds[spikereg_threshold], outlier_stats[spikereg_threshold] = \
+                    get_confounds_from_df(confounds_df, kind=conf, spikereg_threshold=spikereg_threshold,
+                                          censor=censor_pars is not None)
+                if censor_pars is not None:
+                    # the censor stats (censored and retained volumes) replace the outlier counts
+                    sample_masks[spikereg_threshold], outlier_stats[spikereg_threshold] = \
+                        get_censor_mask(confounds_df["FramewiseDisplacement"].values, spikereg_threshold,
+                                        **censor_pars)
+        if censor_pars is None:
+            with timed("clean", conf=conf):
+                q_base, q_spikes = get_variant_projections(base_confounds,
+                                                           {k: c.iloc[:, base_confounds.shape[1]:]
+                                                            for k, c in confounds.items()},
+                                                           tr, masker_pars["low_pass"], masker_pars["high_pass"])
+
+        for parc in sorted(set([v[1] for v in conf_variants])):
+            with timed("clean", parc=parc, conf=conf):
+                if censor_pars is None:
+                    time_series = clean_with_projections(raw_signals[parc], q_base, q_spikes, tr,
+                                                         masker_pars["low_pass"], masker_pars["high_pass"])
+                else:
+                    # censored variants differ in their samples, they cannot share the projection
+                    time_series = {k: _clean_signals(raw_signals[parc], c, masker_pars, sample_masks[k])
+                                   for k, c in confounds.items()}
+            roi_file, roi_names, roi_type = roi_infos[parc]
+
+            for _, _, spikereg_threshold, full_out_dir, out_files, provenance in filter(lambda v: v[1] == parc,
+                                                                                        conf_variants):
+                with keys_context(parc=parc, conf=conf, spikereg=spikereg_threshold):
+                    print("*** Calc conmats for {} {} {} {} {} ***".format(subject, session, parc, conf,
+                                                                           spikereg_threshold))
+                    os.makedirs(full_out_dir, exist_ok=True)
+                    with timed("correlate"):
+                        conmats = get_connectivity(time_series[spikereg_threshold], set(kinds) | {"correlation"})
+                    conmat = conmats.pop("correlation")
+                    report_str = _get_report_str(rs_file, roi_file, masker_pars, spikereg_threshold,
+                                                 confounds[spikereg_threshold], censor_pars,
+                                                 sample_masks.get(spikereg_threshold))
+                    _save_conmat(conmat, roi_names, report_str, outlier_stats[spikereg_threshold], out_files,
+                                 out_stub_short + " r")
+                    with timed("write"):
+                        if store_dir:
+                            append_conmat(store_dir, parc, roi_names, conmat, subject, session, conf,
+                                          spikereg_threshold, outlier_stats[spikereg_threshold],
+                                          censor_pars is not None)
+                        for kind, kind_conmat in conmats.items():
+                            if kind == "tangent":
+                                with atomic_output(out_files["cov"]) as tmp_file:
+                                    np.save(tmp_file, kind_conmat)
+                                continue
+                            if kind == "partial_correlation":
+                                kind_df = _get_con_df(kind_conmat, roi_names)
+                            else:
+                                # keep the variances on the diagonal
+                                kind_df = pd.DataFrame(kind_conmat, index=roi_names, columns=roi_names)
+                            with atomic_output(out_files["conmat_" + kind]) as tmp_file:
+                                kind_df.to_csv(tmp_file, sep="\t")
+                            if store_dir:
+                                append_conmat(store_dir, parc, roi_names, kind_conmat, subject, session, conf,
+                                              spikereg_threshold, outlier_stats[spikereg_threshold],
+                                              censor_pars is not None, kind)
+                    if dfc_pars:
+                        with timed("correlate"):
+                            dfc, _ = sliding_window_correlation(time_series[spikereg_threshold], **dfc_pars)
+                        with timed("write"), atomic_output(out_files["dfc"]) as tmp_file:
+                            np.save(tmp_file, dfc)
+                    key, inputs, params = provenance
+                    record_outputs(full_out_dir, key, out_files.values(), inputs, params, MANIFEST_VERSION)
+
+
+def _append_outputs_to_store(store_dir, parc, roi_names, subject, session, conf, spikereg_threshold, censor, kinds,
+                             out_files, stored_keys):
+    """
+    appends the matrices of an up-to-date variant that are missing in the connectome store (e.g., after the store was
+    deleted or with a new store_dir) from its output files; stored_keys: see conmat_store.get_stored_keys
+    tangent matrices are added by the group step (see connectivity.tangent_group)
+    """
+    outlier_stats = None
+    for kind in ["correlation"] + [k for k in kinds if k not in ["correlation", "tangent"]]:
+        if (subject, session, conf, str(spikereg_threshold), censor, kind) in stored_keys:
+            continue
+        if outlier_stats is None:
+            outlier_stats = pd.read_csv(out_files["outlier_stats"], sep="\t", index_col=0)
+        conmat_file = out_files["conmat"] if kind == "correlation" else out_files["conmat_" + kind]
+        conmat = pd.read_csv(conmat_file, sep="\t", index_col=0).values
+        print("*** Adding {} {} {} {} {} {} to the store ***".format(subject, session, parc, conf,
+                                                                    spikereg_threshold, kind))
+        append_conmat(store_dir, parc, roi_names, conmat, subject, session, conf, spikereg_threshold, outlier_stats,
+                      censor, kind)
+
+
+def _get_masker_pars(brainmask_file, tr, precision="float64"):
+    """
+    precision: "float32" sets the dtype of the maskers, so the rs data are loaded and cleaned in float32 instead of
+    being upcast to float64 (nilearn keeps the dtype of the data through detrending, filtering and confound
+    regression). For float64 no dtype is set, so the masker parameters (and the provenance of existing outputs)
+    stay the same.
+    """
+    masker_pars = {"mask_img": brainmask_file, "detrend": True, "standardize": True, "low_pass": 0.1,
+                   "high_pass": 0.01, "t_r": tr}
+    if precision != "float64":
+        masker_pars["dtype"] = precision
+    return masker_pars
 
-    con_measure = connectome.ConnectivityMeasure(kind='correlation')
-    conmat = con_measure.fit_transform([time_series])[0]
 
+def _get_report_str(rs_file, roi_file, masker_pars, spikereg_threshold, confounds, censor_pars=None,
+                    sample_mask=None):
     report_str = "rs_file\t{}\n".format(rs_file)
     report_str += "roi_file\t{}\n".format(roi_file)
 
@@ -198,10 +383,308 @@ def extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf, roi_typ
     for k in keys:
         report_str += "{}\t{}\n".format(k, masker_pars[k])
 
-    report_str += "spike regression \t {}".format(spikereg_threshold)
+    if censor_pars is None:
+        report_str += "spike regression \t {}".format(spikereg_threshold)
+    else:
+        report_str += "censoring \t {} {}\n".format(spikereg_threshold, censor_pars)
+        report_str += "retained volumes \t {} of {}\n".format(len(sample_mask), len(confounds))
+        report_str += "censored volumes \t {}".format(
+            ", ".join(map(str, np.setdiff1d(np.arange(len(confounds)), sample_mask))))
     report_str += "\n\n"
     report_str += "confounds\t{}".format(", ".join(confounds.columns))
     report_str += "\n\n"
     report_str += confounds.to_string()
+    return report_str
+
+
+def extract_parcel_signals(rs_file, brainmask_file, roi_infos, cache_dir=None, precision="float64"):
+    """
+    loads rs_file once and extracts the raw (i.e., not cleaned) parcel time series for all parcellations in
+    roi_infos = {parc: (roi_file, roi_type)}
+    returns dict {parc: time_series}
+    The parcellations are stacked into one sparse voxel->roi operator, so all time series are extracted with one
+    matrix product over the masked data.
+    As the maskers clean the extracted parcel signals, cleaning those raw signals later (conmat_from_signals)
+    gives the same result as extract_mat.
+    precision: dtype of the loaded data and the time series; "float32" scales int16 data directly to float32
+    """
+    with timed("load"):
+        rs_img = image.load_img(rs_file)
+        rs_data = np.asarray(rs_img.dataobj) if precision == "float64" else np.asarray(rs_img.dataobj, precision)
+    with timed("mask"):
+        mask_data = get_mask_data(brainmask_file, rs_img)
+        operator, slices = get_stacked_operator(roi_infos, rs_img, mask_data, cache_dir)
+
+        masked_data = rs_data[mask_data].astype(precision, copy=False)
+        masked_data[~np.isfinite(masked_data)] = 0
+        return apply_stacked_operator(operator.astype(precision, copy=False), slices, masked_data)
+
+
+def _correlation(time_series):
+    con_measure = connectome.ConnectivityMeasure(kind='correlation')
+    return con_measure.fit_transform([time_series])[0]
+
+
+def _clean_signals(raw_signals, confounds, masker_pars, sample_mask=None):
+    return signal.clean(raw_signals, detrend=masker_pars["detrend"], standardize=masker_pars["standardize"],
+                        confounds=confounds.values, low_pass=masker_pars["low_pass"],
+                        high_pass=masker_pars["high_pass"], t_r=masker_pars["t_r"], sample_mask=sample_mask)
+
+
+def conmat_from_signals(raw_signals, confounds, tr, sample_mask=None):
+    """
+    cleans raw parcel time series (same parameters as the maskers in extract_mat) and returns correlation matrix
+    sample_mask: indices of volumes to keep (censoring)
+    """
+    time_series = _clean_signals(raw_signals, confounds, _get_masker_pars(None, tr), sample_mask)
+    return _correlation(time_series)
+
+
+def extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf, roi_type, tr, spikereg_threshold=None,
+                cache_dir=None, censor_pars=None, bold_cache_pars=None, precision="float64"):
+    """
+    36 P
+    if cache_dir is given, the atlas resampled to the rs grid is taken from the cache (see
+    atlases.get_resampled_atlas) and the masker does not need to resample it
+    if censor_pars is given, volumes with FD > spikereg_threshold are censored instead of regressed out (see
+    utils.get_censor_mask); correlations are calculated on the retained volumes and the returned outlier_stats are
+    the censor stats (censored and retained volumes after neighbor expansion and minimum run length)
+    if bold_cache_pars is given, rs data is read from an uncompressed, memory-mapped copy (see
+    bold_cache.get_cached_bold)
+    precision: "float32" keeps the data and the cleaning in float32 (see _get_masker_pars)
+    """
+    rs_load_file = get_cached_bold(rs_file, **bold_cache_pars) if bold_cache_pars else rs_file
+
+    # Masker
+    masker_pars = _get_masker_pars(brainmask_file, tr, precision)
+
+    if cache_dir:
+        roi_img = get_resampled_atlas_img(roi_file, roi_type, image.load_img(rs_load_file), cache_dir)
+    else:
+        roi_img = roi_file
+
+    if roi_type == "maps":
+        # for msdl type probablistic rois
+        masker = input_data.NiftiMapsMasker(roi_img, **masker_pars)
+    elif roi_type == "labels":
+        # for binary rois
+        masker = input_data.NiftiLabelsMasker(roi_img, **masker_pars)
+    else:
+        raise Exception("roi type not known {}".format(roi_type))
+
+    # Extract time series
+    confounds, outlier_stats = get_confounds(confounds_file, kind=conf, spikereg_threshold=spikereg_threshold,
+                                             censor=censor_pars is not None)
+    sample_mask = None
+    if censor_pars is not None:
+        motion_ts = pd.read_csv(confounds_file, sep="\t", usecols=["FramewiseDisplacement"])
+        sample_mask, outlier_stats = get_censor_mask(motion_ts["FramewiseDisplacement"].values, spikereg_threshold,
+                                                     **censor_pars)
+    with timed("mask_clean"):
+        time_series = masker.fit_transform(rs_load_file, confounds=confounds.values, sample_mask=sample_mask)
+
+    with timed("correlate"):
+        conmat = _correlation(time_series)
+
+    report_str = _get_report_str(rs_file, roi_file, masker_pars, spikereg_threshold, confounds, censor_pars,
+                                 sample_mask)
 
     return conmat, report_str, outlier_stats
+
+
+def _make_test_session(out_dir, n_vols=225, shape=(8, 8, 8)):
+    """
+    writes a small random rs image, brainmask, labels and maps image to out_dir
+    returns rs_file, brainmask_file, labels_file, maps_file
+    """
+    import nibabel as nb
+    rng = np.random.RandomState(42)
+    affine = np.diag([2., 2., 2., 1.])
+    rs_file = os.path.join(out_dir, "rs.nii.gz")
+    brainmask_file = os.path.join(out_dir, "brainmask.nii.gz")
+    labels_file = os.path.join(out_dir, "labels.nii.gz")
+    maps_file = os.path.join(out_dir, "maps.nii.gz")
+
+    rs_data = 100 + rng.randn(*(shape + (n_vols,)))
+    nb.Nifti1Image(rs_data, affine).to_filename(rs_file)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:-1, 1:-1, 1:-1] = 1
+    nb.Nifti1Image(mask, affine).to_filename(brainmask_file)
+    labels = np.zeros(shape, dtype=np.int16)
+    labels[:4, :4] = 1
+    labels[4:, :4] = 2
+    labels[:4, 4:] = 3
+    labels[4:, 4:, :4] = 4
+    nb.Nifti1Image(labels, affine).to_filename(labels_file)
+    maps = np.zeros(shape + (3,))
+    maps[:5, :, :, 0] = rng.rand(5, shape[1], shape[2])
+    maps[3:, :5, :, 1] = rng.rand(shape[0] - 3, 5, shape[2])
+    maps[:, 4:, 2:, 2] = rng.rand(shape[0], shape[1] - 4, shape[2] - 2)
+    nb.Nifti1Image(maps, affine).to_filename(maps_file)
+    return rs_file, brainmask_file, labels_file, maps_file
+
+
+def test_conmat_from_signals():
+    from tempfile import TemporaryDirectory
+    confounds_file = os.path.join("test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv")
+    with TemporaryDirectory() as tmp_dir:
+        rs_file, brainmask_file, labels_file, maps_file = _make_test_session(tmp_dir)
+        roi_infos = {"test_labels": (labels_file, "labels"), "test_maps": (maps_file, "maps")}
+        raw_signals = extract_parcel_signals(rs_file, brainmask_file, roi_infos)
+
+        for parc, (roi_file, roi_type) in roi_infos.items():
+            for conf, spikereg_threshold in [("36P", None), ("9P", 0.4)]:
+                conmat, _, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf, roi_type, 2.,
+                                           spikereg_threshold)
+                confounds, _ = get_confounds(confounds_file, conf, spikereg_threshold)
+                conmat_session = conmat_from_signals(raw_signals[parc], confounds, 2.)
+                assert np.allclose(conmat, conmat_session), "session-level conmat differs from extract_mat"
+
+
+def test_atlas_cache():
+    from tempfile import TemporaryDirectory
+    confounds_file = os.path.join("test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv")
+    with TemporaryDirectory() as tmp_dir:
+        rs_file, brainmask_file, labels_file, maps_file = _make_test_session(tmp_dir)
+        cache_dir = os.path.join(tmp_dir, "cache")
+        roi_infos = {"test_labels": (labels_file, "labels"), "test_maps": (maps_file, "maps")}
+        raw_signals = extract_parcel_signals(rs_file, brainmask_file, roi_infos)
+        assert not os.path.exists(cache_dir), "cache written without cache_dir"
+        for _ in range(2):  # 1st run fills cache, 2nd reads from it
+            raw_signals_cached = extract_parcel_signals(rs_file, brainmask_file, roi_infos, cache_dir)
+            assert len(os.listdir(cache_dir)) == 2, "expected one cache entry per atlas"
+            for parc in roi_infos:
+                assert np.allclose(raw_signals[parc], raw_signals_cached[parc]), "cached atlas gives different ts"
+
+        for parc, (roi_file, roi_type) in roi_infos.items():
+            conmat, _, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, "36P", roi_type, 2.)
+            conmat_cached, _, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, "36P", roi_type, 2.,
+                                              cache_dir=cache_dir)
+            assert np.allclose(conmat, conmat_cached), "cached atlas gives different conmat"
+
+
+def _make_test_fmriprep_dir(fmriprep_dir, subject, session):
+    """
+    writes one session of the test data with fmriprep file names to fmriprep_dir and registers the test labels and
+    maps as parcellations "test_labels" and "test_maps" in fmriprep_dir/registry
+    returns registry_dir
+    """
+    from atlases import add_to_registry
+    import shutil
+    func_dir = os.path.join(fmriprep_dir, "sub-" + subject, "ses-" + session, "func")
+    anat_dir = os.path.join(fmriprep_dir, "sub-" + subject, "anat")
+    os.makedirs(func_dir)
+    os.makedirs(anat_dir)
+    rs_file, brainmask_file, labels_file, maps_file = _make_test_session(fmriprep_dir)
+    stub = os.path.join(func_dir, "sub-{}_ses-{}_task-rest_run-1_bold".format(subject, session))
+    shutil.move(rs_file, stub + "_space-MNI152NLin2009cAsym_preproc.nii.gz")
+    shutil.move(brainmask_file, stub + "_space-MNI152NLin2009cAsym_brainmask.nii.gz")
+    shutil.copy("test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv", stub + "_confounds.tsv")
+    shutil.copy(stub + "_space-MNI152NLin2009cAsym_brainmask.nii.gz",
+                os.path.join(anat_dir, "sub-{}_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz".format(subject)))
+
+    registry_dir = os.path.join(fmriprep_dir, "registry")
+    add_to_registry(registry_dir, "test_labels", labels_file, ["r1", "r2", "r3", "r4"], "labels")
+    add_to_registry(registry_dir, "test_maps", maps_file, ["m1", "m2", "m3"], "maps")
+    return registry_dir
+
+
+def test_conmats_one_session():
+    from glob import glob
+    from tempfile import TemporaryDirectory
+    from conmat_store import load_connectomes, matrix_to_edges
+    from instrumentation import _records, get_stage_times
+    get_stage_times()
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        output_dir = os.path.join(tmp_dir, "out")
+        registry_dir = _make_test_fmriprep_dir(fmriprep_dir, "1", "1")
+        conf_parcs = {"36P": ["test_labels", "test_maps"], "9P": ["test_labels"]}
+        spikereg_thresh_list = [None, 0.3]
+        store_dir = os.path.join(tmp_dir, "store")
+        # one window over the whole run gives the static conmat
+        dfc_pars = {"width": 225, "step": 10, "taper": "rectangular"}
+        kinds = ["correlation", "partial_correlation", "tangent"]
+        conmats_one_session("1", "1", fmriprep_dir, output_dir, 2., conf_parcs, spikereg_thresh_list,
+                            registry_dir=registry_dir, bold_cache_pars={"cache_dir": os.path.join(tmp_dir, "bold")},
+                            store_dir=store_dir, dfc_pars=dfc_pars, kinds=kinds)
+        assert len(glob(os.path.join(tmp_dir, "bold", "*.nii"))) == 1, "rs data not cached"
+        # telemetry records carry the keys of the job and of the variant
+        correlate_keys = {(r["job"], r["subject"], r["session"], r["parc"], r["conf"], r["spikereg"])
+                          for r in _records if r.get("stage") == "correlate"}
+        assert correlate_keys == {("conmats", "1", "1", parc, conf, t) for conf, parcs in conf_parcs.items()
+                                  for parc in parcs for t in spikereg_thresh_list}
+
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, "1", "1")
+        for conf, parcs in conf_parcs.items():
+            for parc in parcs:
+                roi_file, roi_names, roi_type = get_roi_info(parc, registry_dir)
+                for spikereg_threshold in spikereg_thresh_list:
+                    _, out_files = _get_out_files(output_dir, "1", "1", conf, parc, spikereg_threshold,
+                                                  dfc_pars=dfc_pars, kinds=kinds)
+                    assert _outputs_exist(out_files), "output missing"
+                    conmat, _, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, conf, roi_type, 2.,
+                                               spikereg_threshold)
+                    expected = _get_con_df(conmat, roi_names)
+                    conmat_df = pd.read_csv(out_files["conmat"], sep="\t", index_col=0)
+                    assert np.allclose(conmat_df.values, expected.values), "batched conmat differs from extract_mat"
+                    edges, meta = load_connectomes(store_dir, parc, conf, spikereg_threshold)
+                    assert meta[["subject", "session"]].values.tolist() == [["1", "1"]]
+                    assert np.allclose(edges[meta.row[0]], matrix_to_edges(conmat), atol=1e-6), "stored edges differ"
+                    edges, meta = load_connectomes(store_dir, parc, conf, spikereg_threshold,
+                                                   kind="partial_correlation")
+                    partial = pd.read_csv(out_files["conmat_partial_correlation"], sep="\t", index_col=0).values
+                    assert np.allclose(edges[meta.row[0]], matrix_to_edges(partial), atol=1e-6), \
+                        "stored partial corr differs"
+                    assert np.load(out_files["cov"]).shape == (len(roi_names), len(roi_names))
+                    dfc = np.load(out_files["dfc"])
+                    assert dfc.shape == (1, len(edges[0]))
+                    # the static conmat uses ledoit-wolf shrinkage, which scales the correlations of standardized
+                    # time series by a constant
+                    ratio = matrix_to_edges(conmat) / dfc[0]
+                    assert np.allclose(ratio, ratio[0], atol=1e-5), "dfc differs from conmat"
+
+        # second run is skipped based on the manifest, but fills a new (or deleted) store from the outputs; a changed
+        # input is recomputed
+        _, out_files = _get_out_files(output_dir, "1", "1", "9P", "test_labels", None)
+        mtime = os.stat(out_files["conmat"]).st_mtime
+        new_store_dir = os.path.join(tmp_dir, "new_store")
+        conmats_one_session("1", "1", fmriprep_dir, output_dir, 2., conf_parcs, spikereg_thresh_list,
+                            registry_dir=registry_dir, dfc_pars=dfc_pars, kinds=kinds, store_dir=new_store_dir)
+        assert os.stat(out_files["conmat"]).st_mtime == mtime, "up-to-date outputs recomputed"
+        for parc in ["test_labels", "test_maps"]:
+            for kind in ["correlation", "partial_correlation"]:
+                edges, meta = load_connectomes(store_dir, parc, "36P", 0.3, kind=kind)
+                new_edges, new_meta = load_connectomes(new_store_dir, parc, "36P", 0.3, kind=kind)
+                assert np.allclose(new_edges[new_meta.row.values], edges[meta.row.values]), "store not filled"
+                assert new_meta.n_outliers.tolist() == meta.n_outliers.tolist()
+        os.utime(confounds_file)
+        conmats_one_session("1", "1", fmriprep_dir, output_dir, 2., conf_parcs, spikereg_thresh_list,
+                            registry_dir=registry_dir, dfc_pars=dfc_pars, kinds=kinds)
+        assert os.stat(out_files["conmat"]).st_mtime != mtime, "outputs not recomputed after input change"
+
+
+def test_conmats_one_session_censor():
+    from tempfile import TemporaryDirectory
+    censor_pars = {"before": 1, "after": 2, "min_run_length": 5}
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        output_dir = os.path.join(tmp_dir, "out")
+        registry_dir = _make_test_fmriprep_dir(fmriprep_dir, "1", "1")
+        conmats_one_session("1", "1", fmriprep_dir, output_dir, 2., {"36P": ["test_labels"]}, [None, 0.3],
+                            registry_dir=registry_dir, censor_pars=censor_pars)
+
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, "1", "1")
+        roi_file, roi_names, roi_type = get_roi_info("test_labels", registry_dir)
+        for spikereg_threshold in [None, 0.3]:
+            _, out_files = _get_out_files(output_dir, "1", "1", "36P", "test_labels", spikereg_threshold, True)
+            conmat, report_str, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, "36P", roi_type, 2.,
+                                                spikereg_threshold, censor_pars=censor_pars)
+            conmat_df = pd.read_csv(out_files["conmat"], sep="\t", index_col=0)
+            assert np.allclose(conmat_df.values, _get_con_df(conmat, roi_names).values), "censored conmat differs"
+            with open(out_files["report"]) as fi:
+                assert fi.read() == report_str
+            censor_stats = pd.read_csv(out_files["outlier_stats"], sep="\t", index_col=0)
+            n_retained = censor_stats.loc[~censor_stats.censored, "n_tr"].sum()
+            assert "retained volumes \t {} of 225".format(n_retained) in report_str, "censor stats differ"
+        assert "retained volumes \t 225 of 225" not in report_str, "no volumes censored"
@@ -0,0 +1,194 @@
+import os
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from scipy import stats
+from conmat_store import load_store_meta, load_connectomes, load_roi_names, edges_to_matrix, VARIANT_COLS
+
+
+def _fisher_z(edges):
+    return np.arctanh(np.clip(edges.astype(np.float64), -0.999999, 0.999999))
+
+
+def _as_float(edges):
+    return edges.astype(np.float64)
+
+
+def _get_transform(kind):
+    # (partial) correlations are fisher z transformed; covariance and tangent values are used as they are
+    return _fisher_z if kind in ["correlation", "partial_correlation"] else _as_float
+
+
+def chunked_mean_sd(edges, rows=None, chunk_size=256, transform=_fisher_z):
+    """
+    mean and SD (ddof=1) over rows of edges (n_rows x n_edges, e.g. the memmap of the connectome store) of transformed
+    (by default fisher z transformed) values.
+    rows: rows of edges to use (e.g., meta.row of conmat_store.load_connectomes); all rows if None
+    Rows are read in chunks, which are combined with Chan's parallel update, so only chunk_size rows are in memory.
+    """
+    if rows is None:
+        rows = np.arange(edges.shape[0])
+    n, mean, m2 = 0, np.zeros(edges.shape[1]), np.zeros(edges.shape[1])
+    for start in range(0, len(rows), chunk_size):
+        z = transform(edges[rows[start:start + chunk_size]])
+        n_b, mean_b = len(z), z.mean(axis=0)
+        m2_b = ((z - mean_b) ** 2).sum(axis=0)
+        delta = mean_b - mean
+        n_ab = n + n_b
+        mean += delta * n_b / n_ab
+        m2 += m2_b + delta ** 2 * n * n_b / n_ab
+        n = n_ab
+    sd = np.sqrt(m2 / (n - 1)) if n > 1 else np.full_like(m2, np.nan)
+    return mean, sd
+
+
+def _paired_t(sums, sum_sq, n):
+    # one-sample t of the differences from their sums and sums of squares; works on batches of sums
+    mean = sums / n
+    sd = np.sqrt(np.maximum(sum_sq - sums * mean, 0) / (n - 1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return mean / (sd / np.sqrt(n))
+
+
+def paired_max_t(edges, rows_a, rows_b, n_perm=5000, batch_size=500, chunk_size=20000, transform=_fisher_z,
+                 random_state=0):
+    """
+    edgewise paired t-tests of the transformed edges (n_rows x n_edges, e.g. the memmap of the connectome store) of
+    rows_b vs. rows_a (one pair of rows per subject; differences b - a) with FWE correction by the max-statistic of
+    sign-flip permutations.
+    The edges are read in chunks of chunk_size columns, so only (n_subjects x chunk_size) differences are in memory.
+    All edges of a chunk and a batch of permutations are tested with one matrix product (signs x diffs); the sums of
+    squares do not change under sign flips and are computed once per chunk. The max-statistics are combined across
+    chunks.
+    returns mean difference, t, uncorrected two-sided p and FWE corrected p (each n_edges)
+    """
+    n, n_edges = len(rows_a), edges.shape[1]
+    rng = np.random.RandomState(random_state)
+    signs = rng.choice([-1., 1.], size=(n_perm, n))
+    mean_diff, t = np.zeros(n_edges), np.zeros(n_edges)
+    max_t = np.zeros(n_perm)
+    for start in range(0, n_edges, chunk_size):
+        cols = slice(start, start + chunk_size)
+        diffs = transform(edges[rows_b, cols]) - transform(edges[rows_a, cols])
+        sum_sq = (diffs ** 2).sum(axis=0)
+        mean_diff[cols] = diffs.mean(axis=0)
+        t[cols] = _paired_t(diffs.sum(axis=0), sum_sq, n)
+        for perm_start in range(0, n_perm, batch_size):
+            perms = slice(perm_start, perm_start + batch_size)
+            t_perm = _paired_t(signs[perms].dot(diffs), sum_sq, n)
+            max_t[perms] = np.fmax(max_t[perms], np.nanmax(np.abs(t_perm), axis=1))
+    p_unc = 2 * stats.t.sf(np.abs(t), n - 1)
+    max_t = np.sort(max_t)
+    # number of permutations with a max-statistic >= |t| (plus the observed one)
+    n_ge = n_perm - np.searchsorted(max_t, np.abs(t), side="left")
+    p_fwe = (n_ge + 1) / (n_perm + 1)
+    return mean_diff, t, p_unc, p_fwe
+
+
+def _get_variant_stub(parc, conf, spikereg, censor, kind="correlation"):
+    stub = "{}_{}_{}-{}".format(parc, conf, "censor" if censor else "spikereg", spikereg)
+    return stub if kind == "correlation" else stub + "_kind-" + kind
+
+
+def conmats_group(store_dir, output_dir, subjects=None, n_perm=5000, random_state=0):
+    """
+    group statistics of all variants (parc/conf/spikereg/censor/kind) in the connectome store (see conmat_store)
+    writes to output_dir/parc-<parc>, per variant
+    * per session: mean and SD matrices of the fisher z transformed (partial) correlations (mean_fisherz,
+      sd_fisherz); of the untransformed values for covariance and tangent (mean, sd)
+    * per pair of sessions: edgewise paired t-tests (subjects with both sessions) with max-t permutation FWE correction
+      as edge table (roi1, roi2, mean_diff, t, p_unc, p_fwe)
+    subjects: list of subjects to restrict to
+    """
+    parcs = sorted([d[len("parc-"):] for d in os.listdir(store_dir) if d.startswith("parc-")])
+    for parc in parcs:
+        roi_names = load_roi_names(store_dir, parc)
+        iu = np.triu_indices(len(roi_names), 1)
+        parc_out_dir = os.path.join(output_dir, "parc-{}".format(parc))
+        os.makedirs(parc_out_dir, exist_ok=True)
+
+        variants = load_store_meta(store_dir, parc)[VARIANT_COLS].drop_duplicates().values
+        for conf, spikereg, censor, kind in variants:
+            stub = _get_variant_stub(parc, conf, spikereg, censor, kind)
+            transform = _get_transform(kind)
+            print("*** Group conmats {} ***".format(stub))
+            edges, meta = load_connectomes(store_dir, parc, conf, spikereg, subjects, censor, kind)
+            sessions = sorted(meta.session.unique())
+
+            for session in sessions:
+                ses_rows = meta.row[meta.session == session].values
+                mean, sd = chunked_mean_sd(edges, ses_rows, transform=transform)
+                for stat, values in [("mean", mean), ("sd", sd)]:
+                    df = pd.DataFrame(edges_to_matrix(values), index=roi_names, columns=roi_names)
+                    stat_file = "{}_ses-{}_{}{}.tsv".format(stub, session, stat,
+                                                            "_fisherz" if transform is _fisher_z else "")
+                    df.to_csv(os.path.join(parc_out_dir, stat_file), sep="\t")
+                print("{} ses-{}: {} sessions".format(stub, session, len(ses_rows)))
+
+            # row of each subject/session in edges
+            subject_rows = meta.pivot(index="subject", columns="session", values="row")
+            for ses_a, ses_b in combinations(sessions, 2):
+                rows = subject_rows[[ses_a, ses_b]].dropna().astype(int)
+                if len(rows) < 3:
+                    print("{} ses-{} vs ses-{}: only {} subjects, skipping test".format(stub, ses_a, ses_b,
+                                                                                      len(rows)))
+                    continue
+                mean_diff, t, p_unc, p_fwe = paired_max_t(edges, rows[ses_a].values, rows[ses_b].values, n_perm,
+                                                          transform=transform, random_state=random_state)
+                df = pd.DataFrame({"roi1": roi_names[iu[0]], "roi2": roi_names[iu[1]],
+                                   "mean_diff": mean_diff, "t": t, "p_unc": p_unc, "p_fwe": p_fwe})
+                df.to_csv(os.path.join(parc_out_dir, "{}_ses-{}-vs-{}_paired.tsv".format(stub, ses_b, ses_a)),
+                          sep="\t", index=False)
+                print("{} ses-{} vs ses-{}: {} subjects, {} edges p_fwe<0.05".format(stub, ses_b, ses_a, len(rows),
+                                                                                   (p_fwe < 0.05).sum()))
+
+
+def test_chunked_mean_sd():
+    rng = np.random.RandomState(0)
+    edges = np.tanh(rng.randn(50, 10)).astype(np.float32)
+    mean, sd = chunked_mean_sd(edges, chunk_size=7)
+    z = _fisher_z(edges)
+    assert np.allclose(mean, z.mean(axis=0))
+    assert np.allclose(sd, z.std(axis=0, ddof=1))
+    rows = np.arange(1, 50, 3)
+    mean, sd = chunked_mean_sd(edges, rows, chunk_size=4)
+    assert np.allclose(mean, z[rows].mean(axis=0)) and np.allclose(sd, z[rows].std(axis=0, ddof=1))
+
+
+def test_paired_max_t():
+    rng = np.random.RandomState(0)
+    edges = rng.randn(40, 30)
+    edges[20:, 0] += 3
+    rows_a, rows_b = np.arange(20), np.arange(20, 40)[::-1]
+    mean_diff, t, p_unc, p_fwe = paired_max_t(edges, rows_a, rows_b, n_perm=1000, transform=_as_float)
+    diffs = edges[rows_b] - edges[rows_a]
+    expected = stats.ttest_1samp(diffs, 0)
+    assert np.allclose(mean_diff, diffs.mean(axis=0))
+    assert np.allclose(t, expected.statistic)
+    assert np.allclose(p_unc, expected.pvalue)
+    assert p_fwe[0] < 0.01 and (p_fwe[1:] > 0.05).all()
+    assert (p_fwe >= p_unc).all()
+    # the edge chunks give the same max-statistics
+    chunked = paired_max_t(edges, rows_a, rows_b, n_perm=1000, chunk_size=7, transform=_as_float)
+    assert np.allclose(chunked[3], p_fwe)
+
+
+def test_conmats_group():
+    from tempfile import TemporaryDirectory
+    from conmat_store import append_conmat
+    rng = np.random.RandomState(0)
+    roi_names = ["r1", "r2", "r3", "r4"]
+    with TemporaryDirectory() as tmp_dir:
+        store_dir, output_dir = os.path.join(tmp_dir, "store"), os.path.join(tmp_dir, "group")
+        for subject in ["01", "02", "03", "04", "05"]:
+            for session in ["1", "2"]:
+                m = np.tanh(rng.randn(4, 4) * .3)
+                append_conmat(store_dir, "test", roi_names, m + m.T, subject, session, "36P", None)
+        conmats_group(store_dir, output_dir, n_perm=100)
+        files = sorted(os.listdir(os.path.join(output_dir, "parc-test")))
+        assert files == ["test_36P_spikereg-None_ses-1_mean_fisherz.tsv", "test_36P_spikereg-None_ses-1_sd_fisherz.tsv",
+                         "test_36P_spikereg-None_ses-2-vs-1_paired.tsv", "test_36P_spikereg-None_ses-2_mean_fisherz.tsv",
+                         "test_36P_spikereg-None_ses-2_sd_fisherz.tsv"], files
+        df = pd.read_csv(os.path.join(output_dir, "parc-test", "test_36P_spikereg-None_ses-2-vs-1_paired.tsv"),
+                         sep="\t")
+        assert len(df) == 6
@@ -0,0 +1,215 @@
+import os
+import warnings
+import numpy as np
+
+KINDS = ["correlation", "partial_correlation", "covariance", "tangent"]
+# recorded in the output manifest of tangent_group; bump when the tangent computation changes, so existing outputs are
+# recomputed
+MANIFEST_VERSION = 1
+
+
+def get_connectivity(time_series, kinds=("correlation",)):
+    """
+    estimates the (ledoit-wolf shrunk) covariance of the cleaned time series once and derives all kinds from it
+    returns dict {kind: matrix}
+    For "tangent", the covariance is returned, as the projection needs the group mean (see tangent_projection).
+    The results equal nilearn's ConnectivityMeasure with the respective kind if the time series are z-scored (as the
+    cleaned time series of the conmats). For other time series, only correlation differs: ConnectivityMeasure
+    z-scores them before the ledoit-wolf estimate, and the shrinkage depends on the scale of the data.
+    """
+    # imported here, so importing KINDS (run.py) does not load sklearn and nilearn
+    from scipy import linalg
+    from sklearn.covariance import LedoitWolf
+    from nilearn.connectome import cov_to_corr, prec_to_partial
+    cov = LedoitWolf(store_precision=False).fit(time_series).covariance_
+    conmats = {}
+    for kind in kinds:
+        if kind == "correlation":
+            conmats[kind] = cov_to_corr(cov)
+        elif kind == "partial_correlation":
+            conmats[kind] = prec_to_partial(linalg.inv(cov))
+        elif kind in ["covariance", "tangent"]:
+            conmats[kind] = cov
+        else:
+            raise Exception("Connectivity kind not known {}".format(kind))
+    return conmats
+
+
+def _map_eigenvalues(func, mats):
+    # applies func to the eigenvalues of a stack of symmetric matrices (one batched eigendecomposition)
+    vals, vecs = np.linalg.eigh(mats)
+    return np.matmul(vecs * func(vals)[..., np.newaxis, :], np.swapaxes(vecs, -1, -2))
+
+
+def geometric_mean(covs, max_iter=30, tol=1e-7):
+    """
+    geometric (riemannian) mean of a stack of covariance matrices (n_sessions x n_rois x n_rois); same algorithm as
+    nilearn's ConnectivityMeasure(kind="tangent"), but with the per-subject matrix functions of each iteration
+    computed as one batched operation
+    """
+    gmean = covs.mean(axis=0)
+    norm_old, step = np.inf, 1.
+    for _ in range(max_iter):
+        gmean_inv_sqrt = _map_eigenvalues(lambda v: 1. / np.sqrt(v), gmean)
+        logs_mean = _map_eigenvalues(np.log, np.matmul(np.matmul(gmean_inv_sqrt, covs), gmean_inv_sqrt)).mean(axis=0)
+        if np.any(np.isnan(logs_mean)):
+            raise FloatingPointError("Nan value after logarithm operation.")
+        norm = np.linalg.norm(logs_mean)
+        gmean_sqrt = _map_eigenvalues(np.sqrt, gmean)
+        gmean = gmean_sqrt.dot(_map_eigenvalues(np.exp, logs_mean * step)).dot(gmean_sqrt)
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2.
+            norm = norm_old
+        if norm / gmean.size < tol:
+            break
+    else:
+        warnings.warn("Maximum number of iterations {} reached without getting to the requested tolerance "
+                      "level {}".format(max_iter, tol))
+    return gmean
+
+
+def tangent_projection(covs, gmean=None):
+    """
+    projects a stack of covariance matrices (n_sessions x n_rois x n_rois) into the tangent space at the group mean
+    (geometric mean of covs if gmean is None); one batched eigendecomposition per session
+    returns tangent matrices and gmean
+    """
+    if gmean is None:
+        gmean = geometric_mean(covs)
+    whitening = _map_eigenvalues(lambda v: 1. / np.sqrt(v), gmean)
+    whitened = np.matmul(np.matmul(whitening, covs), whitening)
+    return _map_eigenvalues(np.log, whitened), gmean
+
+
+def tangent_group(participant_dir, store_dir, output_dir):
+    """
+    group step of the tangent connectomes: collects the session covariances saved by participant_2_conmats
+    (*_cov.npy) of the sessions and parc/conf/spikereg variants in the connectome store, projects all sessions of each
+    variant at their geometric mean, and appends the tangent matrices to the connectome store (kind "tangent"). The
+    group means are saved to output_dir/parc-<parc>/<variant>_tangent_gmean.npy
+    Variants are skipped if the manifest of output_dir/parc-<parc> (see manifest.py) lists them as computed from the
+    same covariance files and the store has their tangent matrices, so unchanged variants are not appended to the
+    store again.
+    """
+    # imported here, as conmats imports this module
+    from conmats import _get_out_files
+    from conmat_store import append_conmat, compact_store, load_roi_names, load_store_meta, get_stored_keys
+    from manifest import load_manifest, is_up_to_date, record_outputs, atomic_output
+    parcs = sorted([d[len("parc-"):] for d in os.listdir(store_dir) if d.startswith("parc-")])
+    for parc in parcs:
+        # correlation is computed for all sessions and variants, so its rows list the available covariances
+        meta = load_store_meta(store_dir, parc)
+        meta = meta[meta.kind == "correlation"]
+        parc_out_dir = os.path.join(output_dir, "parc-{}".format(parc))
+        os.makedirs(parc_out_dir, exist_ok=True)
+        manifest, existing = load_manifest(parc_out_dir)
+        stored_keys = get_stored_keys(store_dir, parc)
+
+        for (conf, spikereg, censor), variant_meta in meta.groupby(["conf", "spikereg", "censor"]):
+            sessions = [(subject, session, _get_out_files(participant_dir, subject, session, conf, parc, spikereg,
+                                                          censor, kinds=["tangent"])[1]["cov"])
+                        for subject, session in variant_meta[["subject", "session"]].values]
+            sessions = [s for s in sessions if os.path.exists(s[2])]
+            if not sessions:
+                continue
+            key = "{}_{}_{}-{}_tangent".format(parc, conf, "censor" if censor else "spikereg", spikereg)
+            gmean_file = os.path.join(parc_out_dir, key + "_gmean.npy")
+            inputs = [f for _, _, f in sessions]
+            params = {"sessions": [[subject, session] for subject, session, _ in sessions]}
+            in_store = all((subject, session, conf, spikereg, censor, "tangent") in stored_keys
+                           for subject, session, _ in sessions)
+            if in_store and is_up_to_date(manifest, existing, key, [gmean_file], inputs, params, MANIFEST_VERSION):
+                print("*** Tangent space {} already computed. Do nothing. ***".format(key))
+                continue
+
+            print("*** Tangent space {} ({} sessions) ***".format(key, len(sessions)))
+            covs = np.stack([np.load(f) for f in inputs])
+            tangents, gmean = tangent_projection(covs)
+            roi_names = load_roi_names(store_dir, parc)
+            for (subject, session, _), tangent in zip(sessions, tangents):
+                append_conmat(store_dir, parc, roi_names, tangent, subject, session, conf, spikereg, censor=censor,
+                              kind="tangent")
+            with atomic_output(gmean_file) as tmp_file:
+                np.save(tmp_file, gmean)
+            record_outputs(parc_out_dir, key, [gmean_file], inputs, params, MANIFEST_VERSION)
+        # tangents of recomputed variants replace the earlier ones
+        compact_store(store_dir, parc)
+
+
+def test_get_connectivity():
+    from nilearn import connectome
+    rng = np.random.RandomState(0)
+    time_series = [rng.randn(100, 5) for _ in range(4)]
+    time_series = [(ts - ts.mean(0)) / ts.std(0) for ts in time_series]
+    conmats = [get_connectivity(ts, KINDS) for ts in time_series]
+    for kind in ["correlation", "partial correlation", "covariance"]:
+        expected = connectome.ConnectivityMeasure(kind=kind).fit_transform(time_series)
+        for i, c in enumerate(conmats):
+            assert np.allclose(c[kind.replace(" ", "_")], expected[i]), "{} differs".format(kind)
+
+    measure = connectome.ConnectivityMeasure(kind="tangent")
+    expected = measure.fit_transform(time_series)
+    tangents, gmean = tangent_projection(np.stack([c["tangent"] for c in conmats]))
+    assert np.allclose(gmean, measure.mean_)
+    assert np.allclose(tangents, expected)
+
+    # unstandardized time series: all kinds but correlation are the same
+    time_series = [ts * rng.rand(5) * 10 + 3 for ts in time_series]
+    conmats = [get_connectivity(ts, KINDS) for ts in time_series]
+    for kind in ["partial correlation", "covariance"]:
+        expected = connectome.ConnectivityMeasure(kind=kind).fit_transform(time_series)
+        for i, c in enumerate(conmats):
+            assert np.allclose(c[kind.replace(" ", "_")], expected[i]), "{} differs".format(kind)
+    expected = connectome.ConnectivityMeasure(kind="tangent").fit_transform(time_series)
+    assert np.allclose(tangent_projection(np.stack([c["tangent"] for c in conmats]))[0], expected)
+    expected = connectome.ConnectivityMeasure(kind="correlation").fit_transform(time_series)
+    assert not np.allclose(conmats[0]["correlation"], expected[0])
+
+
+def test_tangent_group():
+    from tempfile import TemporaryDirectory
+    from conmats import _get_out_files
+    from conmat_store import append_conmat, load_connectomes, matrix_to_edges
+    rng = np.random.RandomState(0)
+    roi_names = ["r1", "r2", "r3", "r4"]
+    with TemporaryDirectory() as tmp_dir:
+        participant_dir, store_dir = os.path.join(tmp_dir, "participant"), os.path.join(tmp_dir, "store")
+        output_dir = os.path.join(tmp_dir, "group")
+        covs, correlations = {}, {}
+        for subject in ["01", "02", "03"]:
+            for spikereg in [None, 0.5]:
+                ts = rng.randn(50, 4)
+                covs[subject, spikereg] = get_connectivity(ts, ["covariance"])["covariance"]
+                cov_file = _get_out_files(participant_dir, subject, "1", "36P", "test", spikereg,
+                                          kinds=["tangent"])[1]["cov"]
+                os.makedirs(os.path.dirname(cov_file), exist_ok=True)
+                np.save(cov_file, covs[subject, spikereg])
+                correlations[subject, spikereg] = np.corrcoef(ts.T)
+                append_conmat(store_dir, "test", roi_names, correlations[subject, spikereg], subject, "1", "36P",
+                              spikereg)
+
+        tangent_group(participant_dir, store_dir, output_dir)
+        edges_file = os.path.join(store_dir, "parc-test", "edges.dat")
+        size = os.path.getsize(edges_file)
+        for spikereg in [None, 0.5]:
+            expected, _ = tangent_projection(np.stack([covs[s, spikereg] for s in ["01", "02", "03"]]))
+            edges, meta = load_connectomes(store_dir, "test", "36P", spikereg, kind="tangent")
+            assert meta.subject.tolist() == ["01", "02", "03"]
+            assert np.allclose(edges[meta.row.values], [matrix_to_edges(m) for m in expected], atol=1e-6)
+
+        # unchanged covariances: nothing is recomputed or appended
+        tangent_group(participant_dir, store_dir, output_dir)
+        assert os.path.getsize(edges_file) == size, "tangents appended again"
+
+        # a new store without the tangents (e.g., rebuilt by participant_2_conmats) gets them, although the manifest
+        # of output_dir is up to date
+        new_store_dir = os.path.join(tmp_dir, "new_store")
+        for subject, spikereg in correlations:
+            append_conmat(new_store_dir, "test", roi_names, correlations[subject, spikereg], subject, "1", "36P",
+                          spikereg)
+        tangent_group(participant_dir, new_store_dir, output_dir)
+        for spikereg in [None, 0.5]:
+            _, meta = load_connectomes(new_store_dir, "test", "36P", spikereg, kind="tangent")
+            assert meta.subject.tolist() == ["01", "02", "03"], "tangents missing in the new store"
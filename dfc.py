@@ -0,0 +1,75 @@
+import numpy as np
+
+TAPERS = ["rectangular", "hamming", "hann"]
+
+
+def get_window_starts(n_vols, width, step):
+    return np.arange(0, n_vols - width + 1, step)
+
+
+def _window_sums(x, starts, width, taper):
+    # (weighted) sums of the rows of x in each window
+    if taper == "rectangular":
+        # running sums: each window is the difference of two cumulative sums
+        cs = np.zeros((len(x) + 1, x.shape[1]))
+        np.cumsum(x, axis=0, out=cs[1:])
+        return cs[starts + width] - cs[starts]
+    else:
+        # the weights differ within a window, so the windows are applied as one (n_windows x n_vols) matrix product
+        from scipy.signal import get_window
+        weights = np.zeros((len(starts), len(x)))
+        taper_weights = get_window(taper, width, fftbins=False)
+        for i, start in enumerate(starts):
+            weights[i, start:start + width] = taper_weights
+        return weights.dot(x)
+
+
+def sliding_window_correlation(time_series, width, step=1, taper="rectangular", block_size=20000):
+    """
+    dynamic connectivity: correlation matrices in sliding windows of width volumes, moved by step volumes
+    time_series: cleaned parcel time series (n_vols x n_rois)
+    taper: "rectangular" or a tapered window ("hamming", "hann"); with a taper, volumes are weighted within each
+    window (weighted correlation)
+    Windowed sums of x and of the edge products x_i * x_j are computed for all windows at once (cumulative sums for
+    rectangular windows), so the cost does not grow with width. Edges are processed in blocks of block_size.
+    returns (n_windows x n_edges) float32 array of (unshrunk) correlations (edge order as
+    conmat_store.matrix_to_edges) and the window start volumes
+    """
+    if taper not in TAPERS:
+        raise Exception("Taper not known {}".format(taper))
+    x = np.asarray(time_series, dtype=np.float64)
+    n_vols, n_rois = x.shape
+    if width > n_vols:
+        raise Exception("Window width {} larger than number of volumes {}".format(width, n_vols))
+    starts = get_window_starts(n_vols, width, step)
+    sum_w = _window_sums(np.ones((n_vols, 1)), starts, width, taper)
+
+    mean = _window_sums(x, starts, width, taper) / sum_w
+    var = _window_sums(x ** 2, starts, width, taper) / sum_w - mean ** 2
+    sd = np.sqrt(np.maximum(var, 0))
+
+    iu = np.triu_indices(n_rois, 1)
+    dfc = np.empty((len(starts), len(iu[0])), dtype=np.float32)
+    for block_start in range(0, len(iu[0]), block_size):
+        i = iu[0][block_start:block_start + block_size]
+        j = iu[1][block_start:block_start + block_size]
+        cov = _window_sums(x[:, i] * x[:, j], starts, width, taper) / sum_w - mean[:, i] * mean[:, j]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dfc[:, block_start:block_start + block_size] = cov / (sd[:, i] * sd[:, j])
+    return dfc, starts
+
+
+def test_sliding_window_correlation():
+    from scipy.signal import get_window
+    rng = np.random.RandomState(0)
+    ts = rng.randn(100, 6)
+    iu = np.triu_indices(6, 1)
+    for taper in TAPERS:
+        dfc, starts = sliding_window_correlation(ts, 20, 7, taper, block_size=4)
+        assert dfc.shape == (len(starts), 15) and dfc.dtype == np.float32
+        assert starts[-1] == 77
+        weights = get_window(taper, 20, fftbins=False) if taper != "rectangular" else None
+        for w, start in enumerate(starts):
+            expected = np.cov(ts[start:start + 20].T, aweights=weights)
+            expected = expected / np.sqrt(np.outer(np.diag(expected), np.diag(expected)))
+            assert np.allclose(dfc[w], expected[iu], atol=1e-5), "window {} differs for {}".format(w, taper)
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import socket
+import resource
+import functools
+import inspect
+from glob import glob
+from contextlib import contextmanager
+
+# processing stages of the participant and group jobs
+STAGES = ["discover", "confounds", "load", "mask", "clean", "mask_clean", "correlate", "aggregate", "write", "plot"]
+# directory the records are written to (one json lines file per process); set by run.py, inherited by the workers
+TELEMETRY_ENV = "RS_TELEMETRY_DIR"
+KEY_COLS = ["job", "subject", "session", "parc", "conf", "spikereg"]
+
+# records of this process, kept only if they are not written to RS_TELEMETRY_DIR (in-process use, e.g. tests and
+# benchmark.py, which collect them with get_stage_times); pool workers run many jobs and would accumulate them
+_records = []
+# keys of the running job (see job_context), added to all records
+_context = {}
+# peak RSS of the enclosing open blocks (e.g., the job of a stage) before their high-water mark was reset by a nested
+# block (see _measure)
+_open_peaks = []
+
+
+def _read_bytes():
+    # bytes read by this process with read syscalls (/proc/self/io rchar; includes page cache hits, but not
+    # memory-mapped files)
+    try:
+        with open("/proc/self/io") as fi:
+            for line in fi:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _peak_rss_mb():
+    # peak RSS since the last reset (see _reset_peak_rss)
+    try:
+        with open("/proc/self/status") as fi:
+            for line in fi:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _reset_peak_rss():
+    # resetting the high-water mark gives the peak of each block (linux only); the peak so far is kept for the
+    # enclosing blocks
+    peak = _peak_rss_mb()
+    _open_peaks[:] = [max(p, peak) for p in _open_peaks]
+    try:
+        with open("/proc/self/clear_refs", "w") as fi:
+            fi.write("5")
+    except OSError:
+        pass
+
+
+def _write_record(record):
+    telemetry_dir = os.environ.get(TELEMETRY_ENV)
+    if telemetry_dir:
+        out_file = os.path.join(telemetry_dir, "telemetry_{}_{}.jsonl".format(socket.gethostname(), os.getpid()))
+        with open(out_file, "a") as fi:
+            fi.write(json.dumps(record, default=str) + "\n")
+    else:
+        _records.append(record)
+
+
+@contextmanager
+def _measure(record_type, keys):
+    _reset_peak_rss()
+    _open_peaks.append(0.)
+    start_wall, start_cpu, start_read = time.perf_counter(), time.process_time(), _read_bytes()
+    try:
+        yield
+    finally:
+        record = dict(_context, **keys)
+        record.update({"type": record_type, "wall_time": time.perf_counter() - start_wall,
+                       "cpu_time": time.process_time() - start_cpu, "read_bytes": _read_bytes() - start_read,
+                       "peak_rss_mb": max(_open_peaks.pop(), _peak_rss_mb()), "pid": os.getpid()})
+        _write_record(record)
+
+
+@contextmanager
+def timed(stage, **keys):
+    """
+    records wall time, cpu time (of all threads of the process), bytes read and peak RSS (within the block) of the
+    block as stage (see STAGES)
+    keys: e.g. parc, conf, spikereg; added to the keys of the job (see job_context)
+    mask_clean: nilearn maskers that mask and clean in one call
+    If the environment variable RS_TELEMETRY_DIR is set, records are written as json lines to
+    telemetry_<host>_<pid>.jsonl in that directory (see load_telemetry); otherwise they are kept in memory (see
+    get_stage_times).
+    """
+    with _measure("stage", dict(keys, stage=stage)):
+        yield
+
+
+@contextmanager
+def keys_context(**keys):
+    """
+    adds keys (e.g. parc, conf, spikereg of one variant) to all records in the block
+    """
+    old_context = dict(_context)
+    _context.update(keys)
+    try:
+        yield
+    finally:
+        _context.clear()
+        _context.update(old_context)
+
+
+@contextmanager
+def job_context(job, **keys):
+    """
+    adds job (e.g. "conmats") and keys (e.g. subject, session) to all records in the block and records the block as
+    a whole (type "job")
+    """
+    with keys_context(job=job, **keys):
+        with _measure("job", {}):
+            yield
+
+
+def job(name, **arg_names):
+    """
+    decorator: runs the function as job name (see job_context) with keys taken from its arguments, e.g.
+    @job("conmat", subject="subject", session="session", spikereg="spikereg_threshold")
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with job_context(name, **{k: bound.arguments[a] for k, a in arg_names.items()}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_stage_times(reset=True):
+    """
+    returns dict {stage: summed wall time} of the stages recorded in memory by this process (i.e., without
+    RS_TELEMETRY_DIR, see timed)
+    reset: start a new collection
+    """
+    stage_times = {}
+    for record in _records:
+        if record["type"] == "stage":
+            stage_times[record["stage"]] = stage_times.get(record["stage"], 0.) + record["wall_time"]
+    if reset:
+        del _records[:]
+    return stage_times
+
+
+def get_max_peak_rss_mb():
+    # peak RSS of all records of this process kept in memory
+    return max([r["peak_rss_mb"] for r in _records] + [_peak_rss_mb()])
+
+
+def load_telemetry(telemetry_dir):
+    """
+    returns the records of all processes in telemetry_dir as data frame (one row per stage or job)
+    """
+    import pandas as pd
+    records = []
+    for telemetry_file in sorted(glob(os.path.join(telemetry_dir, "telemetry_*.jsonl"))):
+        with open(telemetry_file) as fi:
+            records += [json.loads(line) for line in fi if line.endswith("\n")]
+    df = pd.DataFrame(records)
+    for c in KEY_COLS + ["stage"]:
+        if c not in df.columns:
+            df[c] = None
+    return df
+
+
+def summarize_telemetry(telemetry_dir, n_top=10):
+    """
+    returns report (string) of the records in telemetry_dir:
+    * per stage: number of calls, summed wall and cpu time, MB read and max. peak RSS
+    * the n_top slowest jobs and stages with their keys
+    """
+    import pandas as pd
+    df = load_telemetry(telemetry_dir)
+    if df.empty:
+        return "No telemetry records in {}\n".format(telemetry_dir)
+    df["read_mb"] = df.read_bytes / 1024. ** 2
+    stages = df[df.type == "stage"]
+    jobs = df[df.type == "job"]
+    metric_cols = ["wall_time", "cpu_time", "read_mb", "peak_rss_mb"]
+    with pd.option_context("display.width", 200, "display.max_columns", 20):
+        report = "Stages\n"
+        per_stage = stages.groupby("stage").agg(n=("wall_time", "size"), wall_time=("wall_time", "sum"),
+                                                cpu_time=("cpu_time", "sum"), read_mb=("read_mb", "sum"),
+                                                peak_rss_mb=("peak_rss_mb", "max"))
+        report += per_stage.sort_values("wall_time", ascending=False).round(2).to_string() + "\n\n"
+        if not jobs.empty:
+            report += "Slowest jobs\n"
+            job_cols = [c for c in KEY_COLS if jobs[c].notnull().any()]
+            report += jobs.nlargest(n_top, "wall_time")[job_cols + metric_cols].round(2).to_string(index=False)
+            report += "\n\n"
+        report += "Slowest stages\n"
+        stage_cols = [c for c in KEY_COLS if stages[c].notnull().any()] + ["stage"]
+        report += stages.nlargest(n_top, "wall_time")[stage_cols + metric_cols].round(2).to_string(index=False)
+    return report + "\n"
+
+
+def test_timed():
+    from tempfile import TemporaryDirectory
+    import numpy as np
+    get_stage_times()
+
+    def run_jobs():
+        for session in ["1", "2"]:
+            with job_context("test", subject="01", session=session):
+                with timed("load"):
+                    time.sleep(0.01)
+                try:
+                    with keys_context(parc="p", conf="36P", spikereg=None), timed("write"):
+                        raise IOError
+                except IOError:
+                    pass
+
+    with TemporaryDirectory() as telemetry_dir:
+        os.environ[TELEMETRY_ENV] = telemetry_dir
+        try:
+            run_jobs()
+        finally:
+            del os.environ[TELEMETRY_ENV]
+        assert _records == [], "records written to the telemetry dir are kept in memory"
+
+        df = load_telemetry(telemetry_dir)
+        assert len(df) == 6 and (df.type == "job").sum() == 2
+        assert df[df.stage == "write"][["job", "subject", "session", "parc"]].values.tolist() == \
+            [["test", "01", "1", "p"], ["test", "01", "2", "p"]]
+        assert (df.peak_rss_mb > 0).all() and (df.read_bytes >= 0).all()
+        report = summarize_telemetry(telemetry_dir)
+        assert "Slowest jobs" in report and "load" in report
+
+    # without telemetry dir the records are kept in memory
+    run_jobs()
+    stage_times = get_stage_times()
+    assert sorted(stage_times) == ["load", "write"]
+    assert stage_times["load"] >= 0.02
+    assert get_stage_times() == {}
+
+    # peak RSS per stage: a cheap stage after a heavy one reports its own peak, the job the peak of both
+    with job_context("test"):
+        with timed("clean"):
+            data = np.ones(25 * 1024 ** 2)
+            del data
+        with timed("write"):
+            pass
+    clean, write, job_record = _records[-3:]
+    assert clean["peak_rss_mb"] - write["peak_rss_mb"] > 100, "stage peak not reset"
+    assert job_record["peak_rss_mb"] >= clean["peak_rss_mb"] and _open_peaks == []
+    get_stage_times()
+
+    @job("test_job", subject="subject", spikereg="spikereg_threshold")
+    def test_job(subject, spikereg_threshold=None):
+        with timed("correlate"):
+            return dict(_context)
+
+    assert test_job("01") == {"job": "test_job", "subject": "01", "spikereg": None}
+    assert _context == {} and get_stage_times(reset=False).keys() == {"correlate"}
+    assert [r["type"] for r in _records] == ["stage", "job"]
+    get_stage_times()
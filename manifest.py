@@ -0,0 +1,138 @@
+import os
+import json
+import fcntl
+from contextlib import contextmanager
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+def file_signature(path):
+    # size and mtime; hashing the (multi-GB) rs files would cost more than most stages
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def _normalize(obj):
+    # json round trip, so tuples, numpy scalars and paths compare equal to the values read from the manifest
+    return json.loads(json.dumps(obj, sort_keys=True, default=str))
+
+
+def _get_input_signatures(inputs):
+    return {f: file_signature(f) for f in sorted(set(inputs)) if f}
+
+
+def load_manifest(output_dir):
+    """
+    reads the manifest of output_dir (output_dir/manifest.jsonl)
+    returns {key: entry} with the latest entry per key and the set of files in output_dir (one directory listing, so
+    checking outputs needs no stat per file)
+    """
+    manifest = {}
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE)) as fi:
+            for line in fi:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written line of a crashed job
+                    continue
+                manifest[entry["key"]] = entry
+        existing = set(os.listdir(output_dir))
+    except FileNotFoundError:
+        existing = set()
+    return manifest, existing
+
+
+def is_up_to_date(manifest, existing, key, out_files, inputs, params, version):
+    """
+    True if the manifest has an entry for key that was computed from the same inputs (size, mtime), params and
+    version, and all out_files (in the directory of the manifest) exist
+    manifest, existing: see load_manifest
+    """
+    entry = manifest.get(key)
+    if entry is None or entry["version"] != version or entry["params"] != _normalize(params):
+        return False
+    if not all(os.path.basename(f) in existing for f in out_files):
+        return False
+    try:
+        return entry["inputs"] == _normalize(_get_input_signatures(inputs))
+    except FileNotFoundError:
+        return False
+
+
+def record_outputs(output_dir, key, out_files, inputs, params, version):
+    """
+    appends the provenance of the outputs of key (input file signatures, params, version) to the manifest of
+    output_dir. Call after all out_files are written (see atomic_output), so an entry means the outputs are complete.
+    Appends are serialized with a lock file, so parallel jobs can share one manifest.
+    """
+    entry = {"key": key, "outputs": sorted(os.path.basename(f) for f in out_files),
+             "inputs": _get_input_signatures(inputs), "params": params, "version": version}
+    line = json.dumps(_normalize(entry)) + "\n"
+    with open(os.path.join(output_dir, "." + MANIFEST_FILE + ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(os.path.join(output_dir, MANIFEST_FILE), "ab+") as fi:
+            size = fi.seek(0, os.SEEK_END)
+            if size:
+                # terminate a partially written line of a crashed job
+                fi.seek(size - 1)
+                if fi.read(1) != b"\n":
+                    line = "\n" + line
+            fi.write(line.encode())
+
+
+@contextmanager
+def atomic_output(out_file):
+    """
+    yields a temporary file name in the directory of out_file (with the same extension) that is renamed to out_file
+    when the block finishes; out_file is never partially written
+    """
+    tmp_file = os.path.join(os.path.dirname(out_file), ".tmp{}_{}".format(os.getpid(), os.path.basename(out_file)))
+    try:
+        yield tmp_file
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def test_manifest():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as tmp_dir:
+        in_file = os.path.join(tmp_dir, "in.txt")
+        out_file = os.path.join(tmp_dir, "out.txt")
+        with open(in_file, "w") as fi:
+            fi.write("a")
+        params = {"conf": "36P", "spikereg_threshold": None, "pars": (1, 2)}
+
+        manifest, existing = load_manifest(tmp_dir)
+        assert not is_up_to_date(manifest, existing, "k", [out_file], [in_file], params, 1)
+        with atomic_output(out_file) as tmp_file:
+            with open(tmp_file, "w") as fi:
+                fi.write("b")
+        record_outputs(tmp_dir, "k", [out_file], [in_file], params, 1)
+        manifest, existing = load_manifest(tmp_dir)
+        assert is_up_to_date(manifest, existing, "k", [out_file], [in_file], params, 1)
+        assert not is_up_to_date(manifest, existing, "k", [out_file], [in_file], dict(params, conf="9P"), 1)
+        assert not is_up_to_date(manifest, existing, "k", [out_file], [in_file], params, 2)
+
+        # changed input
+        with open(in_file, "w") as fi:
+            fi.write("aa")
+        assert not is_up_to_date(manifest, existing, "k", [out_file], [in_file], params, 1)
+
+        # partial line of a crashed job is skipped, later entries are kept
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), "a") as fi:
+            fi.write('{"key": "k", "outp')
+        record_outputs(tmp_dir, "k", [out_file], [in_file], params, 1)
+        manifest, existing = load_manifest(tmp_dir)
+        assert is_up_to_date(manifest, existing, "k", [out_file], [in_file], params, 1)
+
+        # failed write leaves neither the output nor the temporary file
+        try:
+            with atomic_output(os.path.join(tmp_dir, "failed.txt")) as tmp_file:
+                open(tmp_file, "w").close()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert sorted(os.listdir(tmp_dir)) == [".manifest.jsonl.lock", "in.txt", MANIFEST_FILE, "out.txt"]
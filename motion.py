@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from utils import get_confounds_file
+
+FD_COLUMN = "FramewiseDisplacement"
+# optional columns of the fmriprep confounds file that can be collected in addition to FD
+EXTRA_COLUMNS = {"dvars": ["stdDVARS"],
+                 "motion_params": ["X", "Y", "Z", "RotX", "RotY", "RotZ"]}
+
+
+def read_motion_ts(confounds_file, columns=(FD_COLUMN,)):
+    """
+    returns the columns of a fmriprep confounds file as data frame; the other columns are not parsed
+    """
+    return pd.read_csv(confounds_file, sep="\t", usecols=list(columns), dtype=np.float64)[list(columns)]
+
+
+def _categorical(values, n_rows):
+    # categorical column with one value per session, repeated for the rows of each session
+    categories = sorted(set(values))
+    codes = pd.Index(categories).get_indexer(values)
+    return pd.Categorical.from_codes(np.repeat(codes, n_rows), categories)
+
+
+def get_motion_summary(motion_dfs, subjects_sessions, spikereg_thresh_list):
+    """
+    returns data frame with one row per session: subject, session, n_tr, mean and max FD and the number of outlier
+    volumes (FD > threshold, as in utils.get_spikereg_confounds) for each threshold in spikereg_thresh_list
+    """
+    summary = pd.DataFrame(subjects_sessions, columns=["subject", "session"])
+    summary["n_tr"] = [len(df) for df in motion_dfs]
+    summary["mean_fd"] = [df[FD_COLUMN].mean() for df in motion_dfs]
+    summary["max_fd"] = [df[FD_COLUMN].max() for df in motion_dfs]
+    for threshold in spikereg_thresh_list:
+        if threshold:
+            summary["n_outliers_fd{}".format(threshold)] = [int((df[FD_COLUMN] > threshold).sum())
+                                                            for df in motion_dfs]
+    return summary
+
+
+def collect_motion(subjects_sessions, fmriprep_dir, output_dir, spikereg_thresh_list, extra_columns=(), n_jobs=1,
+                   layout=None):
+    """
+    collects the FD time series (and the extra_columns groups, see EXTRA_COLUMNS) of all sessions into
+    * output_dir/group_motion_ts.feather: one row per volume with subject and session as categoricals, tr (int32) and
+      the motion columns (float32)
+    * output_dir/group_motion_summary.tsv: one row per session (see get_motion_summary)
+    Only the confounds files are looked up and only the motion columns are parsed; the files are read in a pool of
+    n_jobs threads.
+    layout: fmriprep layout index (see utils.get_layout)
+    """
+    columns = [FD_COLUMN] + [c for extra in extra_columns for c in EXTRA_COLUMNS[extra]]
+
+    def read(subject_session):
+        return read_motion_ts(get_confounds_file(fmriprep_dir, *subject_session, layout=layout), columns)
+
+    print("*** Collecting motion of {} sessions ***".format(len(subjects_sessions)))
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        motion_dfs = list(executor.map(read, subjects_sessions))
+
+    # outliers are counted on the float64 values, like in the spike regression
+    summary = get_motion_summary(motion_dfs, subjects_sessions, spikereg_thresh_list)
+
+    n_rows = [len(df) for df in motion_dfs]
+    motion_df = pd.concat(motion_dfs, ignore_index=True).astype(np.float32)
+    motion_df.insert(0, "subject", _categorical([s[0] for s in subjects_sessions], n_rows))
+    motion_df.insert(1, "session", _categorical([s[1] for s in subjects_sessions], n_rows))
+    motion_df.insert(2, "tr", np.concatenate([np.arange(n, dtype=np.int32) for n in n_rows]))
+
+    os.makedirs(output_dir, exist_ok=True)
+    motion_df.to_feather(os.path.join(output_dir, "group_motion_ts.feather"))
+    summary.to_csv(os.path.join(output_dir, "group_motion_summary.tsv"), sep="\t", index=False)
+    return motion_df, summary
+
+
+def test_collect_motion():
+    from tempfile import TemporaryDirectory
+    import shutil
+    from utils import get_spikereg_confounds, get_motion_ts_one_subject
+    confounds_file = "test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv"
+    subjects_sessions = [("02", "1"), ("01", "1"), ("01", "2")]
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        for subject, session in subjects_sessions:
+            func_dir = os.path.join(fmriprep_dir, "sub-" + subject, "ses-" + session, "func")
+            os.makedirs(func_dir)
+            shutil.copy(confounds_file, os.path.join(
+                func_dir, "sub-{}_ses-{}_task-rest_run-1_bold_confounds.tsv".format(subject, session)))
+
+        output_dir = os.path.join(tmp_dir, "out")
+        collect_motion(subjects_sessions, fmriprep_dir, output_dir, [None, 0.2], ["dvars"], n_jobs=2)
+        motion_df = pd.read_feather(os.path.join(output_dir, "group_motion_ts.feather"))
+        assert motion_df.subject.dtype.name == "category" and motion_df.session.dtype.name == "category"
+        assert motion_df[FD_COLUMN].dtype == np.float32
+        assert motion_df.columns.tolist() == ["subject", "session", "tr", FD_COLUMN, "stdDVARS"]
+
+        fd = get_motion_ts_one_subject("01", "2", fmriprep_dir)[FD_COLUMN].values
+        session_df = motion_df[(motion_df.subject == "01") & (motion_df.session == "2")]
+        assert np.array_equal(session_df.tr, np.arange(len(fd)))
+        assert np.allclose(session_df[FD_COLUMN], fd, equal_nan=True)
+
+        summary = pd.read_csv(os.path.join(output_dir, "group_motion_summary.tsv"), sep="\t",
+                              dtype={"subject": str, "session": str})
+        _, outlier_stats = get_spikereg_confounds(fd, 0.2)
+        assert summary.n_tr.tolist() == [len(fd)] * 3
+        assert summary["n_outliers_fd0.2"].tolist() == [outlier_stats.loc[outlier_stats.outlier, "n_tr"].sum()] * 3
+        assert np.allclose(summary.mean_fd, np.nanmean(fd))
+
+
+def test_collect_motion_imports():
+    # the motion level (run.py and motion.py) runs without nilearn, sklearn and matplotlib
+    import sys
+    import json
+    import subprocess
+    code = "import sys, json, run, motion; print(json.dumps([m.split('.')[0] for m in sys.modules]))"
+    modules = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert not {"nilearn", "sklearn", "matplotlib"} & set(json.loads(modules))
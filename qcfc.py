@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.spatial.distance import pdist
+from utils import get_motion_ts_one_subject
+from atlases import get_roi_info, get_roi_centroids, DEFAULT_REGISTRY_DIR
+from conmat_store import load_store_meta, load_connectomes, VARIANT_COLS
+
+
+def _zscore_cols(x):
+    x = x - x.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return x / np.sqrt((x ** 2).mean(axis=0))
+
+
+def _rank_cols(x):
+    return stats.rankdata(x, axis=0)
+
+
+def get_mean_fd(subjects_sessions, fmriprep_dir, layout=None):
+    """
+    returns data frame with subject, session and mean FD
+    """
+    mean_fd = []
+    for subject, session in subjects_sessions:
+        motion_df = get_motion_ts_one_subject(subject, session, fmriprep_dir, layout)
+        mean_fd.append([subject, session, motion_df["FramewiseDisplacement"].mean()])
+    return pd.DataFrame(mean_fd, columns=["subject", "session", "mean_fd"])
+
+
+def qcfc(edges, mean_fd):
+    """
+    QC-FC: correlation across subjects between mean FD and each edge, for all edges with one matrix product
+    edges: (n_subjects x n_edges)
+    mean_fd: (n_subjects)
+    returns r and two-sided p (each n_edges)
+    """
+    n = len(mean_fd)
+    r = _zscore_cols(np.asarray(mean_fd, dtype=np.float64)).dot(_zscore_cols(edges.astype(np.float64))) / n
+    r = np.clip(r, -1, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt((n - 2) / (1 - r ** 2))
+    p = 2 * stats.t.sf(np.abs(t), n - 2)
+    return r, p
+
+
+def _fdr(p):
+    # Benjamini-Hochberg adjusted p values
+    order = np.argsort(p)
+    adjusted = p[order] * len(p) / np.arange(1, len(p) + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    out = np.empty_like(adjusted)
+    out[order] = np.minimum(adjusted, 1)
+    return out
+
+
+def qcfc_summary(edges, mean_fd, distances):
+    """
+    summary measures of one variant
+    * median_abs_qcfc: median absolute QC-FC correlation across edges
+    * pct_sig_edges/pct_sig_edges_fdr: % edges with significant QC-FC (p < 0.05 uncorrected/FDR corrected)
+    * qcfc_dist_rho: spearman correlation of QC-FC and roi distance across edges (distance dependence)
+    """
+    r, p = qcfc(edges, mean_fd)
+    valid = np.isfinite(r)
+    r, p, distances = r[valid], p[valid], distances[valid]
+    rho = (_zscore_cols(_rank_cols(r)) * _zscore_cols(_rank_cols(distances))).mean()
+    return {"n_subjects": len(mean_fd), "mean_fd": np.mean(mean_fd), "median_abs_qcfc": np.median(np.abs(r)),
+            "pct_sig_edges": 100 * (p < 0.05).mean(), "pct_sig_edges_fdr": 100 * (_fdr(p) < 0.05).mean(),
+            "qcfc_dist_rho": rho}
+
+
+def qcfc_group(store_dir, output_dir, fmriprep_dir, subjects=None, registry_dir=DEFAULT_REGISTRY_DIR, layout=None):
+    """
+    QC-FC benchmark of all variants (parc/conf/spikereg/censor/kind) in the connectome store (see conmat_store), per
+    session. Writes output_dir/qcfc_summary.tsv with one row per variant and session (see qcfc_summary).
+    subjects: list of subjects to restrict to
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    parcs = sorted([d[len("parc-"):] for d in os.listdir(store_dir) if d.startswith("parc-")])
+    metas = {parc: load_store_meta(store_dir, parc) for parc in parcs}
+
+    # mean FD is read once for all sessions in the store
+    subjects_sessions = pd.concat(metas.values())[["subject", "session"]].drop_duplicates()
+    if subjects is not None:
+        subjects_sessions = subjects_sessions[subjects_sessions.subject.isin(subjects)]
+    subjects_sessions = subjects_sessions.values.tolist()
+    mean_fd = get_mean_fd(subjects_sessions, fmriprep_dir, layout).set_index(["subject", "session"])
+
+    summary = []
+    for parc, meta in metas.items():
+        roi_file, roi_names, roi_type = get_roi_info(parc, registry_dir)
+        distances = pdist(get_roi_centroids(roi_file, roi_type))
+
+        for conf, spikereg, censor, kind in meta[VARIANT_COLS].drop_duplicates().values:
+            edges, variant_meta = load_connectomes(store_dir, parc, conf, spikereg, subjects, censor, kind)
+            for session in sorted(variant_meta.session.unique()):
+                rows = variant_meta.index[variant_meta.session == session].values
+                if len(rows) < 3:
+                    continue
+                fd = mean_fd.loc[list(zip(variant_meta.subject[rows], variant_meta.session[rows])), "mean_fd"].values
+                print("*** QC-FC {} {} {} {} {} ses-{} ***".format(parc, conf, "censor" if censor else "spikereg",
+                                                                   spikereg, kind, session))
+                summary.append(dict(parc=parc, conf=conf, spikereg=spikereg, censor=censor, kind=kind,
+                                    session=session,
+                                    **qcfc_summary(edges[variant_meta.row.values[rows]], fd, distances)))
+
+    summary = pd.DataFrame(summary)
+    summary.to_csv(os.path.join(output_dir, "qcfc_summary.tsv"), sep="\t", index=False)
+    return summary
+
+
+def test_qcfc():
+    rng = np.random.RandomState(0)
+    mean_fd = rng.rand(30)
+    edges = rng.randn(30, 10)
+    edges[:, 0] += 5 * mean_fd
+    r, p = qcfc(edges, mean_fd)
+    for i in range(10):
+        expected = stats.pearsonr(mean_fd, edges[:, i])
+        assert np.allclose([r[i], p[i]], expected)
+
+    distances = rng.rand(10)
+    summary = qcfc_summary(edges, mean_fd, distances)
+    assert np.isclose(summary["qcfc_dist_rho"], stats.spearmanr(r, distances)[0])
+    assert summary["pct_sig_edges"] >= 10
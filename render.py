@@ -0,0 +1,210 @@
+import os
+import re
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import matplotlib
+
+matplotlib.use('Agg')
+from matplotlib import pyplot as plt
+
+# figures of a render worker; created once per process and reused for all plots
+_FIGURES = {}
+
+SHEET_SIZE = 100
+
+
+def _get_figure(kind):
+    if kind not in _FIGURES:
+        figsize = {"conmat": (9, 7), "stat_map": (7.3, 3.5)}[kind]
+        _FIGURES[kind] = plt.figure(figsize=figsize)
+    return _FIGURES[kind]
+
+
+def _parse_sbc_report(report_file):
+    # seed coordinates (or mask) and background image of an sbc map from its report
+    info = {}
+    with open(report_file) as fi:
+        for line in fi:
+            if ": " in line:
+                k, v = line.rstrip("\n").split(": ", 1)
+                info.setdefault(k, v)
+    return info
+
+
+def _render_conmat(tsv_file, png_file, title):
+    from conmats import plot_conmat
+    conmat_df = pd.read_csv(tsv_file, sep="\t", index_col=0)
+    plot_conmat(conmat_df.values, conmat_df.index.tolist(), title, png_file, figure=_get_figure("conmat"))
+
+
+def _render_sbc(nii_file, png_file, title, report_file=None):
+    from sbc import plot_sbc_map, PCC_COORDS
+    from nilearn import plotting
+    bg_img, threshold, seed_coords = None, 0.5, PCC_COORDS
+    if report_file:
+        info = _parse_sbc_report(report_file)
+        bg_img = info.get("anat_file")
+        if "seed coords" in info:
+            seed_coords = tuple(float(c) for c in info["seed coords"].strip("()").split(","))
+        else:
+            seed_coords = tuple(plotting.find_xyz_cut_coords(info["seed mask"]))
+    elif "_sd_" in os.path.basename(nii_file):
+        threshold = 1e-6
+    plot_sbc_map(nii_file, seed_coords, title, png_file, bg_img, threshold, figure=_get_figure("stat_map"))
+
+
+def _thumbnail_conmat(tsv_file):
+    conmat = pd.read_csv(tsv_file, sep="\t", index_col=0).values
+    step = int(np.ceil(len(conmat) / 100.))
+    return conmat[::step, ::step]
+
+
+def _thumbnail_sbc(nii_file, z=None):
+    data = np.asarray(nb.load(nii_file).dataobj)
+    if z is None:
+        z = np.unravel_index(np.nanargmax(data), data.shape)[2]
+    return np.rot90(data[::2, ::2, z]), z
+
+
+def _render_contact_sheet(kind, files, labels, png_file, title):
+    """
+    one image with downsampled versions of many outputs: conmats (kind "conmat") or an axial slice (through the peak
+    of the first map) of sbc maps (kind "sbc")
+    """
+    n_cols = 10
+    n_rows = int(np.ceil(len(files) / float(n_cols)))
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(n_cols * 1.5, n_rows * 1.6 + 0.5), squeeze=False)
+    z = None
+    for ax in axes.flat:
+        ax.axis("off")
+    for ax, f, label in zip(axes.flat, files, labels):
+        if kind == "conmat":
+            ax.imshow(_thumbnail_conmat(f), vmin=-1, vmax=1, cmap="RdBu_r", interpolation="nearest")
+        else:
+            thumb, z = _thumbnail_sbc(f, z)
+            ax.imshow(thumb, vmin=-1, vmax=1, cmap="RdBu_r", interpolation="nearest")
+        ax.set_title(label, fontsize=6)
+    fig.suptitle(title)
+    fig.savefig(png_file, dpi=72)
+    plt.close(fig)
+
+
+def _run_task(task):
+    func, args, png_file = task
+    func(*args)
+    return png_file
+
+
+def _get_conmat_tasks(conmats_dir):
+    tasks = []
+    for tsv_file in sorted(glob(os.path.join(conmats_dir, "sub-*", "ses-*", "*_conmat.tsv"))):
+        if "_kind-" in os.path.basename(tsv_file):
+            continue
+        subject, session = re.match(r"sub-(.+)_ses-(.+?)_parc-", os.path.basename(tsv_file)).groups()
+        tasks.append((tsv_file, tsv_file.replace("_conmat.tsv", "_conmat.png"), "{}_{} r".format(subject, session)))
+    return tasks
+
+
+def _get_sbc_tasks(sbc_dir):
+    tasks = []
+    for nii_file in sorted(glob(os.path.join(sbc_dir, "participant", "sbc_*_1_*.nii.gz"))):
+        m = re.match(r"sbc_(.+?)_1_(.+)\.nii\.gz", os.path.basename(nii_file))
+        if m.group(1) == "seeds":  # 4D image of all seeds
+            continue
+        seed_name, out_stub = m.groups()
+        png_file = os.path.join(os.path.dirname(nii_file), "sbc_{}_2_fisherz_thrsh0.5_{}.png".format(seed_name,
+                                                                                                 out_stub))
+        report_file = os.path.join(os.path.dirname(nii_file), "sbc_{}_9_info_{}.txt".format(seed_name, out_stub))
+        tasks.append((nii_file, png_file, out_stub + " {} (fisher z)".format(seed_name), report_file))
+    for nii_file in sorted(glob(os.path.join(sbc_dir, "group", "sbc_1_*_ses-*.nii.gz"))):
+        stat, ses = re.match(r"sbc_1_(mean|sd)_ses-(.+)\.nii\.gz", os.path.basename(nii_file)).groups()
+        png_file = os.path.join(os.path.dirname(nii_file), "sbc_2_{}_ses-{}.png".format(stat, ses))
+        tasks.append((nii_file, png_file, "{} sbc {} (fisher z)".format(stat, ses), None))
+    return tasks
+
+
+def _get_contact_sheet_tasks(conmat_tasks, sbc_tasks, figures_dir):
+    # one sheet per conmat variant / sbc seed and session, split into pages of SHEET_SIZE images
+    groups = {}
+    for tsv_file, _, title in conmat_tasks:
+        variant = re.sub(r"^sub-.+?_ses-(.+?)_", r"ses-\1_", os.path.basename(tsv_file)).replace("_conmat.tsv", "")
+        groups.setdefault(("conmat", variant), []).append((tsv_file, title.split(" ")[0]))
+    for nii_file, _, title, report_file in sbc_tasks:
+        if report_file is None:
+            continue
+        seed_name, out_stub = re.match(r"sbc_(.+?)_1_(.+)\.nii\.gz", os.path.basename(nii_file)).groups()
+        session = out_stub.split("_")[-1]
+        groups.setdefault(("sbc", "sbc_{}_ses-{}".format(seed_name, session)), []).append((nii_file, out_stub))
+
+    tasks = []
+    for (kind, variant), files in sorted(groups.items()):
+        for page, start in enumerate(range(0, len(files), SHEET_SIZE)):
+            page_files = files[start:start + SHEET_SIZE]
+            png_file = os.path.join(figures_dir, "contact_sheet_{}_{}.png".format(variant, page + 1))
+            tasks.append((kind, [f for f, _ in page_files], [l for _, l in page_files], png_file,
+                          "{} ({}/{})".format(variant, page + 1, int(np.ceil(len(files) / float(SHEET_SIZE))))))
+    return tasks
+
+
+def render_figures(output_dir, n_jobs=1, contact_sheet=False, overwrite=False):
+    """
+    renders the figures of outputs that were computed with --no_figures: conmat plots (conmats/participant) and sbc
+    maps (sbc/participant, sbc/group). Only missing pngs are rendered (all with overwrite=True).
+    Figures are rendered in a pool of n_jobs processes; each process reuses one matplotlib figure per plot type.
+    contact_sheet: instead of individual pngs, render contact sheets with downsampled conmats/sbc maps of up to
+    SHEET_SIZE sessions per image to output_dir/figures
+    """
+    conmat_tasks = _get_conmat_tasks(os.path.join(output_dir, "conmats", "participant"))
+    sbc_tasks = _get_sbc_tasks(os.path.join(output_dir, "sbc"))
+
+    if contact_sheet:
+        figures_dir = os.path.join(output_dir, "figures")
+        os.makedirs(figures_dir, exist_ok=True)
+        tasks = [(_render_contact_sheet, t, t[3]) for t in _get_contact_sheet_tasks(conmat_tasks, sbc_tasks,
+                                                                                    figures_dir)]
+    else:
+        tasks = [(_render_conmat, t, t[1]) for t in conmat_tasks] + [(_render_sbc, t, t[1]) for t in sbc_tasks]
+    if not overwrite:
+        tasks = [t for t in tasks if not os.path.exists(t[2])]
+    print("*** Rendering {} figures ***".format(len(tasks)))
+
+    if n_jobs == 1:
+        rendered = [_run_task(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rendered = list(executor.map(_run_task, tasks, chunksize=max(1, len(tasks) // (4 * n_jobs))))
+    return rendered
+
+
+def test_render_figures():
+    from tempfile import TemporaryDirectory
+    from conmats import conmats_one_session, _make_test_fmriprep_dir, _get_out_files
+    from sbc import sbc_one_session, _get_sbc_out_files
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        output_dir = os.path.join(tmp_dir, "out")
+        conmats_dir = os.path.join(output_dir, "conmats", "participant")
+        registry_dir = _make_test_fmriprep_dir(fmriprep_dir, "1", "1")
+        conmats_one_session("1", "1", fmriprep_dir, conmats_dir, 2., {"36P": ["test_labels", "test_maps"]}, [None],
+                            registry_dir=registry_dir, figures=False)
+        sbc_dir = os.path.join(output_dir, "sbc", "participant")
+        os.makedirs(sbc_dir)
+        seeds = pd.DataFrame({"name": ["a"], "x": [4], "y": [4], "z": [4]})
+        sbc_one_session("1", "1", fmriprep_dir, sbc_dir, 2., seeds, radius=3, figures=False)
+        png_files = [_get_out_files(conmats_dir, "1", "1", "36P", parc, None)[1]["conmat_plot"]
+                     for parc in ["test_labels", "test_maps"]] + [_get_sbc_out_files(sbc_dir, "a", "1_1")["thresh"]]
+        assert not any(map(os.path.exists, png_files)), "figures created with figures=False"
+
+        rendered = render_figures(output_dir, n_jobs=2)
+        assert sorted(rendered) == sorted(png_files)
+        assert all(map(os.path.exists, png_files)), "figures not rendered"
+        assert render_figures(output_dir) == [], "existing figures rendered again"
+
+        rendered = render_figures(output_dir, contact_sheet=True)
+        assert [os.path.basename(f) for f in rendered] == [
+            "contact_sheet_ses-1_parc-test_labels_conf-36P_spikereg-None_1.png",
+            "contact_sheet_ses-1_parc-test_maps_conf-36P_spikereg-None_1.png",
+            "contact_sheet_sbc_a_ses-1_1.png"]
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 import argparse
 import os
-from joblib import Parallel, delayed
-from utils import get_subject_sessions, get_motion_ts_one_subject
-from conmats import conmat_one_session
-from sbc import sbc_one_session, sbc_group
-import itertools
-import pandas as pd
+import time
+from utils import get_layout, get_subject_sessions, get_files, PRECISIONS
+from dfc import TAPERS
+from connectivity import KINDS
+from motion import EXTRA_COLUMNS
+from instrumentation import TELEMETRY_ENV, timed, summarize_telemetry
+
+# The stage modules of the analysis levels (and with them nilearn, sklearn and matplotlib) are imported in the branch
+# of their level, so each level, and the workers of its jobs, only load what the level uses.
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -20,13 +23,25 @@ if __name__ == "__main__":
                                                *"group_1_sbc_pcc": mean sbc maps
                                                *"participant_2_conmats": connectivity matrix extraction on the subject
                                                level
+                                               *"participant_3_centrality": voxelwise global brain connectivity and
+                                               degree centrality maps
+                                               *"group_2_conmats": mean and SD matrices per session and edgewise
+                                               paired tests between sessions
+                                               *"group_2_qcfc": QC-FC (motion-connectivity) benchmark of all
+                                               conmat variants
                                                *"group_2_collect_motion": motion ts.
                                                Info from all participants are collected into one file
+                                               *"render_figures": renders the figures of outputs computed with
+                                               --no_figures
                                                 '''
                         , choices=['participant_1_sbc_pcc',
                                    'group_1_sbc_pcc',
                                    'participant_2_conmats',
-                                   'group_2_collect_motion'])
+                                   'participant_3_centrality',
+                                   'group_2_conmats',
+                                   'group_2_qcfc',
+                                   'group_2_collect_motion',
+                                   'render_figures'])
 
     parser.add_argument('--participant_label',
                         help='The label of the participant that should be analyzed. The label '
@@ -40,20 +55,118 @@ if __name__ == "__main__":
 
     parser.add_argument('--TR', help='TR of your data in seconds.', type=float)
 
+    parser.add_argument('--mem_limit', help='participant levels: memory budget in GB for all parallel jobs. Jobs are '
+                                            'only started if their estimated memory (from the preproc file header) '
+                                            'fits into the budget. If not defined only --n_cpus limits the jobs',
+                        type=float)
+    parser.add_argument('--blas_threads', help='Number of BLAS/OpenMP threads per job. If not defined the libraries '
+                                               'decide', type=int)
+
+    parser.add_argument('--no_figures', help='Do not create figures in the participant_1_sbc_pcc, group_1_sbc_pcc and '
+                                             'participant_2_conmats steps. They can be created later with '
+                                             'render_figures', action='store_true')
+    parser.add_argument('--contact_sheet', help='render_figures: render contact sheets with downsampled images of up '
+                                                'to 100 sessions instead of one figure per output',
+                        action='store_true')
+
+    parser.add_argument('--atlas_cache_dir', help='Directory to cache atlases resampled to the fmri grid. Can be '
+                                                  'shared between runs. If not defined output_dir/atlas_cache is used')
+
+    parser.add_argument('--bold_cache_dir', help='participant levels: keep uncompressed, memory-mapped copies of the '
+                                                 'preproc files in this (local) directory. Copies are created by a '
+                                                 'prefetch thread shortly ahead of the jobs and removed when the '
+                                                 'jobs of a session are done')
+    parser.add_argument('--bold_cache_float32', help='store the cached preproc files as float32',
+                        action='store_true')
+    parser.add_argument('--precision', help='participant levels: floating point precision of the rs data, cleaning '
+                                            'and correlation. float32 halves the memory of the data copies of '
+                                            'a job (see README)',
+                        default='float64', choices=PRECISIONS)
+
+    parser.add_argument('--seeds', help='participant_1_sbc_pcc: tsv file with a seed table (columns name, x, y, z for '
+                                        'sphere seeds and/or name, mask for roi mask files). If not defined only the '
+                                        'PCC seed is used')
+    parser.add_argument('--sbc_4d', help='participant_1_sbc_pcc: additionally save the maps of all seeds as one 4D '
+                                         'image', action='store_true')
+
+    parser.add_argument('--censor', help='participant_2_conmats: censor volumes with FD above the spike regression '
+                                         'thresholds instead of adding one spike regressor per volume',
+                        action='store_true')
+    parser.add_argument('--censor_before', help='Number of volumes censored before each outlier volume', default=1,
+                        type=int)
+    parser.add_argument('--censor_after', help='Number of volumes censored after each outlier volume', default=2,
+                        type=int)
+    parser.add_argument('--censor_min_run_length', help='Retained segments shorter than this are censored as well',
+                        default=5, type=int)
+
+    parser.add_argument('--kinds', help='participant_2_conmats: connectivity kinds. All kinds are derived from one '
+                                        '(ledoit-wolf) covariance estimate per session; correlation is always '
+                                        'computed. tangent is projected at the group mean in group_2_conmats. '
+                                        'The store holds the off-diagonal edges only (no variances for covariance '
+                                        'and tangent)',
+                        nargs="+", default=["correlation"], choices=KINDS)
+    parser.add_argument('--dfc', help='participant_2_conmats: additionally compute sliding-window (dynamic) '
+                                      'connectivity', action='store_true')
+    parser.add_argument('--dfc_width', help='Window width in volumes', default=30, type=int)
+    parser.add_argument('--dfc_step', help='Window step in volumes', default=1, type=int)
+    parser.add_argument('--dfc_taper', help='Window taper', default='rectangular', choices=TAPERS)
+
+    parser.add_argument('--centrality_thresholds', help='participant_3_centrality: correlation thresholds for degree '
+                                                        'centrality', nargs="+", default=[0.25], type=float)
+    parser.add_argument('--centrality_block_size', help='participant_3_centrality: number of voxels per block of the '
+                                                        'voxel x voxel correlations. Memory per job grows with '
+                                                        'block size x number of voxels x 4 bytes',
+                        default=512, type=int)
+
+    parser.add_argument('--n_perm', help='group_2_conmats: number of sign-flip permutations for the FWE correction '
+                                         'of the paired tests', default=5000, type=int)
+    parser.add_argument('--motion_extra', help='group_2_collect_motion: confound columns to collect in addition to '
+                                               'FD', nargs="+", choices=list(EXTRA_COLUMNS), default=[])
+
     args = parser.parse_args()
 
+    args.fmriprep_dir = os.path.abspath(args.fmriprep_dir)
+    args.output_dir = os.path.abspath(args.output_dir)
     os.makedirs(args.output_dir, exist_ok=True)
     os.chdir(args.output_dir)
 
-    subjects, subjects_sessions = get_subject_sessions(args.fmriprep_dir, args.participant_label)
+    # per-stage telemetry of this run; the workers inherit the directory from the environment
+    telemetry_dir = os.path.join(args.output_dir, "telemetry",
+                                 "{}_{}".format(args.analysis_level, time.strftime("%Y%m%d-%H%M%S")))
+    os.makedirs(telemetry_dir, exist_ok=True)
+    os.environ[TELEMETRY_ENV] = telemetry_dir
+
+    # index of the fmriprep dir; only changed subjects are scanned again on later runs
+    with timed("discover"):
+        layout = get_layout(args.fmriprep_dir, os.path.join(args.output_dir, "layout_index.json"))
+        subjects, subjects_sessions = get_subject_sessions(args.fmriprep_dir, args.participant_label, layout=layout)
     print("Processing {} subjects and a total of {} sessions".format(len(subjects), len(subjects_sessions)))
 
+    atlas_cache_dir = args.atlas_cache_dir or os.path.join(args.output_dir, "atlas_cache")
+
     conf_parcs = {"36P": ["msdl", "schaefer200", "schaefer400", "yeo17", "yeo7", "yeo17split"],
                   "9P": ["yeo17split"]}
 
     spikereg_thresh_list = [None, 0.5, 1.0]
 
+    mem_limit = args.mem_limit * 1024 ** 3 if args.mem_limit else None
+
+    bold_cache_pars, prefetch_stop, prefetch_pars = None, None, {}
+    if args.bold_cache_dir and args.analysis_level.startswith("participant"):
+        from bold_cache import make_prefetch
+        bold_cache_pars = {"cache_dir": args.bold_cache_dir, "dtype": "float32" if args.bold_cache_float32 else None}
+        rs_files = {(subject, session): get_files(args.fmriprep_dir, subject, session, layout)[2]
+                    for subject, session in subjects_sessions}
+        # the running sessions plus one ahead; copies are removed when the jobs of a session are done
+        prefetch_start, prefetch_done, prefetch_stop = make_prefetch(list(rs_files.values()),
+                                                                     lookahead=args.n_cpus + 1, **bold_cache_pars)
+        prefetch_pars = {"on_start": prefetch_start, "on_done": lambda key: prefetch_done(rs_files[key])}
+
+    if args.analysis_level.startswith("participant"):
+        from scheduler import run_jobs, estimate_job_memory, MEM_COPIES
+
     if args.analysis_level == "participant_1_sbc_pcc":
+        from sbc import sbc_one_session
 
         if not args.TR:
             raise Exception("TR required for this step. Stopping")
@@ -61,51 +174,112 @@ if __name__ == "__main__":
         output_dir = os.path.join(args.output_dir, "sbc", "participant")
         os.makedirs(output_dir, exist_ok=True)
 
-        _ = Parallel(n_jobs=args.n_cpus)(
-            delayed(sbc_one_session)(*suse, args.fmriprep_dir, output_dir, args.TR) for suse in
-            subjects_sessions)
+        jobs = [((subject, session),
+                 estimate_job_memory(get_files(args.fmriprep_dir, subject, session, layout)[2], MEM_COPIES["sbc"],
+                                     precision=args.precision),
+                 sbc_one_session,
+                 (subject, session, args.fmriprep_dir, output_dir, args.TR, args.seeds, args.sbc_4d),
+                 {"layout": {subject: layout[subject]}, "bold_cache_pars": bold_cache_pars,
+                  "figures": not args.no_figures, "precision": args.precision})
+                for subject, session in subjects_sessions]
+        _ = run_jobs(jobs, args.n_cpus, mem_limit, args.blas_threads, **prefetch_pars)
 
     elif args.analysis_level == "group_1_sbc_pcc":
+        from sbc import sbc_group
         input_dir = os.path.join(args.output_dir, "sbc", "participant")
         output_dir = os.path.join(args.output_dir, "sbc", "group")
-        sbc_group(input_dir, output_dir)
+        sbc_group(input_dir, output_dir, args.n_cpus, not args.no_figures)
 
     elif args.analysis_level == "participant_2_conmats":
+        from conmats import conmats_one_session
         if not args.TR:
             raise Exception("TR required for this step. Stopping")
 
         output_dir = os.path.join(args.output_dir, "conmats", "participant")
         os.makedirs(output_dir, exist_ok=True)
+        store_dir = os.path.join(args.output_dir, "conmats", "store")
 
-        subjects_sessions_conf_parc = []
-        for c, ps in conf_parcs.items():
-            subjects_sessions_conf_parc += list(itertools.product(subjects_sessions, [c], ps, spikereg_thresh_list))
-
-        _ = Parallel(n_jobs=args.n_cpus)(
-            delayed(conmat_one_session)(suse[0][0],
-                                        suse[0][1],
-                                        args.fmriprep_dir,
-                                        output_dir,
-                                        args.TR,
-                                        suse[1],
-                                        suse[2],
-                                        suse[3])
-            for suse in subjects_sessions_conf_parc)
+        if args.censor:
+            censor_pars = {"before": args.censor_before, "after": args.censor_after,
+                           "min_run_length": args.censor_min_run_length}
+        else:
+            censor_pars = None
 
-    elif args.analysis_level == "group_2_collect_motion":
-        output_dir = os.path.join(args.output_dir, "motion", "group")
+        if args.dfc:
+            dfc_pars = {"width": args.dfc_width, "step": args.dfc_step, "taper": args.dfc_taper}
+        else:
+            dfc_pars = None
+
+        # one job per session; all conf/parc/spikereg variants are computed from one load of the rs data
+        jobs = [((subject, session),
+                 estimate_job_memory(get_files(args.fmriprep_dir, subject, session, layout)[2], MEM_COPIES["conmats"],
+                                     precision=args.precision),
+                 conmats_one_session,
+                 (subject, session, args.fmriprep_dir, output_dir, args.TR, conf_parcs, spikereg_thresh_list,
+                  atlas_cache_dir),
+                 {"censor_pars": censor_pars, "layout": {subject: layout[subject]},
+                  "bold_cache_pars": bold_cache_pars, "store_dir": store_dir, "dfc_pars": dfc_pars,
+                  "kinds": args.kinds, "figures": not args.no_figures, "precision": args.precision})
+                for subject, session in subjects_sessions]
+        _ = run_jobs(jobs, args.n_cpus, mem_limit, args.blas_threads, **prefetch_pars)
+
+        # recomputed matrices were appended again; drop the rows they replace
+        from conmat_store import compact_store
+        for parc_dir in sorted(os.listdir(store_dir)) if os.path.isdir(store_dir) else []:
+            compact_store(store_dir, parc_dir[len("parc-"):])
+
+    elif args.analysis_level == "participant_3_centrality":
+        from centrality import centrality_one_session
+        if not args.TR:
+            raise Exception("TR required for this step. Stopping")
+
+        output_dir = os.path.join(args.output_dir, "centrality", "participant")
         os.makedirs(output_dir, exist_ok=True)
 
-        subjects, subjects_sessions = get_subject_sessions(args.fmriprep_dir, args.participant_label)
+        jobs = [((subject, session),
+                 estimate_job_memory(get_files(args.fmriprep_dir, subject, session, layout)[2],
+                                     MEM_COPIES["centrality"], args.centrality_block_size, args.precision),
+                 centrality_one_session,
+                 (subject, session, args.fmriprep_dir, output_dir, args.TR, args.centrality_thresholds,
+                  args.centrality_block_size),
+                 {"layout": {subject: layout[subject]}, "bold_cache_pars": bold_cache_pars,
+                  "precision": args.precision})
+                for subject, session in subjects_sessions]
+        _ = run_jobs(jobs, args.n_cpus, mem_limit, args.blas_threads, **prefetch_pars)
+
+    elif args.analysis_level == "group_2_conmats":
+        from connectivity import tangent_group
+        from conmats_group import conmats_group
+        store_dir = os.path.join(args.output_dir, "conmats", "store")
+        output_dir = os.path.join(args.output_dir, "conmats", "group")
+        # tangent connectomes need the group mean of the session covariances
+        tangent_group(os.path.join(args.output_dir, "conmats", "participant"), store_dir, output_dir)
+        conmats_group(store_dir, output_dir, subjects, args.n_perm)
+
+    elif args.analysis_level == "group_2_qcfc":
+        from qcfc import qcfc_group
+        store_dir = os.path.join(args.output_dir, "conmats", "store")
+        output_dir = os.path.join(args.output_dir, "conmats", "qcfc")
+        qcfc_group(store_dir, output_dir, args.fmriprep_dir, subjects, layout=layout)
+
+    elif args.analysis_level == "group_2_collect_motion":
+        from motion import collect_motion
+        output_dir = os.path.join(args.output_dir, "motion", "group")
+        collect_motion(subjects_sessions, args.fmriprep_dir, output_dir, spikereg_thresh_list, args.motion_extra,
+                       args.n_cpus, layout)
 
-        # collect motion time series
-        motion_dfs = []
-        for subject, session in subjects_sessions:
-            motion_dfs.append(get_motion_ts_one_subject(subject, session, args.fmriprep_dir))
-        motion_df = pd.concat(motion_dfs)
-        motion_df.reset_index(inplace=True, drop=True)
-        out_file = os.path.join(output_dir, "group_motion_ts.tsv")
-        motion_df.to_csv(out_file, sep="\t")
+    elif args.analysis_level == "render_figures":
+        from render import render_figures
+        render_figures(args.output_dir, args.n_cpus, args.contact_sheet)
 
     else:
         raise NotImplementedError(args.analysis_level)
+
+    if prefetch_stop:
+        prefetch_stop()
+
+    report = summarize_telemetry(telemetry_dir)
+    with open(os.path.join(telemetry_dir, "summary.txt"), "w") as fi:
+        fi.write(report)
+    print("*** Telemetry ({}) ***".format(telemetry_dir))
+    print(report)
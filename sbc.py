@@ -1,118 +1,471 @@
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from nilearn import input_data, plotting
+import pandas as pd
+import nibabel as nb
+import matplotlib
+
+matplotlib.use('Agg')
+from nilearn import input_data, image
 from glob import glob
 from utils import get_files, get_confounds
+from bold_cache import get_cached_bold
+from manifest import load_manifest, is_up_to_date, record_outputs, atomic_output
+from instrumentation import timed, job, job_context
+
+
+PCC_SEED = {"name": "pcc", "x": 0, "y": -52, "z": 18}
+PCC_COORDS = (PCC_SEED["x"], PCC_SEED["y"], PCC_SEED["z"])
+
+# recorded in the output manifest; bump when the sbc computation changes, so existing outputs are recomputed
+MANIFEST_VERSION = 1
+
+
+def get_seed_table(seeds=None):
+    """
+    returns seed table as data frame with one row per seed and the columns
+    * name
+    * x, y, z: mni coordinates of sphere seeds
+    * mask: roi mask file of mask seeds (nan for sphere seeds)
+    seeds can be
+    * None: only the PCC seed (0, -52, 18)
+    * a tsv file or data frame with the columns name, x, y, z (sphere seeds) and/or name, mask (mask seeds)
+    """
+    if seeds is None:
+        seeds = pd.DataFrame([PCC_SEED])
+    elif isinstance(seeds, str):
+        seeds = pd.read_csv(seeds, sep="\t")
+    seeds = pd.DataFrame(seeds).copy()
+    for c in ["x", "y", "z", "mask"]:
+        if c not in seeds.columns:
+            seeds[c] = np.nan
+    if seeds.name.duplicated().any():
+        raise Exception("Seed names not unique {}".format(seeds.name.tolist()))
+    if (seeds["mask"].isnull() & seeds[["x", "y", "z"]].isnull().any(axis=1)).any():
+        raise Exception("Seeds need either coordinates or a mask {}".format(seeds.name.tolist()))
+    return seeds[["name", "x", "y", "z", "mask"]].reset_index(drop=True)
+
 
+def plot_sbc_map(img, seed_coords, title, out_file, bg_img=None, threshold=0.5, figure=None):
+    """
+    saves stat map plot of an sbc map with a marker at seed_coords (x, y, z) to out_file
+    bg_img: background image (default MNI template)
+    figure: matplotlib figure to draw into (cleared first and kept open, so it can be reused); if None a new
+    figure is created and closed
+    """
+    # imported on first use, so jobs without figures do not load nilearn.plotting (and pyplot)
+    from nilearn import plotting
+    if figure is not None:
+        figure.clf()
+    kwargs = {"bg_img": bg_img} if bg_img is not None else {}
+    display = plotting.plot_stat_map(img, threshold=threshold, cut_coords=seed_coords, title=title, figure=figure,
+                                     **kwargs)
+    display.add_markers(marker_coords=[seed_coords], marker_color='g', marker_size=300)
+    display.savefig(out_file)
+    if figure is None:
+        display.close()
+
+
+def _get_sbc_out_files(output_dir, seed_name, out_stub, figures=True):
+    out_files = {"nii": os.path.join(output_dir, "sbc_{}_1_{}.nii.gz".format(seed_name, out_stub)),
+                 "thresh": os.path.join(output_dir, "sbc_{}_2_fisherz_thrsh0.5_{}.png".format(seed_name, out_stub)),
+                 "report": os.path.join(output_dir, "sbc_{}_9_info_{}.txt".format(seed_name, out_stub))}
+    if not figures:
+        out_files.pop("thresh")
+    return out_files
+
+
+def extract_seed_time_series(rs_img, seed_table, masker_pars, confounds, radius=8):
+    """
+    returns cleaned seed time series (n_vols x n_seeds) in the order of seed_table.
+    All sphere seeds are extracted with one NiftiSpheresMasker
+    """
+    seed_time_series = np.zeros((rs_img.shape[-1], len(seed_table)), dtype=masker_pars.get("dtype", np.float64))
+    is_sphere = seed_table["mask"].isnull().values
+    if is_sphere.any():
+        coords = [tuple(c) for c in seed_table.loc[is_sphere, ["x", "y", "z"]].values]
+        seed_masker = input_data.NiftiSpheresMasker(coords, radius=radius, **masker_pars)
+        seed_time_series[:, is_sphere] = seed_masker.fit_transform(rs_img, confounds=confounds.values)
+    for i in np.flatnonzero(~is_sphere):
+        seed_masker = input_data.NiftiLabelsMasker(seed_table["mask"][i], **masker_pars)
+        seed_time_series[:, i] = seed_masker.fit_transform(rs_img, confounds=confounds.values)[:, 0]
+    return seed_time_series
 
-def sbc_one_session(subject, session, fmriprep_dir, output_dir, tr):
 
-    confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session)
+@job("sbc", subject="subject", session="session")
+def sbc_one_session(subject, session, fmriprep_dir, output_dir, tr, seeds=None, output_4d=False, radius=8,
+                    layout=None, bold_cache_pars=None, figures=True, precision="float64"):
+    """
+    calculates seed-based correlation (fisher z) maps for all seeds in the seed table (see get_seed_table; default:
+    PCC). The whole-brain time series are extracted once and all seed maps are calculated with one matrix product.
+    output_4d: additionally save all seed maps as one 4D image (sbc_seeds_1_*.nii.gz, with the seed table as tsv)
+    layout: fmriprep layout index (see utils.get_layout)
+    bold_cache_pars: read the rs data from an uncompressed cache, e.g. {"cache_dir": ..., "dtype": "float32"} (see
+    bold_cache.get_cached_bold)
+    figures: if False, no plots are created (see render.py)
+    precision: "float32" keeps the rs data, the cleaning and the correlation in float32 (see
+    conmats._get_masker_pars); the seed maps are saved as float32 either way
+    Outputs are skipped if the manifest of output_dir (see manifest.py) lists them as computed from the same input
+    files and parameters.
+    """
+    with timed("discover"):
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session, layout)
     out_stub = "{}_{}".format(subject, session)
+    seed_table = get_seed_table(seeds)
+    lp_freq = 0.1
+    hp_freq = 0.01
+    masker_pars = {"mask_img": brainmask_file, "detrend": True, "standardize": True, "low_pass": lp_freq,
+                   "high_pass": hp_freq, "t_r": tr}
+    if precision != "float64":
+        masker_pars["dtype"] = precision
 
     # look for output files
-    out_file_nii = os.path.join(output_dir, "sbc_pcc_1_" + out_stub + ".nii.gz")
-    out_file_thresh = os.path.join(output_dir, "sbc_pcc_2_fisherz_thrsh0.5_" + out_stub + ".png")
-    out_file_report = os.path.join(output_dir, "sbc_pcc_9_info_" + out_stub + ".txt")
+    out_files = {seed_name: _get_sbc_out_files(output_dir, seed_name, out_stub, figures)
+                 for seed_name in seed_table.name}
+    out_file_4d = os.path.join(output_dir, "sbc_seeds_1_" + out_stub + ".nii.gz")
+    out_files_flat = [f for seed_files in out_files.values() for f in seed_files.values()]
+    if output_4d:
+        out_files_flat += [out_file_4d, out_file_4d.replace(".nii.gz", ".tsv")]
+
+    inputs = [rs_file, confounds_file, brainmask_file, anat_file] + seed_table["mask"].dropna().tolist()
+    # NaN (coordinates of mask seeds, mask of sphere seeds) as None, which compares equal after reading the manifest
+    seed_records = seed_table.astype(object).where(seed_table.notnull(), None).to_dict("records")
+    params = {"seeds": seed_records, "radius": radius, "masker_pars": masker_pars,
+              "smoothing_fwhm": 6}
+    with timed("discover"):
+        manifest, existing = load_manifest(output_dir)
 
-    if not (os.path.exists(out_file_thresh) and os.path.exists(out_file_nii) and os.path.exists(out_file_report)):
+    if not is_up_to_date(manifest, existing, out_stub, out_files_flat, inputs, params, MANIFEST_VERSION):
         print("*** Running SBC for {} {} ***".format(subject, session))
         # see http://nilearn.github.io/auto_examples/03_connectivity/plot_seed_to_voxel_correlation.html
-        pcc_coords = [(0, -52, 18)]
-        lp_freq = 0.1
-        hp_freq = 0.01
-
-        # load confounds
+        # load confounds and rs data (once for all maskers)
         confounds, outlier_stats = get_confounds(confounds_file)
+        with timed("load"):
+            rs_img = image.load_img(get_cached_bold(rs_file, **bold_cache_pars) if bold_cache_pars else rs_file)
+            if precision == "float32":
+                # one float32 copy for all maskers; for float64 the (possibly memory-mapped) image is passed on
+                rs_img = image.new_img_like(rs_img, rs_img.get_fdata(dtype=precision), affine=rs_img.affine,
+                                            copy_header=True)
 
-        # extract data from seed ROI
-        seed_masker = input_data.NiftiSpheresMasker(
-            pcc_coords, radius=8,
-            mask_img=brainmask_file,
-            detrend=True, standardize=True,
-            low_pass=lp_freq, high_pass=hp_freq, t_r=tr)
-        seed_time_series = seed_masker.fit_transform(rs_file, confounds=confounds.values)
-
-        #  extract data for the entire brain
-        brain_masker = input_data.NiftiMasker(
-            smoothing_fwhm=6,
-            mask_img=brainmask_file,
-            detrend=True, standardize=True,
-            low_pass=lp_freq, high_pass=hp_freq, t_r=tr)
-        brain_time_series = brain_masker.fit_transform(rs_file, confounds=confounds.values)
-
-        #  calculate correlation
-        seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / \
-                                  seed_time_series.shape[0]
-        seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
-
-        # plot
-        seed_based_correlation_img = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
-        seed_based_correlation_img.to_filename(out_file_nii)
-
-        display = plotting.plot_stat_map(seed_based_correlation_img, threshold=0.5, bg_img=anat_file,
-                                         cut_coords=pcc_coords[0], title=out_stub + " (fisher z)")
-        display.add_markers(marker_coords=pcc_coords, marker_color='g', marker_size=300);
-        display.savefig(out_file_thresh)
-        display.close()
+        with timed("mask_clean"):
+            # extract data from seed ROIs
+            seed_time_series = extract_seed_time_series(rs_img, seed_table, masker_pars, confounds, radius)
+
+            #  extract data for the entire brain
+            brain_masker = input_data.NiftiMasker(smoothing_fwhm=6, **masker_pars)
+            brain_time_series = brain_masker.fit_transform(rs_img, confounds=confounds.values)
+
+        with timed("correlate"):
+            #  calculate correlation of all seeds in one go
+            seed_based_correlations = np.dot(brain_time_series.T, seed_time_series) / \
+                                      seed_time_series.shape[0]
+            seed_based_correlations_fisher_z = np.arctanh(seed_based_correlations)
+
+        # save and plot
+        with timed("write"):
+            seed_based_correlation_imgs = brain_masker.inverse_transform(seed_based_correlations_fisher_z.T)
+            if output_4d:
+                with atomic_output(out_file_4d) as tmp_file:
+                    seed_based_correlation_imgs.to_filename(tmp_file)
+                with atomic_output(out_file_4d.replace(".nii.gz", ".tsv")) as tmp_file:
+                    seed_table.to_csv(tmp_file, sep="\t", index=False)
+
+        for i, seed in seed_table.iterrows():
+            seed_out_files = out_files[seed["name"]]
+            seed_based_correlation_img = image.index_img(seed_based_correlation_imgs, i)
+            with timed("write"), atomic_output(seed_out_files["nii"]) as tmp_file:
+                seed_based_correlation_img.to_filename(tmp_file)
 
-        # report
-        report = "Confounds:\n"
-        report += "\n".join(confounds.columns) + "\n\n"
-        report += "lp_freq: {}\n".format(lp_freq)
-        report += "hp_freq: {}\n".format(hp_freq)
+            if pd.isnull(seed["mask"]):
+                seed_coords = [tuple(seed[["x", "y", "z"]])]
+            else:
+                from nilearn.plotting import find_xyz_cut_coords
+                seed_coords = [tuple(find_xyz_cut_coords(seed["mask"]))]
+            if figures:
+                with timed("plot"), atomic_output(seed_out_files["thresh"]) as tmp_file:
+                    plot_sbc_map(seed_based_correlation_img, seed_coords[0],
+                                 out_stub + " {} (fisher z)".format(seed["name"]), tmp_file, anat_file)
 
-        report += "confounds_file: {}\n".format(confounds_file)
-        report += "brainmask_file: {}\n".format(brainmask_file)
-        report += "rs_file: {}\n".format(rs_file)
-        report += "anat_file: {}\n\n".format(anat_file)
+            # report
+            report = "Seed: {}\n".format(seed["name"])
+            if pd.isnull(seed["mask"]):
+                report += "seed coords: {}\nseed radius: {}\n\n".format(seed_coords[0], radius)
+            else:
+                report += "seed mask: {}\n\n".format(seed["mask"])
+            report += "Confounds:\n"
+            report += "\n".join(confounds.columns) + "\n\n"
+            report += "lp_freq: {}\n".format(lp_freq)
+            report += "hp_freq: {}\n".format(hp_freq)
 
-        report += confounds.to_string()
+            report += "confounds_file: {}\n".format(confounds_file)
+            report += "brainmask_file: {}\n".format(brainmask_file)
+            report += "rs_file: {}\n".format(rs_file)
+            report += "anat_file: {}\n\n".format(anat_file)
 
-        with open(out_file_report, "w") as fi:
-            fi.write(report)
+            report += confounds.to_string()
+
+            with timed("write"), atomic_output(seed_out_files["report"]) as tmp_file:
+                with open(tmp_file, "w") as fi:
+                    fi.write(report)
+        record_outputs(output_dir, out_stub, out_files_flat, inputs, params, MANIFEST_VERSION)
     else:
         print("*** SBC for {} {} already computed. Do nothing. ***".format(subject, session))
 
-def sbc_group(in_dir, out_dir):
+
+def _welford_update(state, data):
+    """
+    adds one map to the running mean/M2 state {"n": ..., "mean": ..., "m2": ...} (Welford's algorithm)
+    """
+    state["n"] += 1
+    delta = data - state["mean"]
+    state["mean"] += delta / state["n"]
+    state["m2"] += delta * (data - state["mean"])
+
+
+def _load_map(nii):
+    img = image.load_img(nii)
+    return img, img.get_fdata(dtype=np.float64)
+
+
+def welford_mean_sd(niis, n_jobs=1):
+    """
+    one-pass mean and sd (np.std, i.e. ddof=0) of 3D maps, e.g. subject sbc maps.
+    Maps are read one at a time (in batches of n_jobs threads if n_jobs > 1) and accumulated in float64, so memory
+    stays constant in the number of maps.
+    returns mean_img, sd_img
+    """
+    state = None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for i in range(0, len(niis), n_jobs):
+            for img, data in executor.map(_load_map, niis[i:i + n_jobs]):
+                if state is None:
+                    ref_img = img
+                    state = {"n": 0, "mean": np.zeros(data.shape), "m2": np.zeros(data.shape)}
+                elif data.shape != state["mean"].shape:
+                    raise Exception("Shape of {} does not match {}".format(img.get_filename(),
+                                                                           ref_img.get_filename()))
+                _welford_update(state, data)
+
+    if state is None:
+        raise Exception("No maps to aggregate")
+    mean_img = image.new_img_like(ref_img, state["mean"], affine=ref_img.affine)
+    sd_img = image.new_img_like(ref_img, np.sqrt(state["m2"] / state["n"]), affine=ref_img.affine)
+    return mean_img, sd_img
+
+
+def _welford_downdate(state, data):
+    """
+    removes one map from the running mean/M2 state (inverse of _welford_update)
+    """
+    if state["n"] == 1:
+        state["n"] = 0
+        state["mean"][:] = 0
+        state["m2"][:] = 0
+        return
+    old_mean = state["mean"].copy()
+    state["n"] -= 1
+    state["mean"] -= (data - old_mean) / state["n"]
+    state["m2"] -= (data - old_mean) * (data - state["mean"])
+
+
+def _scan_signature(nii):
+    st = os.stat(nii)
+    return [st.st_size, st.st_mtime]
+
+
+def update_group_state(state_dir, niis, n_jobs=1):
+    """
+    incremental version of welford_mean_sd.
+    The sufficient statistics (n, mean, M2) and the list of contributing scans (with size and mtime) are stored in
+    state_dir. On later calls only new or changed maps are read and folded in, and maps that were retracted (or
+    changed) are removed. For this, the non-zero voxels of each contributing map are kept in state_dir (float32,
+    compressed; removing a float64 map therefore leaves an error below float32 precision in the state).
+    returns mean_img, sd_img, changed (False if the state was already up to date)
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    stats_file = os.path.join(state_dir, "stats.npz")
+    scans_file = os.path.join(state_dir, "scans.json")
+
+    state, scans, affine = None, {}, None
+    if os.path.exists(stats_file) and os.path.exists(scans_file):
+        with np.load(stats_file) as stats:
+            state = {"n": int(stats["n"]), "mean": stats["mean"], "m2": stats["m2"]}
+            affine = stats["affine"]
+        with open(scans_file) as fi:
+            scans = json.load(fi)
+
+    signatures = {nii: _scan_signature(nii) for nii in niis}
+    to_remove = [nii for nii in scans if signatures.get(nii) != scans[nii]["signature"]]
+    to_add = [nii for nii in niis if nii not in scans or nii in to_remove]
+
+    for nii in to_remove:
+        contribution_file = os.path.join(state_dir, scans.pop(nii)["contribution"])
+        with np.load(contribution_file) as contribution:
+            data = np.zeros(state["mean"].shape)
+            data.flat[contribution["idx"]] = contribution["values"]
+        _welford_downdate(state, data)
+        os.remove(contribution_file)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for i in range(0, len(to_add), n_jobs):
+            batch = to_add[i:i + n_jobs]
+            for nii, (img, data) in zip(batch, executor.map(_load_map, batch)):
+                if state is None:
+                    affine = img.affine
+                    state = {"n": 0, "mean": np.zeros(data.shape), "m2": np.zeros(data.shape)}
+                elif data.shape != state["mean"].shape:
+                    raise Exception("Shape of {} does not match group state".format(nii))
+                _welford_update(state, data)
+
+                contribution = os.path.basename(nii).split(".")[0] + ".npz"
+                idx = np.flatnonzero(data)
+                np.savez_compressed(os.path.join(state_dir, contribution), idx=idx.astype(np.int32),
+                                    values=data.flat[idx].astype(np.float32))
+                scans[nii] = {"signature": signatures[nii], "contribution": contribution}
+
+    if state is None or state["n"] == 0:
+        raise Exception("No maps to aggregate")
+
+    changed = bool(to_remove or to_add)
+    if changed:
+        np.savez(stats_file + ".tmp.npz", n=state["n"], mean=state["mean"], m2=state["m2"], affine=affine)
+        os.replace(stats_file + ".tmp.npz", stats_file)
+        with open(scans_file + ".tmp", "w") as fi:
+            json.dump(scans, fi)
+        os.replace(scans_file + ".tmp", scans_file)
+        print("group state: removed {}, added {} maps".format(len(to_remove), len(to_add)))
+
+    mean_img = nb.Nifti1Image(state["mean"], affine)
+    sd_img = nb.Nifti1Image(np.sqrt(np.clip(state["m2"], 0, None) / state["n"]), affine)
+    return mean_img, sd_img, changed
+
+
+def sbc_group(in_dir, out_dir, n_jobs=1, figures=True):
     """
     for each session: load sbc (z transformed) of all subjects and calculate mean & sd
+    maps are aggregated in one streaming pass with n_jobs reader threads. The group state is stored in
+    out_dir/sbc_ses-*_state, so later runs only read new or changed maps (see update_group_state)
+    figures: if False, no plots are created (see render.py)
     """
     os.makedirs(out_dir, exist_ok=True)
-    niis = glob(os.path.join(in_dir, "*.nii.gz"))
+    niis = glob(os.path.join(in_dir, "sbc_pcc_1_*.nii.gz"))
     sessions = list(set(map(lambda f: os.path.basename(f).split("_")[-1].split(".")[0], niis)))
     sessions.sort()
     print("calc mean sbc for {}".format(sessions))
     for ses in sessions:
-        niis = glob(os.path.join(in_dir, "*{}.nii.gz".format(ses)))
-        niis.sort()
-        print(niis)
-        from nilearn import image, plotting
-
-        out_filename_mean_nii = os.path.join(out_dir, "sbc_1_mean_ses-{}.nii.gz".format(ses))
-        out_filename_sd_nii = os.path.join(out_dir, "sbc_1_sd_ses-{}.nii.gz".format(ses))
-        out_filename_mean_png = os.path.join(out_dir, "sbc_2_mean_ses-{}.png".format(ses))
-        out_filename_sd_png = os.path.join(out_dir, "sbc_2_sd_ses-{}.png".format(ses))
-        out_filename_list = os.path.join(out_dir, "sbc_ses-{}_scans.txt".format(ses))
-
-        mean_sbc = image.mean_img(niis)
-        mean_sbc.to_filename(out_filename_mean_nii)
-        concat_img = image.concat_imgs(niis)
-        sd_sbc = image.math_img("np.std(img, axis=-1)", img=concat_img)
-        sd_sbc.to_filename(out_filename_sd_nii)
-
-        with open(out_filename_list, "w") as fi:
-            fi.write("\n".join(niis))
-
-        display = plotting.plot_stat_map(mean_sbc, threshold=0.5,
-                                         cut_coords=(0, -52, 18), title="mean sbc {} (fisher z)".format(ses))
-        display.add_markers(marker_coords=[(0, -52, 18)], marker_color='g', marker_size=300);
-        display.savefig(out_filename_mean_png)
-        display.close()
+        with job_context("sbc_group", session=ses):
+            niis = glob(os.path.join(in_dir, "sbc_pcc_1_*{}.nii.gz".format(ses)))
+            niis.sort()
+            print(niis)
+
+            out_filename_mean_nii = os.path.join(out_dir, "sbc_1_mean_ses-{}.nii.gz".format(ses))
+            out_filename_sd_nii = os.path.join(out_dir, "sbc_1_sd_ses-{}.nii.gz".format(ses))
+            out_filename_mean_png = os.path.join(out_dir, "sbc_2_mean_ses-{}.png".format(ses))
+            out_filename_sd_png = os.path.join(out_dir, "sbc_2_sd_ses-{}.png".format(ses))
+            out_filename_list = os.path.join(out_dir, "sbc_ses-{}_scans.txt".format(ses))
+            state_dir = os.path.join(out_dir, "sbc_ses-{}_state".format(ses))
+
+            with timed("aggregate"):
+                mean_sbc, sd_sbc, changed = update_group_state(state_dir, niis, n_jobs)
+            out_files = [out_filename_mean_nii, out_filename_sd_nii, out_filename_list]
+            if figures:
+                out_files += [out_filename_mean_png, out_filename_sd_png]
+            if not changed and all(map(os.path.exists, out_files)):
+                print("*** Group sbc for {} up to date. Do nothing. ***".format(ses))
+                continue
+
+            with timed("write"):
+                mean_sbc.to_filename(out_filename_mean_nii)
+                sd_sbc.to_filename(out_filename_sd_nii)
+
+                with open(out_filename_list, "w") as fi:
+                    fi.write("\n".join(niis))
+
+            if figures:
+                with timed("plot"):
+                    plot_sbc_map(mean_sbc, PCC_COORDS, "mean sbc {} (fisher z)".format(ses), out_filename_mean_png)
+                    plot_sbc_map(sd_sbc, PCC_COORDS, "sd sbc {} (fisher z)".format(ses), out_filename_sd_png,
+                                 threshold=1e-6)
+
+
+def test_welford_mean_sd():
+    from tempfile import TemporaryDirectory
+    import nibabel as nb
+    rng = np.random.RandomState(0)
+    with TemporaryDirectory() as tmp_dir:
+        niis = []
+        for i in range(7):
+            niis.append(os.path.join(tmp_dir, "sbc_pcc_1_{}_1.nii.gz".format(i)))
+            nb.Nifti1Image(rng.randn(4, 5, 6).astype(np.float32) + 3, np.eye(4)).to_filename(niis[-1])
+        expected_mean = image.mean_img(niis).get_fdata()
+        expected_sd = np.std(image.concat_imgs(niis).get_fdata(), axis=-1)
+        for n_jobs in [1, 3]:
+            mean_img, sd_img = welford_mean_sd(niis, n_jobs)
+            assert np.allclose(mean_img.get_fdata(), expected_mean), "mean differs"
+            assert np.allclose(sd_img.get_fdata(), expected_sd), "sd differs"
+
+
+def test_update_group_state():
+    from tempfile import TemporaryDirectory
+    rng = np.random.RandomState(0)
+    with TemporaryDirectory() as tmp_dir:
+        niis = []
+        for i in range(6):
+            niis.append(os.path.join(tmp_dir, "sbc_pcc_1_{}_1.nii.gz".format(i)))
+            nb.Nifti1Image(rng.randn(4, 5, 6) + 3, np.eye(4)).to_filename(niis[-1])
+        state_dir = os.path.join(tmp_dir, "state")
+        update_group_state(state_dir, niis[:4])
+        _, _, changed = update_group_state(state_dir, niis[:4])
+        assert not changed, "state should be up to date"
+
+        # add two maps, retract one, change one
+        nb.Nifti1Image(rng.randn(4, 5, 6), np.eye(4)).to_filename(niis[1])
+        os.utime(niis[1], (0, 1))
+        current = niis[1:]
+        mean_img, sd_img, changed = update_group_state(state_dir, current, n_jobs=2)
+        assert changed
+        expected_mean, expected_sd = welford_mean_sd(current)
+        assert np.allclose(mean_img.get_fdata(), expected_mean.get_fdata()), "incremental mean differs"
+        assert np.allclose(sd_img.get_fdata(), expected_sd.get_fdata()), "incremental sd differs"
+        assert len(os.listdir(state_dir)) == len(current) + 2, "contributions not cleaned up"
+        with np.load(os.path.join(state_dir, os.path.basename(niis[2]).split(".")[0] + ".npz")) as contribution:
+            assert contribution["values"].dtype == np.float32 and contribution["idx"].dtype == np.int32
+
+
+def test_sbc_one_session_seeds():
+    from tempfile import TemporaryDirectory
+    from conmats import _make_test_fmriprep_dir
+    from nilearn import masking
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        output_dir = os.path.join(tmp_dir, "out")
+        os.makedirs(output_dir)
+        _make_test_fmriprep_dir(fmriprep_dir, "1", "1")
+        seeds = pd.DataFrame({"name": ["a", "b"], "x": [4, 8], "y": [4, 8], "z": [4, 6]})
+        sbc_one_session("1", "1", fmriprep_dir, output_dir, 2., seeds, output_4d=True, radius=3)
+
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, "1", "1")
+        confounds, _ = get_confounds(confounds_file)
+        masker_pars = {"mask_img": brainmask_file, "detrend": True, "standardize": True, "low_pass": 0.1,
+                       "high_pass": 0.01, "t_r": 2.}
+        brain_time_series = input_data.NiftiMasker(smoothing_fwhm=6, **masker_pars).fit_transform(
+            rs_file, confounds=confounds.values)
+        seed_maps_4d = masking.apply_mask(os.path.join(output_dir, "sbc_seeds_1_1_1.nii.gz"), brainmask_file)
+        for i, seed in seeds.iterrows():
+            seed_time_series = input_data.NiftiSpheresMasker([(seed.x, seed.y, seed.z)], radius=3,
+                                                             **masker_pars).fit_transform(rs_file,
+                                                                                          confounds=confounds.values)
+            expected = np.arctanh(np.dot(brain_time_series.T, seed_time_series) / seed_time_series.shape[0])[:, 0]
+            out_files = _get_sbc_out_files(output_dir, seed["name"], "1_1")
+            assert all(map(os.path.exists, out_files.values())), "seed output missing"
+            assert np.allclose(masking.apply_mask(out_files["nii"], brainmask_file), expected), "seed map wrong"
+            assert np.allclose(seed_maps_4d[i], expected), "4D seed map wrong"
 
-        display = plotting.plot_stat_map(sd_sbc,
-                                         cut_coords=(0, -52, 18), title="sd sbc {} (fisher z)".format(ses))
-        display.add_markers(marker_coords=[(0, -52, 18)], marker_color='g', marker_size=300);
-        display.savefig(out_filename_sd_png)
-        display.close()
\ No newline at end of file
+        # second run is skipped based on the manifest; changed parameters are recomputed
+        mtime = os.stat(out_files["nii"]).st_mtime
+        sbc_one_session("1", "1", fmriprep_dir, output_dir, 2., seeds, output_4d=True, radius=3)
+        assert os.stat(out_files["nii"]).st_mtime == mtime, "up-to-date outputs recomputed"
+        sbc_one_session("1", "1", fmriprep_dir, output_dir, 2., seeds, output_4d=True, radius=2)
+        assert os.stat(out_files["nii"]).st_mtime != mtime, "outputs not recomputed after parameter change"
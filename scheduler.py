@@ -0,0 +1,125 @@
+import os
+import time
+import numpy as np
+import nibabel as nb
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# approximate number of float64 copies of the 4D data a job holds at its peak (on top of the loaded data)
+MEM_COPIES = {"conmats": 1.5, "sbc": 3, "centrality": 2}
+MEM_OVERHEAD = 300 * 1024 ** 2
+
+
+def estimate_job_memory(rs_file, n_copies=1.5, block_size=0, precision="float64"):
+    """
+    estimates peak memory of a job (bytes) from the nifti header of rs_file (no data is read):
+    the data in its stored dtype plus n_copies copies in precision (float64 or float32) and a fixed overhead
+    block_size: jobs that hold a (block_size x n_voxels) float32 block (see centrality.blocked_centrality)
+    """
+    header = nb.load(rs_file).header
+    shape = header.get_data_shape()
+    n_values = int(np.prod(shape))
+    block_bytes = block_size * int(np.prod(shape[:3])) * 4
+    copy_bytes = np.dtype(precision).itemsize * n_copies
+    return n_values * (header.get_data_dtype().itemsize + copy_bytes) + block_bytes + MEM_OVERHEAD
+
+
+def _init_worker(blas_threads):
+    if blas_threads:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=blas_threads)
+
+
+def _run_group(jobs):
+    return [func(*args, **kwargs) for func, args, kwargs in jobs]
+
+
+def run_jobs(jobs, n_jobs=1, mem_limit=None, blas_threads=None, on_start=None, on_done=None):
+    """
+    runs jobs in a process pool with memory-aware admission
+    jobs: list of (key, mem_estimate, func, args, kwargs); jobs with the same key (e.g., the same session) are run
+    one after another in the same worker, so they can reuse data (e.g. page-cached files)
+    n_jobs: number of worker processes
+    mem_limit: memory budget in bytes. A job group is only started if the summed estimates of the running groups
+    plus its own estimate (the max. of its jobs) fit into the budget. A group that exceeds the budget on its own is
+    run alone.
+    blas_threads: number of BLAS/OpenMP threads per worker (avoids oversubscription)
+    on_start: called once the workers exist (e.g., to start threads, which must not run while workers are forked)
+    on_done: called with the key of each finished group (e.g., to free cached inputs)
+    returns the results in the order of jobs
+    """
+    groups = OrderedDict()
+    for i, (key, mem, func, args, kwargs) in enumerate(jobs):
+        groups.setdefault(key, []).append((i, mem, func, args, kwargs))
+
+    results = [None] * len(jobs)
+    if n_jobs == 1:
+        _init_worker(blas_threads)
+        if on_start:
+            on_start()
+        for key, group in groups.items():
+            for i, _, func, args, kwargs in group:
+                results[i] = func(*args, **kwargs)
+            if on_done:
+                on_done(key)
+        return results
+
+    pending = list(groups.items())
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(blas_threads,)) as executor:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                group_mem = max(j[1] for j in pending[0][1])
+                used_mem = sum(m for _, _, m in running.values())
+                if running and mem_limit and used_mem + group_mem > mem_limit:
+                    break
+                key, group = pending.pop(0)
+                future = executor.submit(_run_group, [(func, args, kwargs) for _, _, func, args, kwargs in group])
+                running[future] = (key, group, group_mem)
+                if on_start:
+                    # with the fork start method, the pool forks all workers on the first submit
+                    on_start()
+                    on_start = None
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, group, _ = running.pop(future)
+                for (i, _, _, _, _), result in zip(group, future.result()):
+                    results[i] = result
+                if on_done:
+                    on_done(key)
+    return results
+
+
+def _test_job(x, sleep=0.):
+    from threadpoolctl import threadpool_info
+    time.sleep(sleep)
+    return x, os.getpid(), [i["num_threads"] for i in threadpool_info()]
+
+
+def test_run_jobs():
+    import multiprocessing
+    # two jobs per key; keys must be run by the same worker
+    jobs = [(k, 1, _test_job, (i,), {"sleep": 0.05}) for i, k in enumerate([0, 1, 2, 0, 1, 2])]
+    for n_jobs, mem_limit in [(1, None), (3, None), (3, 2)]:
+        results = run_jobs(jobs, n_jobs=n_jobs, mem_limit=mem_limit, blas_threads=1)
+        assert [r[0] for r in results] == list(range(6)), "results not in job order"
+        for k in range(3):
+            assert results[k][1] == results[k + 3][1], "jobs of one key not run in one worker"
+        assert all(n == 1 for r in results for n in r[2]), "blas threads not limited"
+
+    started, done_keys = [], []
+    run_jobs(jobs, n_jobs=2, blas_threads=1, on_start=lambda: started.append(len(multiprocessing.active_children())),
+             on_done=done_keys.append)
+    assert started == [2], "started before the workers were forked"
+    assert sorted(done_keys) == [0, 1, 2]
+
+
+def test_estimate_job_memory():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as tmp_dir:
+        rs_file = os.path.join(tmp_dir, "rs.nii.gz")
+        nb.Nifti1Image(np.zeros((4, 5, 6, 10), dtype=np.int16), np.eye(4)).to_filename(rs_file)
+        assert estimate_job_memory(rs_file, 1) == 1200 * (2 + 8) + MEM_OVERHEAD
+        assert estimate_job_memory(rs_file, 1, block_size=10) == 1200 * (2 + 8) + 10 * 120 * 4 + MEM_OVERHEAD
+        assert estimate_job_memory(rs_file, 1, precision="float32") == 1200 * (2 + 4) + MEM_OVERHEAD
@@ -0,0 +1,213 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import nibabel as nb
+from scipy import signal as sp_signal
+from scipy.spatial import cKDTree
+from utils import FUNC_PATTERNS, ANAT_PATTERN
+
+# networks with correlated signal; parcels of all synthetic atlases sample them
+N_NETWORKS = 7
+MOTION_COLUMNS = ["X", "Y", "Z", "RotX", "RotY", "RotZ"]
+
+
+def get_synthetic_affine(shape, voxel_size):
+    # grid centered on the MNI brain (so the default PCC seed lies inside the mask)
+    origin = -(np.array(shape) - 1) * voxel_size / 2. + np.array([0, -18, 12])
+    affine = np.diag([voxel_size] * 3 + [1.])
+    affine[:3, 3] = origin
+    return affine
+
+
+def get_synthetic_mask(shape):
+    # ellipsoid filling most of the grid
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    return sum(g ** 2 for g in grid) < 0.85 ** 2
+
+
+def _voronoi_labels(mask, n_regions, rng):
+    # random seed voxels of the mask; each voxel gets the label (1..n_regions) of its closest seed
+    coords = np.argwhere(mask)
+    seeds = coords[rng.choice(len(coords), n_regions, replace=False)]
+    labels = np.zeros(mask.shape, dtype=np.int16)
+    labels[mask] = cKDTree(seeds).query(coords)[1] + 1
+    return labels
+
+
+def make_synthetic_atlases(registry_dir, shape=(32, 38, 32), voxel_size=4., n_parcels=(100, 400), n_maps=20,
+                           seed=0):
+    """
+    writes small offline atlases on the synthetic grid and adds them to the atlas registry in registry_dir
+    (see atlases.add_to_registry):
+    * synth<n> for n in n_parcels: labels atlas with n parcels
+    * synth_maps: maps atlas with n_maps gaussian blobs
+    returns the parcellation names
+    """
+    from atlases import add_to_registry
+    rng = np.random.RandomState(seed)
+    os.makedirs(registry_dir, exist_ok=True)
+    affine = get_synthetic_affine(shape, voxel_size)
+    mask = get_synthetic_mask(shape)
+    parcs = []
+    for n in n_parcels:
+        labels_file = os.path.join(registry_dir, "synth{}_labels.nii.gz".format(n))
+        nb.Nifti1Image(_voronoi_labels(mask, n, rng), affine).to_filename(labels_file)
+        add_to_registry(registry_dir, "synth{}".format(n), labels_file, ["p{}".format(i + 1) for i in range(n)],
+                        "labels")
+        os.remove(labels_file)
+        parcs.append("synth{}".format(n))
+
+    coords = np.argwhere(mask)
+    centers = coords[rng.choice(len(coords), n_maps, replace=False)]
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing="ij"), axis=-1)
+    maps = np.stack([np.exp(-((grid - c) ** 2).sum(-1) / (2 * 2. ** 2)) for c in centers], axis=-1)
+    maps[maps < 0.05] = 0
+    maps_file = os.path.join(registry_dir, "synth_maps_maps.nii.gz")
+    nb.Nifti1Image((maps * mask[..., np.newaxis]).astype(np.float32), affine).to_filename(maps_file)
+    add_to_registry(registry_dir, "synth_maps", maps_file, ["m{}".format(i + 1) for i in range(n_maps)], "maps")
+    os.remove(maps_file)
+    parcs.append("synth_maps")
+    return parcs
+
+
+def _bandpassed_noise(rng, n_vols, n_signals, tr, low=0.01, high=0.1):
+    b, a = sp_signal.butter(2, [low * 2 * tr, min(high * 2 * tr, 0.99)], btype="band")
+    x = sp_signal.filtfilt(b, a, rng.randn(n_vols + 50, n_signals), axis=0)[25:-25]
+    return x / x.std(0)
+
+
+def _motion(rng, n_vols, spike_prob=0.05):
+    # fd with occasional spikes, motion parameters as their random walk
+    fd = np.abs(rng.randn(n_vols)) * 0.08 + 0.05
+    spikes = rng.rand(n_vols) < spike_prob
+    fd[spikes] += rng.uniform(0.5, 2., spikes.sum())
+    fd[0] = np.nan
+    steps = rng.randn(n_vols, 6) * np.nan_to_num(fd)[:, np.newaxis] / np.sqrt(6)
+    steps[:, 3:] /= 50.  # rotations in radians
+    return fd, np.cumsum(steps, axis=0)
+
+
+def make_synthetic_session(func_dir, stub, mask, affine, n_vols, tr, rng, network_labels, bold_dtype="float32"):
+    """
+    writes preproc bold, brainmask and confounds of one session with fmriprep names to func_dir
+    bold_dtype: stored dtype of the bold data; "int16" is stored with scaling factor (like many fmriprep outputs)
+    The bold data are network signals (band-passed noise, shared by all voxels of a network) plus voxel noise,
+    global signal and motion-related signal drops at the volumes with high FD.
+    """
+    n_voxels = int(mask.sum())
+    networks = _bandpassed_noise(rng, n_vols, N_NETWORKS, tr)
+    global_signal = _bandpassed_noise(rng, n_vols, 1, tr)[:, 0]
+    fd, motion_params = _motion(rng, n_vols)
+
+    data = rng.randn(n_vols, n_voxels).astype(np.float32)
+    data += 0.8 * networks[:, network_labels[mask] - 1].astype(np.float32)
+    data += (0.3 * global_signal - 0.5 * np.nan_to_num(fd))[:, np.newaxis].astype(np.float32)
+    data *= 10.
+    data += (1000 + 200 * rng.rand(n_voxels)).astype(np.float32)
+
+    bold = np.zeros(mask.shape + (n_vols,), dtype=np.float32)
+    bold[mask] = data.T
+    del data
+    img = nb.Nifti1Image(bold, affine)
+    img.set_data_dtype(bold_dtype)
+    img.header.set_xyzt_units("mm", "sec")
+    img.header["pixdim"][4] = tr
+    img.to_filename(os.path.join(func_dir, FUNC_PATTERNS["preproc"].replace("sub-*", stub)))
+    nb.Nifti1Image(mask.astype(np.uint8), affine).to_filename(
+        os.path.join(func_dir, FUNC_PATTERNS["brainmask"].replace("sub-*", stub)))
+
+    gs = bold[mask].mean(0)
+    del bold
+    confounds = pd.DataFrame({"CSF": 0.5 * gs + rng.randn(n_vols), "WhiteMatter": 0.2 * gs + rng.randn(n_vols),
+                              "GlobalSignal": gs})
+    confounds["stdDVARS"] = 1 + np.nan_to_num(fd) + 0.1 * rng.rand(n_vols)
+    confounds.loc[0, "stdDVARS"] = np.nan
+    confounds["FramewiseDisplacement"] = fd
+    for i, c in enumerate(MOTION_COLUMNS):
+        confounds[c] = motion_params[:, i]
+    confounds.to_csv(os.path.join(func_dir, FUNC_PATTERNS["confounds"].replace("sub-*", stub)), sep="\t",
+                     index=False, na_rep="n/a")
+
+
+def make_fmriprep_dataset(out_dir, n_subjects=4, n_sessions=2, n_vols=200, shape=(32, 38, 32), voxel_size=4.,
+                          tr=2., n_parcels=(100, 400), seed=0, bold_dtype="float32"):
+    """
+    writes a synthetic fmriprep dataset to out_dir, for tests and benchmarks without real scans:
+    * out_dir/fmriprep: sub-<01..>/ses-<1..>/func with preproc bold, brainmask and confounds, and sub-*/anat with the
+      T1w, with the file names utils.get_files expects
+    * out_dir/registry: atlas registry with the synthetic atlases (see make_synthetic_atlases)
+    Data size per session: n_vols x shape x 4 bytes (uncompressed; 2 bytes for bold_dtype "int16", see
+    make_synthetic_session).
+    returns fmriprep_dir, registry_dir, parcs
+    """
+    rng = np.random.RandomState(seed)
+    fmriprep_dir = os.path.join(out_dir, "fmriprep")
+    registry_dir = os.path.join(out_dir, "registry")
+    affine = get_synthetic_affine(shape, voxel_size)
+    mask = get_synthetic_mask(shape)
+    network_labels = _voronoi_labels(mask, N_NETWORKS, rng)
+
+    for subject in ["{:02d}".format(i + 1) for i in range(n_subjects)]:
+        anat_dir = os.path.join(fmriprep_dir, "sub-" + subject, "anat")
+        os.makedirs(anat_dir, exist_ok=True)
+        t1w = mask * (800 + 200 * rng.rand(*shape)).astype(np.float32)
+        nb.Nifti1Image(t1w, affine).to_filename(os.path.join(anat_dir, ANAT_PATTERN.replace("sub-*",
+                                                                                            "sub-" + subject)))
+        for session in [str(i + 1) for i in range(n_sessions)]:
+            print("*** Writing synthetic session {} {} ***".format(subject, session))
+            func_dir = os.path.join(fmriprep_dir, "sub-" + subject, "ses-" + session, "func")
+            os.makedirs(func_dir, exist_ok=True)
+            make_synthetic_session(func_dir, "sub-{}_ses-{}".format(subject, session), mask, affine, n_vols, tr,
+                                   rng, network_labels, bold_dtype)
+
+    parcs = make_synthetic_atlases(registry_dir, shape, voxel_size, n_parcels, seed=seed)
+    return fmriprep_dir, registry_dir, parcs
+
+
+def test_make_fmriprep_dataset():
+    from tempfile import TemporaryDirectory
+    from utils import get_subject_sessions, get_files, get_confounds
+    from atlases import get_roi_info
+    from conmats import extract_mat
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir, registry_dir, parcs = make_fmriprep_dataset(tmp_dir, 2, 2, 60, (12, 14, 12), 8., n_parcels=(10,),
+                                                                  seed=1)
+        assert parcs == ["synth10", "synth_maps"]
+        subjects, subjects_sessions = get_subject_sessions(fmriprep_dir, None)
+        assert subjects_sessions == [("01", "1"), ("01", "2"), ("02", "1"), ("02", "2")]
+
+        confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, "02", "2")
+        confounds, outlier_stats = get_confounds(confounds_file, spikereg_threshold=0.5)
+        assert confounds.shape[0] == 60 and outlier_stats.n_tr.sum() == 60
+        assert nb.load(rs_file).shape == (12, 14, 12, 60)
+        for parc in parcs:
+            roi_file, roi_names, roi_type = get_roi_info(parc, registry_dir)
+            conmat, _, _ = extract_mat(rs_file, brainmask_file, roi_file, confounds_file, "36P", roi_type, 2.)
+            assert conmat.shape == (len(roi_names), len(roi_names))
+            assert np.isfinite(conmat).all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='writes a synthetic fmriprep dataset and atlas registry')
+    parser.add_argument('out_dir', help='the dataset is written to out_dir/fmriprep, the atlases to out_dir/registry')
+    parser.add_argument('--n_subjects', type=int, default=4)
+    parser.add_argument('--n_sessions', type=int, default=2)
+    parser.add_argument('--n_vols', type=int, default=200)
+    parser.add_argument('--shape', help='grid size in voxels', type=int, nargs=3, default=[32, 38, 32])
+    parser.add_argument('--voxel_size', help='voxel size in mm', type=float, default=4.)
+    parser.add_argument('--tr', help='repetition time in seconds', type=float, default=2.)
+    parser.add_argument('--n_parcels', help='number of parcels of the synthetic labels atlases', type=int, nargs="+",
+                        default=[100, 400])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bold_dtype', help='stored dtype of the synthetic bold data', default='float32',
+                        choices=['float32', 'int16'])
+    args = parser.parse_args()
+
+    fmriprep_dir, registry_dir, parcs = make_fmriprep_dataset(os.path.abspath(args.out_dir), args.n_subjects,
+                                                              args.n_sessions, args.n_vols, tuple(args.shape),
+                                                              args.voxel_size, args.tr, tuple(args.n_parcels),
+                                                              args.seed, args.bold_dtype)
+    print("*** Synthetic dataset in {}, atlas registry in {} (parcellations: {}) ***".format(
+        fmriprep_dir, registry_dir, ", ".join(parcs)))
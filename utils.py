@@ -1,46 +1,114 @@
 import os
+import json
 from glob import glob
-import itertools
-import matplotlib
+from fnmatch import fnmatch
+import numpy as np
+import pandas as pd
+from instrumentation import timed
 
-matplotlib.use('Agg')
 
-import pandas as pd
+FUNC_PATTERNS = {"confounds": "sub-*_task-rest_run-1_bold_confounds.tsv",
+                 "brainmask": "sub-*_task-rest_run-1_bold_space-MNI152NLin2009cAsym_brainmask.nii.gz",
+                 "preproc": "sub-*_task-rest_run-1_bold_space-MNI152NLin2009cAsym_preproc.nii.gz"}
+ANAT_PATTERN = "sub-*_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz"
+# floating point precision of the voxelwise data, cleaning and correlation (see conmats._get_masker_pars)
+PRECISIONS = ["float64", "float32"]
 
 
-def get_subject_sessions(input_dir, participant_label, raise_if_empty=True, fmriprep_dir=True):
+def _scan_subject(input_dir, subject):
+    """
+    scans sub-<subject> with os.scandir and returns its layout entry
+    {"dirs": {dir: mtime}, "anat": [anat files],
+     "sessions": {session: {"func": bool, "confounds": [...], "brainmask": [...], "preproc": [...], "anat": [...]}}}
+    "dirs" holds the mtimes of all scanned directories, which change when files are added or removed
+    """
+    entry = {"dirs": {}, "anat": [], "sessions": {}}
+
+    def scan(path):
+        entry["dirs"][path] = os.stat(path).st_mtime
+        return list(os.scandir(path))
+
+    def match(path, pattern):
+        return sorted([e.path for e in scan(path) if fnmatch(e.name, pattern)])
+
+    for e in scan(os.path.join(input_dir, "sub-" + subject)):
+        if e.name == "anat" and e.is_dir():
+            entry["anat"] = match(e.path, ANAT_PATTERN)
+        elif fnmatch(e.name, "ses-*") and e.is_dir():
+            session_entry = {"func": False, "anat": []}
+            session_entry.update({k: [] for k in FUNC_PATTERNS})
+            for e_ses in scan(e.path):
+                if e_ses.name == "func" and e_ses.is_dir():
+                    session_entry["func"] = True
+                    func_files = [f for f in scan(e_ses.path)]
+                    for k, pattern in FUNC_PATTERNS.items():
+                        session_entry[k] = sorted([f.path for f in func_files if fnmatch(f.name, pattern)])
+                elif e_ses.name == "anat" and e_ses.is_dir():
+                    session_entry["anat"] = match(e_ses.path, ANAT_PATTERN)
+            entry["sessions"][e.name.split("-")[-1]] = session_entry
+    return entry
+
+
+def get_layout(input_dir, index_file=None):
+    """
+    returns an index of the fmriprep/bids directory: {subject: layout entry (see _scan_subject)}
+    The directory is walked with os.scandir (no chdir, no glob).
+    If index_file is given, the index is stored there and re-used on later calls. Only subjects with a changed
+    directory mtime (i.e., added or removed files or sessions) are scanned again.
+    """
+    input_dir = os.path.abspath(input_dir)
+    old_layout = {}
+    if index_file and os.path.exists(index_file):
+        with open(index_file) as fi:
+            index = json.load(fi)
+        if index["input_dir"] == input_dir:
+            old_layout = index["layout"]
+
+    def up_to_date(entry):
+        try:
+            return all(os.stat(d).st_mtime == mtime for d, mtime in entry["dirs"].items())
+        except FileNotFoundError:
+            return False
+
+    subjects = sorted([e.name.split("-")[-1] for e in os.scandir(input_dir)
+                       if fnmatch(e.name, "sub-*") and not e.name.endswith(".html") and e.is_dir()])
+    layout, n_scanned = {}, 0
+    for subject in subjects:
+        if subject in old_layout and up_to_date(old_layout[subject]):
+            layout[subject] = old_layout[subject]
+        else:
+            layout[subject] = _scan_subject(input_dir, subject)
+            n_scanned += 1
+
+    if index_file and (n_scanned or set(layout) != set(old_layout)):
+        with open(index_file + ".tmp", "w") as fi:
+            json.dump({"input_dir": input_dir, "layout": layout}, fi)
+        os.replace(index_file + ".tmp", index_file)
+    return layout
+
+
+def get_subject_sessions(input_dir, participant_label, raise_if_empty=True, fmriprep_dir=True, layout=None):
     """
     returns a list of subjects and a list of subject, session tuples
     * input_dir can be an fmriprep_dir; set fmriprep_dir=True to filter out sessions that only have anat, but no func
     * input_dir can be any hierarchy of type sub-01/ses-11; then set fmriprep_dir=False
+    * layout: index from get_layout; if None, input_dir is scanned
     """
-    os.chdir(input_dir)
+    if layout is None:
+        layout = get_layout(input_dir)
 
     # get subjects
+    subjects = list(layout.keys())
     if participant_label:
-        subjects = list(map(lambda s: glob("sub-{}".format(s)), participant_label))
-        subjects = list(itertools.chain.from_iterable(subjects))
-    else:
-        subjects = glob("sub-*")
-
-    subjects = list(filter(lambda s: not s.endswith(".html"), subjects))
-    subjects = list(map(lambda s: s.split("-")[-1], subjects))
+        subjects = list(filter(lambda s: any(fnmatch(s, p) for p in participant_label), subjects))
     subjects.sort()
 
-    # get subject_sessions
-    def get_subject_sessions_one_sub(subject):
-        sessions = glob("sub-{}/ses-*".format(subject))
-        sessions.sort()
-        return list(map(lambda s: (subject, s.split("-")[-1]), sessions))
-
     # subjects_sessions list of tupels: [('s01', 'tp1'), ('s01', 'tp2'), ('s02', 'tp1')]
-    subjects_sessions = list(map(get_subject_sessions_one_sub, subjects))
-    subjects_sessions = list(itertools.chain.from_iterable(subjects_sessions))
+    subjects_sessions = [(subject, session) for subject in subjects for session in sorted(layout[subject]["sessions"])]
 
     if fmriprep_dir:
         # filter out sessions that only have anat, but no func:
-        subjects_sessions = list(filter(lambda s: os.path.isdir(os.path.join(input_dir, "sub-" + s[0], "ses-" + s[1],
-                                                                             "func")), subjects_sessions))
+        subjects_sessions = list(filter(lambda s: layout[s[0]]["sessions"][s[1]]["func"], subjects_sessions))
 
     print(subjects, subjects_sessions)
     if raise_if_empty:
@@ -60,29 +128,56 @@ def check_and_return_path(search_str):
         return l[0]
 
 
-def get_files(fmriprep_dir, subject, session):
-    subject_dir = os.path.join(fmriprep_dir, "sub-" + subject)
-    session_dir = os.path.join(subject_dir, "ses-" + session)
-
-    confounds_file = check_and_return_path(
-        os.path.join(session_dir, "func", "sub-*_task-rest_run-1_bold_confounds.tsv"))
-    brainmask_file = check_and_return_path(
-        os.path.join(session_dir, "func", "sub-*_task-rest_run-1_bold_space-MNI152NLin2009cAsym_brainmask.nii.gz"))
-    rs_file = check_and_return_path(
-        os.path.join(session_dir, "func", "sub-*_task-rest_run-1_bold_space-MNI152NLin2009cAsym_preproc.nii.gz"))
-    try:
-        anat_file = check_and_return_path(
-            os.path.join(subject_dir, "anat", "sub-*_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz"))
-    except:  # might be a case with only 1 session, there the anat files are under sub-xx/ses-xx/anat/...
-        anat_file = check_and_return_path(
-            os.path.join(session_dir, "anat", "sub-*_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz"))
+def _check_and_return_one(files, search_str):
+    if len(files) != 1:
+        raise Exception("found more or less than one file: {}. {}".format(search_str, files))
+    else:
+        return files[0]
+
+
+def get_files(fmriprep_dir, subject, session, layout=None):
+    """
+    returns confounds_file, brainmask_file, rs_file, anat_file of one session
+    layout: index from get_layout (or the entries of some subjects); if None or the subject is not in it, only the
+    subject's directory is scanned
+    """
+    if layout is None or subject not in layout:
+        layout = {subject: _scan_subject(fmriprep_dir, subject)}
+    subject_entry = layout[subject]
+    if session not in subject_entry["sessions"]:
+        raise Exception("Session not found: sub-{} ses-{}".format(subject, session))
+    session_entry = subject_entry["sessions"][session]
+    session_dir = os.path.join(fmriprep_dir, "sub-" + subject, "ses-" + session)
+
+    confounds_file, brainmask_file, rs_file = [
+        _check_and_return_one(session_entry[k], os.path.join(session_dir, "func", FUNC_PATTERNS[k]))
+        for k in ["confounds", "brainmask", "preproc"]]
+    if len(subject_entry["anat"]) == 1:
+        anat_file = subject_entry["anat"][0]
+    else:  # might be a case with only 1 session, there the anat files are under sub-xx/ses-xx/anat/...
+        anat_file = _check_and_return_one(session_entry["anat"], os.path.join(session_dir, "anat", ANAT_PATTERN))
     return confounds_file, brainmask_file, rs_file, anat_file
 
 
-def get_motion_ts_one_subject(subject, session, fmriprep_dir):
+def get_confounds_file(fmriprep_dir, subject, session, layout=None):
+    """
+    returns the confounds file of one session; unlike get_files, only the confounds file is looked up
+    layout: index from get_layout; if None or the subject is not in it, only the session's func directory is globbed
+    """
+    search_str = os.path.join(fmriprep_dir, "sub-" + subject, "ses-" + session, "func", FUNC_PATTERNS["confounds"])
+    if layout is not None and subject in layout:
+        if session not in layout[subject]["sessions"]:
+            raise Exception("Session not found: sub-{} ses-{}".format(subject, session))
+        files = layout[subject]["sessions"][session]["confounds"]
+    else:
+        files = glob(search_str)
+    return _check_and_return_one(files, search_str)
+
+
+def get_motion_ts_one_subject(subject, session, fmriprep_dir, layout=None):
     # returns data frame with FD time series
-    confounds_file, brainmask_file, rs_file, anat_file = get_files(fmriprep_dir, subject, session)
-    df = pd.read_csv(confounds_file, sep="\t")
+    confounds_file = get_confounds_file(fmriprep_dir, subject, session, layout)
+    df = pd.read_csv(confounds_file, sep="\t", usecols=["FramewiseDisplacement"])
 
     frames = df[['FramewiseDisplacement']].copy()
     frames["subject"] = subject
@@ -124,13 +219,15 @@ def get_spikereg_confounds(motion_ts, threshold):
     return outliers, outlier_stats
 
 
-def get_confounds(confounds_file, kind="36P", spikereg_threshold=None):
+def get_confounds(confounds_file, kind="36P", spikereg_threshold=None, censor=False):
     """
     takes a fmriprep confounds file and creates data frame with regressors.
     kind == "36P" returns Satterthwaite's 36P confound regressors
     kind == "9P" returns CSF, WM, Global signal + 6 motion parameters (used in Ng et al., 2016)
 
     if spikereg_threshold=None, no spike regression is performed
+    if censor=True, no spike regressors are added (outlier volumes are censored instead, see get_censor_mask), but
+    outlier_stats are still returned
 
     Satterthwaite, T. D., Elliott, M. A., Gerraty, R. T., Ruparel, K., Loughead, J., Calkins, M. E., et al. (2013).
     An improved framework for confound regression and filtering for control of motion artifact in the preprocessing
@@ -139,11 +236,19 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None):
 
     Ng et al. (2016). http://doi.org/10.1016/j.neuroimage.2016.03.029
     """
+    with timed("confounds"):
+        df = pd.read_csv(confounds_file, sep="\t")
+        return get_confounds_from_df(df, kind, spikereg_threshold, censor)
+
+
+def get_confounds_from_df(df, kind="36P", spikereg_threshold=None, censor=False):
+    """
+    same as get_confounds, but takes an already loaded fmriprep confounds data frame.
+    allows to create several confound variants from one confounds file without re-reading it
+    """
     if kind not in ["36P", "9P", "6P"]:
         raise Exception("Confound type unknown {}".format(kind))
 
-    df = pd.read_csv(confounds_file, sep="\t")
-
     p6 = df[['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']]
     p9 = df[['CSF', 'WhiteMatter', 'GlobalSignal', 'X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']]
     p9_der = p9.diff().fillna(0)
@@ -167,12 +272,131 @@ def get_confounds(confounds_file, kind="36P", spikereg_threshold=None):
         threshold = 99999
     outliers, outlier_stats = get_spikereg_confounds(df["FramewiseDisplacement"].values, threshold)
 
-    if spikereg_threshold:
+    if spikereg_threshold and not censor:
         confounds = pd.concat([confounds, outliers], axis=1)
 
     return confounds, outlier_stats
 
 
+def get_censor_mask(motion_ts, threshold, before=0, after=0, min_run_length=0):
+    """
+    alternative to spike regression: returns the volumes to keep after censoring
+    * volumes with motion > threshold are censored
+    * additionally, <before> volumes before and <after> volumes after each of those are censored
+    * retained segments shorter than <min_run_length> volumes are censored as well
+    e.g. Power et al. (2014) use before=1, after=2, min_run_length=5
+
+    motion_ts = [0.1, 0.7, 0.2, 0.6, 0.3]
+    get_censor_mask(motion_ts, 0.5, after=1)
+    returns
+    1.) sample_mask: indices of retained volumes, here: array([0])
+    2.) a df with counts of censored and retained trs
+       censored  n_tr
+    0     False     1
+    1      True     4
+
+    Censoring is not equivalent to spike regression in the pipeline: only a plain confound regression (without
+    detrending and filtering) gives the same residuals at the retained volumes for both. Detrending and band-pass
+    filtering run over the censored gaps (nilearn interpolates them), whereas spike regression detrends and filters
+    all volumes, so the conmats differ (see test_censor_vs_spikereg).
+
+    Power, J. D., Mitra, A., Laumann, T. O., Snyder, A. Z., Schlaggar, B. L., & Petersen, S. E. (2014). Methods to
+    detect, characterize, and remove motion artifact in resting state fMRI. NeuroImage, 84, 320–341.
+    http://doi.org/10.1016/j.neuroimage.2013.08.048
+    """
+    motion = pd.Series(motion_ts).fillna(0).values  # first value is nan
+    n_vols = len(motion)
+    censored = np.zeros(n_vols, dtype=bool)
+    if threshold:
+        for i in np.flatnonzero(motion > threshold):
+            censored[max(i - before, 0):i + after + 1] = True
+
+    if min_run_length:
+        # censor short runs of retained volumes
+        edges = np.diff(np.concatenate(([0], (~censored).astype(int), [0])))
+        for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            if stop - start < min_run_length:
+                censored[start:stop] = True
+
+    censor_stats = pd.DataFrame({"censored": censored, "n_tr": 1}).groupby("censored").count().reset_index()
+    return np.flatnonzero(~censored), censor_stats
+
+
+def test_censor_mask():
+    sample_mask, censor_stats = get_censor_mask([0.1, 0.7, 0.2, 0.6, 0.3], 0.5, after=1)
+    assert sample_mask.tolist() == [0], "censoring with neighbors wrong"
+    sample_mask, _ = get_censor_mask([np.nan, 0.1, 0.7, 0.2, 0.1, 0.1, 0.1, 0.6, 0.1, 0.1], 0.5, min_run_length=3)
+    assert sample_mask.tolist() == [3, 4, 5, 6], "min run length censoring wrong"
+    sample_mask, censor_stats = get_censor_mask([0.1, 0.2, 0.3], None)
+    assert sample_mask.tolist() == [0, 1, 2]
+    assert censor_stats.n_tr.sum() == 3
+
+
+def test_censor_vs_spikereg():
+    import warnings
+    from nilearn import signal
+    confounds_file = "test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv"
+    fd = pd.read_csv(confounds_file, sep="\t")["FramewiseDisplacement"].values
+    spike_confounds, _ = get_confounds(confounds_file, spikereg_threshold=0.3)
+    censor_confounds, _ = get_confounds(confounds_file, spikereg_threshold=0.3, censor=True)
+    sample_mask, _ = get_censor_mask(fd, 0.3)
+    assert 0 < len(sample_mask) < len(fd), "no volumes censored"
+    x = np.random.RandomState(0).randn(len(fd), 5)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        # plain regression: spike regressors and censoring give the same residuals at the retained volumes
+        pars = {"detrend": False, "standardize": False, "standardize_confounds": False, "filter": False}
+        spikereg = signal.clean(x, confounds=spike_confounds.values, **pars)[sample_mask]
+        censored = signal.clean(x, confounds=censor_confounds.values, sample_mask=sample_mask, **pars)
+        assert np.allclose(spikereg, censored)
+
+        # with detrending and filtering (as in the conmats) they differ
+        pars = {"detrend": True, "standardize": False, "low_pass": 0.1, "high_pass": 0.01, "t_r": 2.}
+        spikereg = signal.clean(x, confounds=spike_confounds.values, **pars)[sample_mask]
+        censored = signal.clean(x, confounds=censor_confounds.values, sample_mask=sample_mask, **pars)
+        assert not np.allclose(spikereg, censored, atol=0.1)
+
+
+def test_get_layout():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as tmp_dir:
+        fmriprep_dir = os.path.join(tmp_dir, "fmriprep")
+        files = ["sub-01/anat/sub-01_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz",
+                 "sub-01/ses-1/func/sub-01_ses-1_task-rest_run-1_bold_confounds.tsv",
+                 "sub-01/ses-1/func/sub-01_ses-1_task-rest_run-1_bold_space-MNI152NLin2009cAsym_brainmask.nii.gz",
+                 "sub-01/ses-1/func/sub-01_ses-1_task-rest_run-1_bold_space-MNI152NLin2009cAsym_preproc.nii.gz",
+                 "sub-01/ses-2/anat/sub-01_ses-2_T1w.nii.gz",
+                 "sub-02/ses-1/anat/sub-02_T1w_space-MNI152NLin2009cAsym_preproc.nii.gz",
+                 "sub-02/ses-1/func/sub-02_ses-1_task-rest_run-1_bold_confounds.tsv",
+                 "sub-02/ses-1/func/sub-02_ses-1_task-rest_run-1_bold_space-MNI152NLin2009cAsym_brainmask.nii.gz",
+                 "sub-02/ses-1/func/sub-02_ses-1_task-rest_run-1_bold_space-MNI152NLin2009cAsym_preproc.nii.gz",
+                 "sub-01.html"]
+        for f in files:
+            os.makedirs(os.path.dirname(os.path.join(fmriprep_dir, f)), exist_ok=True)
+            open(os.path.join(fmriprep_dir, f), "w").close()
+        index_file = os.path.join(tmp_dir, "layout_index.json")
+        cwd = os.getcwd()
+        layout = get_layout(fmriprep_dir, index_file)
+        assert os.getcwd() == cwd, "layout changed cwd"
+
+        subjects, subjects_sessions = get_subject_sessions(fmriprep_dir, None, layout=layout)
+        assert subjects == ["01", "02"]
+        assert subjects_sessions == [("01", "1"), ("02", "1")], "sessions without func not filtered"
+        _, subjects_sessions = get_subject_sessions(fmriprep_dir, ["02"], fmriprep_dir=False, layout=layout)
+        assert subjects_sessions == [("02", "1")]
+
+        assert get_files(fmriprep_dir, "01", "1", layout)[3] == os.path.join(fmriprep_dir, files[0])
+        assert get_files(fmriprep_dir, "02", "1", layout)[3] == os.path.join(fmriprep_dir, files[5])
+        assert get_files(fmriprep_dir, "02", "1") == get_files(fmriprep_dir, "02", "1", layout)
+
+        # adding a session invalidates the subject's entry
+        os.makedirs(os.path.join(fmriprep_dir, "sub-02/ses-2/func"))
+        os.utime(os.path.join(fmriprep_dir, "sub-02"), (0, 1))
+        layout = get_layout(fmriprep_dir, index_file)
+        assert "2" in layout["02"]["sessions"], "index not updated"
+
+
 def test_spikereg():
     confounds_file = os.path.join("test_data/sub-1_ses-1_task-rest_run-1_bold_confounds.tsv")
     df = pd.read_csv(confounds_file, sep="\t")